@@ -0,0 +1,251 @@
+"""Аналитика посещаемости на массивах NumPy.
+
+Журнал загружается один раз в компактную матрицу: студенты и пары (дата, номер)
+кодируются как категории, статус хранится в int8-матрице студент × пара.
+Все счётчики и проценты считаются векторными свёртками без циклов по записям.
+"""
+import datetime
+
+import numpy as np
+
+# Порядок статусов задаёт их коды: 1, 2, 3, 4. 0 - нет отметки, последний код - прочее
+STATUS_TEXTS = ('Присутствовал', 'Отсутствовал', 'Болел', 'Уважительная причина')
+NO_MARK = 0
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+def _parse_date(value):
+    try:
+        return np.datetime64(datetime.datetime.strptime(str(value), "%d.%m.%Y").date(), 'D')
+    except ValueError:
+        return np.datetime64('NaT', 'D')
+
+
+def _slot_keys(dates, lessons):
+    """Ключ пары: день * 100 + номер пары"""
+    return np.asarray(dates, dtype='datetime64[D]').astype(np.int64) * 100 + np.asarray(lessons, dtype=np.int64)
+
+
+class ScheduleCalendar:
+    """Предрассчитанное расписание за период: для каждой подгруппы
+    отсортированные ключи пар и коды меток (предмет, слот преподавателя и т.п.)"""
+
+    def __init__(self, entries):
+        """entries - кортежи (дата, номер пары, подгруппа, метка)"""
+        self.labels = []
+        label_codes = {}
+        by_subgroup = {}
+        for date, lesson, subgroup, label in entries:
+            if label not in label_codes:
+                label_codes[label] = len(self.labels)
+                self.labels.append(label)
+            by_subgroup.setdefault(subgroup, ([], [], []))
+            dates, lessons, codes = by_subgroup[subgroup]
+            dates.append(date)
+            lessons.append(lesson)
+            codes.append(label_codes[label])
+
+        self.tables = {}
+        for subgroup, (dates, lessons, codes) in by_subgroup.items():
+            keys = _slot_keys(dates, lessons)
+            order = np.argsort(keys, kind='stable')
+            self.tables[subgroup] = (keys[order], np.array(codes, dtype=np.int32)[order])
+
+    def lookup(self, dates, lessons, subgroup):
+        """Коды меток для пар (-1 - пары нет в расписании подгруппы)"""
+        result = np.full(len(dates), -1, dtype=np.int32)
+        if subgroup not in self.tables or not len(dates):
+            return result
+        keys, codes = self.tables[subgroup]
+        if not len(keys):
+            return result
+        wanted = _slot_keys(dates, lessons)
+        positions = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+        found = keys[positions] == wanted
+        result[found] = codes[positions[found]]
+        return result
+
+
+class AttendanceMatrix:
+    """Матрица посещаемости: строки - студенты, столбцы - пары (дата, номер пары)"""
+
+    def __init__(self, students, dates, lessons, status, status_texts=STATUS_TEXTS):
+        self.students = list(students)
+        self.student_index = {name: i for i, name in enumerate(self.students)}
+        self.dates = dates
+        self.lessons = lessons
+        self.status = status
+        self.status_texts = tuple(status_texts)
+        # Коды статусов: 1..len(status_texts), и ещё один - для прочих значений
+        self.other_code = len(self.status_texts) + 1
+
+    @classmethod
+    def from_records(cls, records, students=(), status_texts=STATUS_TEXTS):
+        """Строит матрицу из записей листа (результат get_all_records).
+        Студенты из students идут первыми и в том же порядке, остальные - после.
+        При повторных отметках одной пары побеждает последняя запись"""
+        status_codes = {text: code for code, text in enumerate(status_texts, start=1)}
+        other_code = len(status_texts) + 1
+
+        student_index = {name: i for i, name in enumerate(students)}
+        names = list(students)
+        date_values, lesson_values, student_codes, codes = [], [], [], []
+        for record in records:
+            name = record.get('Студент', '')
+            date_value = record.get('Дата', '')
+            if not name or not date_value:
+                continue
+            if name not in student_index:
+                student_index[name] = len(names)
+                names.append(name)
+            date_values.append(str(date_value))
+            lesson_values.append(_to_int(record.get('Пара', '')))
+            student_codes.append(student_index[name])
+            codes.append(status_codes.get(record.get('Статус', ''), other_code))
+
+        if not date_values:
+            return cls(names, np.array([], dtype='datetime64[D]'), np.array([], dtype=np.int16),
+                       np.zeros((len(names), 0), dtype=np.int8), status_texts)
+
+        # Даты разбираются только по уникальным значениям
+        unique_dates, date_inverse = np.unique(np.array(date_values), return_inverse=True)
+        parsed = np.array([_parse_date(value) for value in unique_dates], dtype='datetime64[D]')
+        dates = parsed[date_inverse]
+        lessons = np.array(lesson_values, dtype=np.int32)
+
+        valid = ~np.isnat(dates) & (lessons >= 0)
+        dates, lessons = dates[valid], lessons[valid]
+        student_codes = np.array(student_codes, dtype=np.int32)[valid]
+        codes = np.array(codes, dtype=np.int8)[valid]
+
+        # Пара = день * 100 + номер; уникальные ключи уже отсортированы по дате и номеру
+        slot_keys = dates.astype(np.int64) * 100 + lessons
+        unique_slots, slot_codes = np.unique(slot_keys, return_inverse=True)
+
+        # Повторные отметки одной пары: NumPy не гарантирует, какое значение останется
+        # при повторяющихся индексах, поэтому последняя запись выбирается явно
+        cells = student_codes.astype(np.int64) * len(unique_slots) + slot_codes
+        _, last_from_end = np.unique(cells[::-1], return_index=True)
+        last = len(cells) - 1 - last_from_end
+        status = np.zeros((len(names), len(unique_slots)), dtype=np.int8)
+        status[student_codes[last], slot_codes[last]] = codes[last]
+
+        return cls(
+            names,
+            (unique_slots // 100).astype('datetime64[D]'),
+            (unique_slots % 100).astype(np.int16),
+            status,
+            status_texts
+        )
+
+    # ==================== ВЫБОРКИ ====================
+    def select_slots(self, mask):
+        return AttendanceMatrix(self.students, self.dates[mask], self.lessons[mask],
+                                self.status[:, mask], self.status_texts)
+
+    def between(self, start_date, end_date):
+        """Пары с start_date включительно по end_date не включительно"""
+        start = np.datetime64(start_date, 'D')
+        end = np.datetime64(end_date, 'D')
+        return self.select_slots((self.dates >= start) & (self.dates < end))
+
+    def month(self, year, month):
+        start = datetime.date(year, month, 1)
+        end = datetime.date(year + 1, 1, 1) if month == 12 else datetime.date(year, month + 1, 1)
+        return self.between(start, end)
+
+    def select_students(self, names):
+        rows = np.array([self.student_index[name] for name in names], dtype=np.int64)
+        return AttendanceMatrix(names, self.dates, self.lessons,
+                                self.status[rows] if len(rows) else self.status[:0], self.status_texts)
+
+    # ==================== СВЁРТКИ ====================
+    def _onehot(self):
+        """Булев массив студент × пара × статус (без столбца 'нет отметки')"""
+        codes = np.arange(1, self.other_code + 1, dtype=np.int8)
+        return self.status[:, :, None] == codes
+
+    def marked_slots(self):
+        """Пары, в которых есть хотя бы одна отметка: список (дата, номер пары)"""
+        mask = (self.status != NO_MARK).any(axis=0)
+        return [(date.item(), int(lesson)) for date, lesson in zip(self.dates[mask], self.lessons[mask])]
+
+    def counts_by_student(self):
+        """Массив студент × статус"""
+        return self._onehot().sum(axis=1)
+
+    def counts_by_slot_group(self, slot_groups, group_count):
+        """Массив студент × группа пар × статус; slot_groups - код группы для каждой пары"""
+        groups = np.zeros((len(slot_groups), group_count), dtype=np.int32)
+        groups[np.arange(len(slot_groups)), slot_groups] = 1
+        return np.einsum('stc,tk->skc', self._onehot().astype(np.int32), groups)
+
+    def counts_by_student_group(self, student_groups, group_count):
+        """Массив группа студентов × статус; student_groups - код группы для каждого студента"""
+        groups = np.zeros((len(student_groups), group_count), dtype=np.int32)
+        groups[np.arange(len(student_groups)), student_groups] = 1
+        return groups.T @ self.counts_by_student()
+
+    def counts_by_subject(self, subjects):
+        """subjects - название предмета для каждой пары.
+        Возвращает (список предметов, массив студент × предмет × статус)"""
+        names, codes = np.unique(np.asarray(subjects, dtype=object).astype(str), return_inverse=True)
+        return list(names), self.counts_by_slot_group(codes, len(names))
+
+    def counts_by_week(self):
+        """Возвращает (понедельники недель, массив студент × неделя × статус)"""
+        # 1970-01-01 - четверг, сдвиг на 3 дня выравнивает недели по понедельникам
+        week_numbers = (self.dates.astype(np.int64) + 3) // 7
+        weeks, codes = np.unique(week_numbers, return_inverse=True)
+        mondays = [(np.datetime64(int(week * 7 - 3), 'D')).item() for week in weeks]
+        return mondays, self.counts_by_slot_group(codes, len(weeks))
+
+    def counts_by_subgroup(self, subgroups):
+        """subgroups - подгруппа каждого студента. Возвращает (подгруппы, массив подгруппа × статус)"""
+        names, codes = np.unique(np.asarray(subgroups, dtype=object).astype(str), return_inverse=True)
+        return list(names), self.counts_by_student_group(codes, len(names))
+
+    def counts_by_calendar(self, calendar, student_subgroups):
+        """Соединяет отметки с расписанием: каждой паре студента - метка из календаря его подгруппы.
+        Возвращает (метки, массив метка × статус, число отметок вне расписания)"""
+        subgroups = np.asarray(student_subgroups, dtype=object).astype(str)
+        codes = np.full(self.status.shape, -1, dtype=np.int32)
+        # Цикл только по подгруппам (2-3 штуки), сама выборка - searchsorted по всем парам сразу
+        for subgroup in np.unique(subgroups):
+            codes[subgroups == subgroup] = calendar.lookup(self.dates, self.lessons, subgroup)
+
+        marked = self.status != NO_MARK
+        joined = marked & (codes >= 0)
+        flat = codes[joined].astype(np.int64) * self.other_code + (self.status[joined] - 1)
+        counts = np.bincount(flat, minlength=len(calendar.labels) * self.other_code)
+        return (
+            list(calendar.labels),
+            counts.reshape(len(calendar.labels), self.other_code),
+            int(marked.sum() - joined.sum())
+        )
+
+    def attendance_rate(self, counts):
+        """Процент посещения по массиву счётчиков (последняя ось - статусы)"""
+        total = counts.sum(axis=-1)
+        present = counts[..., 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.where(total > 0, present / np.maximum(total, 1) * 100, 0.0)
+        return np.round(rate, 1)
+
+    def first_mark_per_day(self):
+        """Статус самой ранней отмеченной пары каждого дня.
+        Возвращает (даты, массив студент × дата с кодами статусов)"""
+        days, starts = np.unique(self.dates, return_index=True)
+        if not len(days):
+            return [], np.zeros((len(self.students), 0), dtype=np.int8)
+        slot_count = self.status.shape[1]
+        positions = np.where(self.status != NO_MARK, np.arange(slot_count), slot_count)
+        first = np.minimum.reduceat(positions, starts, axis=1)
+        padded = np.concatenate([self.status, np.zeros((len(self.students), 1), dtype=np.int8)], axis=1)
+        return [day.item() for day in days], np.take_along_axis(padded, first, axis=1)
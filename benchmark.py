@@ -0,0 +1,584 @@
+"""Офлайн-бенчмарк бота: Google Sheets и Telegram заменены на заглушки в памяти.
+
+Сценарии прогоняют настоящие обработчики из bot.py через bot.process_new_updates
+и для каждого выводят время, количество вызовов API и пиковую память.
+
+Запуск:
+    python benchmark.py                         # все сценарии
+    python benchmark.py mark_group report_10k   # выбранные сценарии
+    python benchmark.py --sheets-latency 0.2 --sheets-429 0.05 --json
+    python benchmark.py --sleep-scale 0         # без встроенных пауз бота (быстрый прогон)
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from threading import Lock, Thread
+
+os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+
+import telebot
+from gspread.exceptions import APIError
+from gspread.utils import numericise_all
+
+import bot
+
+ATTENDANCE_HEADER = ['Дата', 'Пара', 'Группа', 'Студент', 'Статус', 'Причина', 'Время']
+STUDENTS_HEADER = ['Группа', 'Студент', 'Подгруппа']
+
+
+# ==================== ЗАГЛУШКА GOOGLE SHEETS ====================
+class FakeQuotaError(APIError):
+    """Имитация ответа 429 от Google Sheets API (в том же виде, что у gspread)"""
+
+    def __init__(self):
+        super().__init__(FakeResponse({'error': {
+            'code': 429,
+            'message': "Quota exceeded for quota metric 'Read requests'",
+            'status': 'RESOURCE_EXHAUSTED'
+        }}, status_code=429))
+
+
+class FakeWorksheet:
+    """Лист в памяти с API, совместимым с используемой частью gspread.Worksheet"""
+
+    def __init__(self, title, rows, latency=0.0, error_rate=0.0, seed=0):
+        self.title = title
+        self.rows = [list(map(str, row)) for row in rows]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.quota_errors = 0
+        self.lock = Lock()
+
+    def _call(self, method_name):
+        with self.lock:
+            self.calls[method_name] = self.calls.get(method_name, 0) + 1
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.quota_errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise FakeQuotaError()
+
+    @property
+    def row_count(self):
+        return len(self.rows)
+
+    def get_all_values(self, *args, **kwargs):
+        self._call('get_all_values')
+        with self.lock:
+            return [list(row) for row in self.rows]
+
+    def get_all_records(self, *args, **kwargs):
+        self._call('get_all_records')
+        with self.lock:
+            header = self.rows[0] if self.rows else []
+            return [dict(zip(header, numericise_all(row))) for row in self.rows[1:]]
+
+    def col_values(self, col, *args, **kwargs):
+        """Значения столбца (номер с 1), как у gspread - без пустых в конце"""
+        self._call('col_values')
+        with self.lock:
+            values = [row[col - 1] if len(row) >= col else '' for row in self.rows]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def get(self, range_name=None, *args, **kwargs):
+        """Значения диапазона вида A1:G100 (пустые строки в конце не возвращаются)"""
+        self._call('get')
+        start, end = (int(''.join(ch for ch in part if ch.isdigit())) for part in range_name.split(':'))
+        with self.lock:
+            rows = [list(row) for row in self.rows[start - 1:end]]
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def batch_get(self, ranges, *args, **kwargs):
+        self._call('batch_get')
+        result = []
+        for range_name in ranges:
+            start, end = (int(''.join(ch for ch in part if ch.isdigit())) for part in range_name.split(':'))
+            with self.lock:
+                result.append([list(row) for row in self.rows[start - 1:end] if row])
+        return result
+
+    def update(self, range_name, values, *args, **kwargs):
+        """Запись прямоугольника значений, начиная с левой верхней ячейки диапазона"""
+        self._call('update')
+        start = range_name.split(':')[0]
+        col = ord(start[0]) - ord('A')
+        row_num = int(start[1:])
+        with self.lock:
+            for r, row_values in enumerate(values):
+                while len(self.rows) < row_num + r:
+                    self.rows.append([])
+                row = self.rows[row_num + r - 1]
+                row.extend([''] * (col + len(row_values) - len(row)))
+                row[col:col + len(row_values)] = map(str, row_values)
+
+    def append_row(self, values, *args, **kwargs):
+        self._call('append_row')
+        with self.lock:
+            self.rows.append(list(map(str, values)))
+
+    def append_rows(self, values, *args, **kwargs):
+        self._call('append_rows')
+        with self.lock:
+            self.rows.extend(list(map(str, row)) for row in values)
+
+    def delete_rows(self, start_index, end_index=None):
+        self._call('delete_rows')
+        end_index = end_index or start_index
+        with self.lock:
+            del self.rows[start_index - 1:end_index]
+
+
+def make_students(count):
+    rows = [STUDENTS_HEADER]
+    for i in range(count):
+        rows.append([bot.GROUP_NAME, f"Студент {i + 1:03d}", str(i % 2 + 1)])
+    return rows
+
+
+def make_attendance(students, row_count, end_date, seed=0):
+    """Генерирует журнал посещаемости из row_count строк за дни до end_date"""
+    rnd = random.Random(seed)
+    statuses = [info['text'] for info in bot.STATUSES.values()]
+    names = [row[1] for row in students[1:]]
+    rows = [ATTENDANCE_HEADER]
+    day = end_date
+    while len(rows) <= row_count:
+        for lesson in bot.schedule_manager.get_day_lessons(day):
+            for name in names:
+                if len(rows) > row_count:
+                    break
+                status = rnd.choices(statuses, weights=(80, 10, 7, 3))[0]
+                reason = 'Справка' if status == 'Уважительная причина' else '-'
+                rows.append([day.strftime("%d.%m.%Y"), lesson.number, bot.GROUP_NAME,
+                             name, status, reason, '10:00'])
+        day -= datetime.timedelta(days=1)
+    return rows
+
+
+# ==================== ЗАГЛУШКА TELEGRAM ====================
+class FakeResponse:
+    def __init__(self, payload, status_code=200, headers=None):
+        self.payload = payload
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = json.dumps(payload, ensure_ascii=False)
+
+    def json(self):
+        return self.payload
+
+
+class FakeTelegram:
+    """Подменяет отправку запросов telebot (apihelper.CUSTOM_REQUEST_SENDER).
+    Хранит сообщения с клавиатурами, чтобы сценарии нажимали настоящие кнопки"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.quota_errors = 0
+        self.messages = {}
+        self.message_ids = itertools.count(1)
+        self.lock = Lock()
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        method_name = url.rsplit('/', 1)[-1]
+        params = params or {}
+        with self.lock:
+            self.calls[method_name] = self.calls.get(method_name, 0) + 1
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.quota_errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            return FakeResponse({
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}
+            }, status_code=429)
+        return FakeResponse({'ok': True, 'result': self._handle(method_name, params)})
+
+    def _handle(self, method_name, params):
+        if method_name in ('sendMessage', 'sendDocument'):
+            chat_id = int(params['chat_id'])
+            with self.lock:
+                message_id = next(self.message_ids)
+                self.messages[(chat_id, message_id)] = self._stored(params)
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', '')
+            }
+        if method_name == 'editMessageText':
+            chat_id = int(params['chat_id'])
+            message_id = int(params['message_id'])
+            with self.lock:
+                self.messages[(chat_id, message_id)] = self._stored(params)
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', '')
+            }
+        return True
+
+    def _stored(self, params):
+        markup = params.get('reply_markup')
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        return {'text': params.get('text', ''), 'markup': markup or {}}
+
+    def find_button(self, chat_id, predicate):
+        """Ищет кнопку в последних сообщениях чата (сначала новые)"""
+        with self.lock:
+            chat_messages = sorted(
+                ((message_id, data) for (cid, message_id), data in self.messages.items() if cid == chat_id),
+                reverse=True
+            )
+        for message_id, data in chat_messages:
+            for row in data['markup'].get('inline_keyboard', []):
+                for button in row:
+                    if predicate(button['text']):
+                        return message_id, button['callback_data']
+        return None, None
+
+
+# ==================== КУРАТОР ====================
+class Curator:
+    """Имитирует действия пользователя в чате"""
+
+    update_ids = itertools.count(1)
+
+    def __init__(self, chat_id, telegram):
+        self.chat_id = chat_id
+        self.telegram = telegram
+        self.user = {'id': chat_id, 'is_bot': False, 'first_name': f'Куратор {chat_id}'}
+
+    def _message(self, text, message_id=0):
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': self.chat_id, 'type': 'private'},
+            'from': self.user,
+            'text': text
+        }
+
+    def send(self, text):
+        update = telebot.types.Update.de_json({
+            'update_id': next(self.update_ids),
+            'message': self._message(text)
+        })
+        bot.bot.process_new_updates([update])
+        bot.outbox.wait_idle()
+
+    def press(self, predicate):
+        """Нажимает первую кнопку, текст которой удовлетворяет predicate"""
+        message_id, data = self.telegram.find_button(self.chat_id, predicate)
+        if data is None:
+            return False
+        update = telebot.types.Update.de_json({
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.update_ids)),
+                'from': self.user,
+                'chat_instance': str(self.chat_id),
+                'data': data,
+                'message': self._message('', message_id)
+            }
+        })
+        bot.bot.process_new_updates([update])
+        # Кнопки следующего шага появятся, когда очередь отправит ответ бота
+        bot.outbox.wait_idle()
+        return True
+
+    def press_all(self, predicate, limit=None):
+        pressed = 0
+        while (limit is None or pressed < limit) and self.press(predicate):
+            pressed += 1
+        return pressed
+
+    def open_marking(self, date, lessons='all'):
+        """Дата -> пары -> экран отметки"""
+        self.send('/start')
+        self.send('📅 Выбор даты')
+        self.press(lambda text: 'Другая дата' in text)
+        self.send(date.strftime("%d.%m.%Y"))
+        self.send('🔢 Выбрать пары')
+        if lessons == 'all':
+            self.press(lambda text: text == '✅ Выбрать все')
+        else:
+            for lesson in lessons:
+                self.press(lambda text, n=lesson: text.startswith(f"{n} - "))
+        self.press(lambda text: text == '📌 Готово')
+        self.send('📝 Отметить')
+
+    def select_students(self, limit=None, only_unmarked=False):
+        """Отмечает галочками студентов, листая страницы"""
+        prefix = '◻️ ⬜' if only_unmarked else '◻️'
+        selected = self.press_all(lambda text: text.startswith(prefix), limit)
+        while (limit is None or selected < limit) and self.press(lambda text: text.startswith('Следующая')):
+            selected += self.press_all(lambda text: text.startswith(prefix),
+                                       None if limit is None else limit - selected)
+        return selected
+
+
+# ==================== ОКРУЖЕНИЕ ====================
+class ScaledTime:
+    """Подмена модуля time в bot.py: паузы бота масштабируются,
+    остальные функции берутся из настоящего модуля.
+    monotonic() - виртуальные часы: пропущенная часть паузы сдвигает их вперёд,
+    чтобы расчёты квоты видели паузу целиком"""
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.requested = 0.0
+        self.skipped = 0.0
+        self.lock = Lock()
+
+    def monotonic(self):
+        with self.lock:
+            return time.monotonic() + self.skipped
+
+    def sleep(self, seconds):
+        seconds = max(0.0, seconds)
+        wake_at = self.monotonic() + seconds
+        with self.lock:
+            self.requested += seconds
+        if self.scale:
+            time.sleep(seconds * self.scale)
+        with self.lock:
+            # Параллельные паузы не складываются: часы доходят до самого позднего пробуждения
+            self.skipped = max(self.skipped, wake_at - time.monotonic())
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class ErrorCounter:
+    def __init__(self):
+        self.errors = []
+
+    def handle(self, exception):
+        self.errors.append(repr(exception))
+        return True
+
+
+def find_lesson_day(min_lessons, before):
+    """Последний день до before, в котором не меньше min_lessons пар у всей группы"""
+    day = before
+    for _ in range(60):
+        if len(bot.schedule_manager.get_day_lessons(day)) >= min_lessons:
+            return day
+        day -= datetime.timedelta(days=1)
+    raise RuntimeError(f"В расписании нет дня с {min_lessons} парами")
+
+
+class Environment:
+    """Свежие заглушки и сброшенное состояние бота для одного сценария"""
+
+    def __init__(self, args, students=30, attendance_rows=0):
+        today = datetime.date.today()
+        self.students = make_students(students)
+        attendance = make_attendance(self.students, attendance_rows, today) if attendance_rows else [ATTENDANCE_HEADER]
+        self.attendance_sheet = FakeWorksheet('Посещаемость', attendance, args.sheets_latency, args.sheets_429, args.seed)
+        self.students_sheet = FakeWorksheet('Студенты', self.students, args.sheets_latency, args.sheets_429, args.seed + 1)
+        self.telegram = FakeTelegram(args.telegram_latency, args.telegram_429, args.seed + 2)
+        self.clock = ScaledTime(args.sleep_scale)
+        self.errors = ErrorCounter()
+
+        bot.attendance_sheet._worksheet = self.attendance_sheet
+        bot.students_sheet._worksheet = self.students_sheet
+        bot.cache = bot.ImprovedSheetsCache()
+        bot.id_header_checked = False
+        bot.applied_writes = bot.RecentKeys(bot.IDEMPOTENCY_KEYS_LIMIT)
+        bot.user_data.clear()
+        bot.metrics.__init__()
+        bot.time = self.clock
+        bot.sheets_quota = bot.SheetsQuota()
+        bot.deferred_writes = bot.DeferredWrites()
+        bot.deferred_writes.start()
+        bot.outbox = bot.Outbox()
+        bot.outbox.start()
+        bot.bot.threaded = False
+        bot.bot.exception_handler = self.errors
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = self.telegram
+
+    def curator(self, chat_id):
+        return Curator(chat_id, self.telegram)
+
+    def drain(self, timeout=60):
+        """Ждёт, пока фоновые потоки допишут отложенные записи и отправят сообщения"""
+        deadline = time.monotonic() + timeout
+        while bot.deferred_writes.pending() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        bot.outbox.wait_idle(max(0.0, deadline - time.monotonic()))
+
+    def result(self, name, wall, peak):
+        return {
+            'scenario': name,
+            'wall_s': round(wall, 3),
+            'bot_sleep_s': round(self.clock.requested, 3),
+            'peak_mem_kb': round(peak / 1024, 1),
+            'sheets_calls': dict(sorted(self._merge(self.attendance_sheet.calls, self.students_sheet.calls).items())),
+            'sheets_429': self.attendance_sheet.quota_errors + self.students_sheet.quota_errors,
+            'telegram_calls': dict(sorted(self.telegram.calls.items())),
+            'telegram_429': self.telegram.quota_errors,
+            'handler_errors': len(self.errors.errors),
+        }
+
+    @staticmethod
+    def _merge(a, b):
+        merged = dict(a)
+        for key, value in b.items():
+            merged[key] = merged.get(key, 0) + value
+        return merged
+
+
+# ==================== СЦЕНАРИИ ====================
+def scenario_mark_group(env):
+    """Отметить всю группу на 3 парах: сначала двух отсутствующих, потом всех остальных одной записью"""
+    day = find_lesson_day(3, datetime.date.today())
+    curator = env.curator(1001)
+    curator.open_marking(day)
+    curator.select_students(limit=2)
+    curator.press(lambda text: text == '❌ Отсутствовал')
+    curator.press(lambda text: text == '✅ Остальные присутствовали')
+    curator.press(lambda text: 'СОХРАНИТЬ' in text)
+
+
+def scenario_sick_leave(env):
+    """Больничный на 2 недели для одного студента"""
+    end = datetime.date.today()
+    start = end - datetime.timedelta(days=13)
+    curator = env.curator(2001)
+    curator.open_marking(find_lesson_day(1, end))
+    curator.select_students(limit=1)
+    curator.press(lambda text: 'Больничный на период' in text)
+    curator.send(f"{start.strftime('%d.%m.%Y')}-{end.strftime('%d.%m.%Y')}")
+
+
+def scenario_report_10k(env):
+    """Месячный отчёт по листу из 10 000 строк"""
+    curator = env.curator(3001)
+    curator.send('📤 Отчёт')
+    curator.send('текущий')
+
+
+def scenario_subjects_semester(env):
+    """Отчёт по предметам за полгода по листу из 10 000 строк"""
+    end = datetime.date.today()
+    start = end - datetime.timedelta(days=180)
+    curator = env.curator(5001)
+    curator.send('/subjects')
+    curator.send(f"{start.strftime('%d.%m.%Y')}-{end.strftime('%d.%m.%Y')}")
+
+
+def scenario_export_10k(env):
+    """Потоковая выгрузка журнала из 10 000 строк в CSV.gz"""
+    curator = env.curator(6001)
+    curator.send('/export csv')
+
+
+def scenario_concurrent(env):
+    """20 кураторов одновременно отмечают по 3 студента на одной паре"""
+    day = find_lesson_day(1, datetime.date.today())
+    lesson = bot.schedule_manager.get_day_lessons(day)[0].number
+
+    def run(chat_id):
+        curator = env.curator(chat_id)
+        curator.open_marking(day, lessons=[lesson])
+        curator.select_students(limit=3)
+        curator.press(lambda text: text == '❌ Отсутствовал')
+
+    threads = [Thread(target=run, args=(4001 + i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+SCENARIOS = {
+    'mark_group': (scenario_mark_group, {'students': 30}),
+    'sick_leave': (scenario_sick_leave, {'students': 30, 'attendance_rows': 2000}),
+    'report_10k': (scenario_report_10k, {'students': 30, 'attendance_rows': 10000}),
+    'subjects_semester': (scenario_subjects_semester, {'students': 30, 'attendance_rows': 10000}),
+    'export_10k': (scenario_export_10k, {'students': 30, 'attendance_rows': 10000}),
+    'concurrent': (scenario_concurrent, {'students': 30, 'attendance_rows': 2000}),
+}
+
+
+def run_scenario(name, args):
+    func, params = SCENARIOS[name]
+    env = Environment(args, **params)
+    tracemalloc.start()
+    started = time.perf_counter()
+    func(env)
+    env.drain()
+    wall = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return env.result(name, wall, peak)
+
+
+def print_result(result):
+    print(f"\n📊 {result['scenario']}")
+    print(f"   ⏱  {result['wall_s']} сек (паузы бота: {result['bot_sleep_s']} сек)")
+    print(f"   💾 пик памяти: {result['peak_mem_kb']} КБ")
+    print(f"   📗 Sheets: {sum(result['sheets_calls'].values())} вызовов {result['sheets_calls']}, 429: {result['sheets_429']}")
+    print(f"   ✈️  Telegram: {sum(result['telegram_calls'].values())} вызовов {result['telegram_calls']}, 429: {result['telegram_429']}")
+    if result['handler_errors']:
+        print(f"   ❌ Ошибок в обработчиках: {result['handler_errors']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота посещаемости")
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help=f"сценарии для запуска: {', '.join(SCENARIOS)} (по умолчанию все)")
+    parser.add_argument('--sheets-latency', type=float, default=0.0, help="задержка вызова Sheets, сек")
+    parser.add_argument('--sheets-429', type=float, default=0.0, help="доля вызовов Sheets с ответом 429")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help="задержка вызова Telegram, сек")
+    parser.add_argument('--telegram-429', type=float, default=0.0, help="доля вызовов Telegram с ответом 429")
+    parser.add_argument('--sleep-scale', type=float, default=1.0, help="множитель для пауз внутри бота")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="вывести результаты одной JSON-строкой")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+
+    # Логи бота не мешают выводу результатов
+    real_stdout = sys.stdout
+    results = []
+    for name in args.scenarios or list(SCENARIOS):
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            results.append(run_scenario(name, args))
+        finally:
+            sys.stdout.close()
+            sys.stdout = real_stdout
+        if not args.json:
+            print_result(results[-1])
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,102 +2,506 @@ import requests
 import telebot
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession, Request
 import datetime
-import pandas as pd
 from io import BytesIO
 import os
-import openpyxl
-from openpyxl.utils import get_column_letter
-from openpyxl.styles import PatternFill, Font, Alignment
 import time
-from threading import Lock
+import json
+import zlib
+import uuid
+import random
+import email.utils
+import functools
+from threading import Condition, Event, Lock, Thread, local
+from queue import Queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import csv
+import bisect
+from collections import deque, namedtuple, OrderedDict
+from types import MappingProxyType
+import gzip
+import tempfile
+import signal
 
 # ==================== НАСТРОЙКИ ====================
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 SPREADSHEET_NAME = "Посещаемость студентов"
+# ID таблицы из URL - открытие по ключу не требует поиска по Drive
+SPREADSHEET_KEY = os.environ.get('SPREADSHEET_KEY')
 GOOGLE_KEY_FILE = os.path.join(os.path.dirname(__file__), "google_key.json")
 GROUP_NAME = "4231133"
 
 # Типы неуважительных пропусков (только они считаются прогулами)
 UNRESPECTFUL_STATUSES = ['Отсутствовал']  # ❌
 
+# Пороги прогулов, при достижении которых куратор получает уведомление
+ABSENCE_ALERT_MONTH_THRESHOLDS = (5, 10)      # за месяц
+ABSENCE_ALERT_SUBJECT_THRESHOLDS = (3, 6)     # по одному предмету за учебный год
+# Чаты кураторов через запятую; остальные могут подписаться командой /alerts
+CURATOR_CHAT_IDS = [int(x) for x in os.environ.get('CURATOR_CHAT_IDS', '').split(',') if x.strip()]
+SUBSCRIPTIONS_FILE = os.path.join(os.path.dirname(__file__), 'subscriptions.json')
+# Незавершённая при остановке работа (отложенные записи, неотправленные сообщения).
+# На Railway стоит указать путь на подключённом томе, иначе файл не переживёт деплой
+PENDING_WORK_FILE = os.environ.get('PENDING_WORK_FILE', os.path.join(os.path.dirname(__file__), 'pending_work.json'))
+# Сколько секунд после SIGTERM есть на то, чтобы дописать очереди (дальше - сохранение на диск)
+SHUTDOWN_DEADLINE = int(os.environ.get('SHUTDOWN_DEADLINE', 20))
+# Сколько секунд ждать getUpdates: столько может занять выход из polling при остановке
+POLLING_TIMEOUT = 10
+
+# Во сколько часов ночи 1-го числа строить и рассылать отчёт за прошедший месяц
+REPORT_DELIVERY_HOUR = 3
+# Сколько секунд хранится отчёт за текущий (незакрытый) месяц
+REPORT_CACHE_TTL = 10 * 60
+# Сколько секунд хранится отчёт за закрытый месяц (правки прямо в таблице видны после него)
+REPORT_CACHE_CLOSED_TTL = 60 * 60
+# Последний разосланный автоотчёт: после перезапуска пропущенная рассылка догоняется
+REPORT_STATE_FILE = os.environ.get('REPORT_STATE_FILE', os.path.join(os.path.dirname(__file__), 'report_state.json'))
+
+# Как часто проверять, изменился ли файл расписания, сек
+SCHEDULE_CHECK_INTERVAL = 10
+
+# Сколько пар (дата, подгруппа) держать в кэше get_day_lessons
+DAY_LESSONS_CACHE_SIZE = 1024
+
+# Начала семестров (ДД.ММ.ГГГГ через запятую). Недели считаются от ближайшего
+# прошедшего начала; если его нет - от 1 сентября учебного года
+SEMESTER_STARTS = [
+    datetime.datetime.strptime(x.strip(), "%d.%m.%Y").date()
+    for x in os.environ.get('SEMESTER_STARTS', '').split(',') if x.strip()
+]
+# Тип первой недели семестра: верхняя (odd) или нижняя (even)
+FIRST_WEEK_TYPE = os.environ.get('FIRST_WEEK_TYPE', 'odd')
+
 # Количество студентов на одной странице
 ITEMS_PER_PAGE = 10
+
+# Предел Telegram для подписи к документу
+CAPTION_MAX_LENGTH = 1024
+
+# Сколько пар показывать столбцами в сетке долгов (/backlog)
+BACKLOG_PAIRS_PER_PAGE = 4
+# Сколько неотмеченных пар открывается в сетке за раз (остальные - после сохранения)
+BACKLOG_MAX_PAIRS = 40
+
+# Ограничения кэша отметок: число пар и примерный объём в байтах
+ATTENDANCE_CACHE_MAX_ENTRIES = 512
+ATTENDANCE_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# Количество потоков-обработчиков бота (под него подбирается пул HTTP-соединений)
+HANDLER_THREADS = 10
+
+# Лимиты Telegram: сообщений в секунду в один чат (и сколько можно подряд) и на весь бот
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_GLOBAL_RATE = 30
+# Потоки, отправляющие исходящие сообщения, и число попыток при 429
+TELEGRAM_SENDERS = 4
+TELEGRAM_SEND_ATTEMPTS = 3
+
+# За сколько секунд до истечения заранее обновлять токен Google
+TOKEN_REFRESH_MARGIN = 300
+
+# За сколько минут до начала пары подгружать студентов и отметки на сегодня
+PREFETCH_LEAD_MINUTES = 10
+# Сколько секунд живут подгруженные заранее отметки в кэше (студенты - обычный срок)
+PREFETCH_TTL = 30 * 60
+
+# Сколько строк читать из таблицы за один запрос при выгрузке журнала
+EXPORT_CHUNK_ROWS = 5000
+# Столбец с ID строки журнала (версия строки для проверки перед удалением)
+ATTENDANCE_ID_COLUMN = 'H'
+# Последний столбец листа посещаемости
+ATTENDANCE_LAST_COLUMN = ATTENDANCE_ID_COLUMN
+# Сколько раз заново искать строки, если лист изменился между чтением и удалением
+WRITE_CONFLICT_RETRIES = 3
+# На сколько строк вокруг прежнего места искать сдвинутую строку без ID
+WRITE_CONFLICT_WINDOW = 200
+# Квота Google Sheets: сколько запросов можно сделать подряд и средний интервал между ними, сек
+SHEETS_BURST = 10
+SHEETS_MIN_INTERVAL = 1.1
+# Потолок паузы после 429, если Google не прислал Retry-After, сек
+QUOTA_MAX_BACKOFF = 30
+# Сколько обработчик готов ждать квоту; дольше - чтение отказывает сразу, запись откладывается
+QUOTA_HANDLER_MAX_WAIT = 10
+# Сколько раз повторять отложенную запись при ошибках, кроме квоты, и пауза между попытками, сек.
+# Пока квота закрыта, запись просто ждёт и попытки не тратит
+DEFERRED_WRITE_ATTEMPTS = 5
+DEFERRED_RETRY_DELAY = 30
+# Сколько ключей уже применённых записей помнить (повторы обновлений от Telegram)
+IDEMPOTENCY_KEYS_LIMIT = 10000
+# Окно, сек, в котором одинаковое нажатие той же кнопки считается двойным
+IDEMPOTENCY_TAP_WINDOW = 3
+
+# Как часто писать метрики в лог (JSON), сек
+METRICS_LOG_INTERVAL = 300
+# Порт для метрик в формате Prometheus (если не задан - только лог)
+METRICS_PORT = int(os.environ['METRICS_PORT']) if os.environ.get('METRICS_PORT') else None
 # ===================================================
 
 # ==================== КЛАСС ДЛЯ РАБОТЫ С РАСПИСАНИЕМ ====================
-class ScheduleManager:
-    """Класс для работы с расписанием из CSV-файла"""
+SCHEDULE_COLUMNS = ('day', 'week_type', 'lesson', 'subgroup', 'subject')
+EXCEPTION_COLUMNS = ('date', 'end_date', 'action', 'lesson', 'subgroup', 'subject', 'source_date')
+EXCEPTION_ACTIONS = ('holiday', 'cancel', 'swap', 'extra')
+SCHEDULE_DAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+ScheduleItem = namedtuple('ScheduleItem', ['subgroup', 'subject'])
+Lesson = namedtuple('Lesson', ['number', 'subject', 'for_subgroup'])
+
+class ScheduleError(Exception):
+    """Ошибки в файле расписания (по одной строке на ошибку)"""
+
+def academic_year(date):
+    """Учебный год начинается 1 сентября"""
+    return date.year if date.month >= 9 else date.year - 1
+
+class WeekCalendar:
+    """Тип недели (верхняя/нижняя) от начала семестра.
+    Таблица дата -> тип недели строится сразу на весь учебный год при первом обращении"""
+    
+    def __init__(self, semester_starts=(), first_week_type='odd'):
+        self.semester_starts = sorted(semester_starts)
+        self.first_week_type = first_week_type
+        self.second_week_type = 'even' if first_week_type == 'odd' else 'odd'
+        self.table = {}
+        self.lock = Lock()
     
-    def __init__(self, filename='schedule.csv'):
-        self.schedule = {}
+    def semester_start(self, date):
+        """Ближайшее начало семестра не позже date"""
+        i = bisect.bisect_right(self.semester_starts, date) - 1
+        if i >= 0 and academic_year(self.semester_starts[i]) == academic_year(date):
+            return self.semester_starts[i]
+        return datetime.date(academic_year(date), 9, 1)
+    
+    def _build_year(self, year):
+        day = datetime.date(year, 9, 1)
+        end = datetime.date(year + 1, 9, 1)
+        table = {}
+        start = None
+        while day < end:
+            # Семестр может начаться посреди недели - начало проверяется каждый день
+            day_start = self.semester_start(day)
+            if day_start != start:
+                start = day_start
+                start_monday = start - datetime.timedelta(days=start.weekday())
+            weeks = (day - start_monday).days // 7
+            table[day] = self.first_week_type if weeks % 2 == 0 else self.second_week_type
+            day += datetime.timedelta(days=1)
+        return table
+    
+    def week_type(self, date):
+        week_type = self.table.get(date)
+        if week_type is None:
+            with self.lock:
+                if date not in self.table:
+                    self.table = {**self.table, **self._build_year(academic_year(date))}
+            week_type = self.table[date]
+        return week_type
+
+CancelRule = namedtuple('CancelRule', ['lesson', 'subgroup'])
+
+class ScheduleExceptions:
+    """Предрассчитанные исключения из расписания (schedule_exceptions.csv):
+    - holiday: с date по end_date пар нет;
+    - cancel: отмена пары lesson (или всех пар) для подгруппы, можно на период;
+    - swap: в день date занятия идут по расписанию дня source_date;
+    - extra: дополнительная пара lesson с предметом subject.
+    Отмены хранятся как интервальный индекс: непересекающиеся отрезки с набором
+    действующих правил, поиск отрезка - бинарный. Переносы и доп. пары - словари по дате"""
+    
+    def __init__(self, cancels=(), swaps=None, extras=None):
+        """cancels - кортежи (начало, конец включительно, CancelRule)"""
+        self.swaps = MappingProxyType(dict(swaps or {}))
+        self.extras = MappingProxyType({date: tuple(items) for date, items in (extras or {}).items()})
+        
+        # Границы отрезков: начала интервалов и дни после их концов
+        bounds = sorted({start for start, end, rule in cancels} |
+                        {end + datetime.timedelta(days=1) for start, end, rule in cancels})
+        self.starts = []
+        self.rules = []
+        for bound in bounds:
+            active = tuple(rule for start, end, rule in cancels if start <= bound <= end)
+            if self.rules and self.rules[-1] == active:
+                continue
+            self.starts.append(bound)
+            self.rules.append(active)
+    
+    def cancel_rules(self, date):
+        """Правила отмены, действующие в этот день"""
+        i = bisect.bisect_right(self.starts, date) - 1
+        return self.rules[i] if i >= 0 else ()
+    
+    def source_date(self, date):
+        """День, по расписанию которого идут занятия"""
+        return self.swaps.get(date, date)
+    
+    def apply(self, date, subgroup, lessons):
+        """Применяет исключения к парам дня (список Lesson)"""
+        rules = self.cancel_rules(date)
+        if rules:
+            lessons = [
+                lesson for lesson in lessons
+                if not any((rule.lesson is None or rule.lesson == lesson.number) and
+                           (rule.subgroup == 'all' or rule.subgroup == subgroup)
+                           for rule in rules)
+            ]
+        extras = self.extras.get(date)
+        if extras:
+            for lesson_num, item in extras:
+                if item.subgroup == 'all' or item.subgroup == subgroup:
+                    lessons = [lesson for lesson in lessons if lesson.number != lesson_num]
+                    lessons.append(Lesson(lesson_num, item.subject, item.subgroup))
+        return lessons
+
+class ScheduleManager:
+    """Класс для работы с расписанием из CSV-файла.
+    Расписание неизменяемое: при перезагрузке собирается новое и подменяется целиком"""
+    
+    def __init__(self, filename='schedule.csv', exceptions_filename='schedule_exceptions.csv'):
+        self.schedule = MappingProxyType({})
+        self.exceptions = ScheduleExceptions()
+        self.week_calendar = WeekCalendar(SEMESTER_STARTS, FIRST_WEEK_TYPE)
+        self._day_lessons = self._make_day_lessons(self.schedule, self.exceptions)
         self.filename = filename
+        self.exceptions_filename = exceptions_filename
+        self.mtime = None
+        self.listeners = []
+        self.reload_lock = Lock()
         self.load_schedule()
     
+    def parse_schedule(self):
+        """Читает и проверяет файл. Возвращает (расписание, список ошибок)"""
+        schedule = {}
+        errors = []
+        seen = {}
+        with open(self.filename, 'r', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            missing = [column for column in SCHEDULE_COLUMNS if column not in (reader.fieldnames or [])]
+            if missing:
+                return MappingProxyType({}), [f"нет столбцов: {', '.join(missing)}"]
+            
+            for line_num, row in enumerate(reader, start=2):
+                day = (row['day'] or '').strip()
+                week_type = (row['week_type'] or '').strip()
+                subgroup = (row['subgroup'] or '').strip()
+                subject = (row['subject'] or '').strip()
+                
+                row_errors = []
+                if day not in SCHEDULE_DAYS:
+                    row_errors.append(f"день '{day}' (ожидается Monday..Sunday)")
+                if week_type not in ('odd', 'even'):
+                    row_errors.append(f"тип недели '{week_type}' (ожидается odd/even)")
+                try:
+                    lesson = int(row['lesson'])
+                    if not 1 <= lesson <= 99:
+                        row_errors.append(f"номер пары {lesson} (ожидается 1..99)")
+                except (TypeError, ValueError):
+                    row_errors.append(f"номер пары '{row['lesson']}'")
+                if subgroup not in ('all', '1', '2'):
+                    row_errors.append(f"подгруппа '{subgroup}' (ожидается all/1/2)")
+                if not subject:
+                    row_errors.append("пустое название предмета")
+                if row_errors:
+                    errors.append(f"строка {line_num}: {'; '.join(row_errors)}")
+                    continue
+                
+                key = (day, week_type, lesson, subgroup)
+                if key in seen:
+                    errors.append(f"строка {line_num}: дублирует строку {seen[key]}")
+                    continue
+                seen[key] = line_num
+                
+                schedule.setdefault(day, {'odd': {}, 'even': {}})
+                schedule[day][week_type].setdefault(lesson, []).append(ScheduleItem(subgroup, subject))
+        
+        frozen = MappingProxyType({
+            day: MappingProxyType({
+                week_type: MappingProxyType({lesson: tuple(items) for lesson, items in lessons.items()})
+                for week_type, lessons in weeks.items()
+            })
+            for day, weeks in schedule.items()
+        })
+        return frozen, errors
+    
+    def parse_exceptions(self):
+        """Читает и проверяет файл исключений (его может не быть).
+        Возвращает (ScheduleExceptions, список ошибок)"""
+        if not os.path.exists(self.exceptions_filename):
+            return ScheduleExceptions(), []
+        
+        def parse_date(value):
+            return datetime.datetime.strptime(value, "%d.%m.%Y").date()
+        
+        cancels = []
+        swaps = {}
+        extras = {}
+        errors = []
+        with open(self.exceptions_filename, 'r', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            missing = [column for column in EXCEPTION_COLUMNS if column not in (reader.fieldnames or [])]
+            if missing:
+                return ScheduleExceptions(), [f"исключения: нет столбцов: {', '.join(missing)}"]
+            
+            for line_num, row in enumerate(reader, start=2):
+                row = {key: (value or '').strip() for key, value in row.items() if key}
+                action = row['action']
+                subgroup = row['subgroup'] or 'all'
+                
+                row_errors = []
+                try:
+                    date = parse_date(row['date'])
+                    end_date = parse_date(row['end_date']) if row['end_date'] else date
+                    if end_date < date:
+                        row_errors.append("end_date раньше date")
+                except ValueError:
+                    row_errors.append(f"дата '{row['date']}' / '{row['end_date']}' (ожидается ДД.ММ.ГГГГ)")
+                lesson = None
+                if row['lesson']:
+                    try:
+                        lesson = int(row['lesson'])
+                        if not 1 <= lesson <= 99:
+                            row_errors.append(f"номер пары {lesson} (ожидается 1..99)")
+                    except ValueError:
+                        row_errors.append(f"номер пары '{row['lesson']}'")
+                if action not in EXCEPTION_ACTIONS:
+                    row_errors.append(f"действие '{action}' (ожидается {'/'.join(EXCEPTION_ACTIONS)})")
+                if subgroup not in ('all', '1', '2'):
+                    row_errors.append(f"подгруппа '{subgroup}' (ожидается all/1/2)")
+                if action == 'extra' and (lesson is None or not row['subject']):
+                    row_errors.append("для extra нужны lesson и subject")
+                if action == 'swap':
+                    try:
+                        source_date = parse_date(row['source_date'])
+                    except ValueError:
+                        row_errors.append(f"source_date '{row['source_date']}' (ожидается ДД.ММ.ГГГГ)")
+                if row_errors:
+                    errors.append(f"исключения, строка {line_num}: {'; '.join(row_errors)}")
+                    continue
+                
+                if action == 'holiday':
+                    cancels.append((date, end_date, CancelRule(None, 'all')))
+                elif action == 'cancel':
+                    cancels.append((date, end_date, CancelRule(lesson, subgroup)))
+                elif action == 'swap':
+                    if date in swaps:
+                        errors.append(f"исключения, строка {line_num}: второй перенос на {row['date']}")
+                        continue
+                    swaps[date] = source_date
+                else:
+                    extras.setdefault(date, []).append((lesson, ScheduleItem(subgroup, row['subject'])))
+        
+        return ScheduleExceptions(cancels, swaps, extras), errors
+    
+    def _mtimes(self):
+        exceptions_mtime = None
+        if os.path.exists(self.exceptions_filename):
+            exceptions_mtime = os.path.getmtime(self.exceptions_filename)
+        return os.path.getmtime(self.filename), exceptions_mtime
+    
     def load_schedule(self):
-        """Загружает расписание из CSV-файла"""
+        """Загружает расписание из CSV-файла при старте.
+        Если в файле есть ошибки, используются корректные строки, а ошибки выводятся в лог"""
         try:
-            with open(self.filename, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    day = row['day']
-                    week_type = row['week_type']
-                    lesson = int(row['lesson'])
-                    subgroup = row['subgroup']
-                    subject = row['subject']
-                    
-                    if day not in self.schedule:
-                        self.schedule[day] = {'odd': {}, 'even': {}}
-                    
-                    if lesson not in self.schedule[day][week_type]:
-                        self.schedule[day][week_type][lesson] = []
-                    
-                    self.schedule[day][week_type][lesson].append({
-                        'subgroup': subgroup,
-                        'subject': subject
-                    })
+            self.mtime = self._mtimes()
+            schedule, errors = self.parse_schedule()
+            exceptions, exception_errors = self.parse_exceptions()
+            for error in errors + exception_errors:
+                print(f"❌ Расписание, {error}")
+            self.schedule = schedule
+            self.exceptions = exceptions
+            self._day_lessons = self._make_day_lessons(schedule, exceptions)
             print(f"✅ Расписание загружено из {self.filename}")
         except FileNotFoundError:
             print(f"❌ Файл {self.filename} не найден")
             print("⚠️ Бот будет работать без расписания")
-            self.schedule = {}
+            self.schedule = MappingProxyType({})
         except Exception as e:
             print(f"❌ Ошибка загрузки расписания: {e}")
-            self.schedule = {}
+            self.schedule = MappingProxyType({})
+    
+    def reload(self):
+        """Перезагружает расписание. При любой ошибке остаётся прежнее (ScheduleError)"""
+        with self.reload_lock:
+            mtime = self._mtimes()
+            schedule, errors = self.parse_schedule()
+            exceptions, exception_errors = self.parse_exceptions()
+            if errors or exception_errors:
+                self.mtime = mtime
+                raise ScheduleError("\n".join(errors + exception_errors))
+            self.exceptions = exceptions
+            self.schedule = schedule
+            # Новый кэш вместе с новым расписанием: одно присваивание, без устаревших записей
+            self._day_lessons = self._make_day_lessons(schedule, exceptions)
+            self.mtime = mtime
+        print(f"🔄 Расписание перезагружено из {self.filename}")
+        for callback in self.listeners:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ Ошибка пересчёта после перезагрузки расписания: {e}")
+    
+    def reload_if_changed(self):
+        """Дешёвая проверка mtime; перезагрузка только если файл изменился"""
+        try:
+            mtime = self._mtimes()
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        try:
+            self.reload()
+            return True
+        except ScheduleError as e:
+            print(f"❌ Новое расписание не принято, работает прежнее:\n{e}")
+        except Exception as e:
+            print(f"❌ Ошибка перезагрузки расписания, работает прежнее: {e}")
+        return False
+    
+    def on_reload(self, callback):
+        """Регистрирует пересчёт производных данных после перезагрузки"""
+        self.listeners.append(callback)
+    
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            self.reload_if_changed()
+    
+    def start_watching(self, interval=SCHEDULE_CHECK_INTERVAL):
+        Thread(target=self._watch, args=(interval,), name='schedule-watcher', daemon=True).start()
     
     def get_week_type(self, date):
         """
-        Определяет тип недели:
-        - нижняя неделя (even) = нечётные недели (1, 3, 5, ...)
-        - верхняя неделя (odd) = чётные недели (2, 4, 6, ...)
+        Определяет тип недели по номеру недели от начала семестра:
+        - первая неделя семестра = FIRST_WEEK_TYPE (по умолчанию верхняя, odd)
+        - дальше типы чередуются, в том числе через Новый год
         """
-        week_num = date.isocalendar()[1]
-        
-        if week_num % 2 == 1:  # нечётные недели
-            return 'even'  # нижняя
-        else:               # чётные недели
-            return 'odd'   # верхняя
+        return self.week_calendar.week_type(date)
+    
+    def _make_day_lessons(self, schedule, exceptions):
+        """LRU-кэш пар дня, привязанный к конкретной версии расписания"""
+        @functools.lru_cache(maxsize=DAY_LESSONS_CACHE_SIZE)
+        def day_lessons(date, subgroup):
+            source_date = exceptions.source_date(date)
+            day_name = source_date.strftime('%A')  # Monday, Tuesday, etc.
+            week_type = self.get_week_type(source_date)
+            
+            lessons = []
+            if day_name in schedule and week_type in schedule[day_name]:
+                for lesson_num, lesson_data in schedule[day_name][week_type].items():
+                    for item in lesson_data:
+                        if item.subgroup == 'all' or item.subgroup == subgroup:
+                            lessons.append(Lesson(lesson_num, item.subject, item.subgroup))
+                            break
+            lessons = exceptions.apply(date, subgroup, lessons)
+            return tuple(sorted(lessons, key=lambda x: x.number))
+        return day_lessons
     
     def get_day_lessons(self, date, subgroup='all'):
-        """Получает список пар на указанную дату для подгруппы"""
-        day_name = date.strftime('%A')  # Monday, Tuesday, etc.
-        week_type = self.get_week_type(date)
-        
-        lessons = []
-        if day_name in self.schedule and week_type in self.schedule[day_name]:
-            for lesson_num, lesson_data in self.schedule[day_name][week_type].items():
-                for item in lesson_data:
-                    if item['subgroup'] == 'all' or item['subgroup'] == subgroup:
-                        lessons.append({
-                            'number': lesson_num,
-                            'subject': item['subject'],
-                            'for_subgroup': item['subgroup']
-                        })
-                        break
-        return sorted(lessons, key=lambda x: x['number'])
+        """Получает пары на указанную дату для подгруппы (с учётом праздников и переносов).
+        Результат - неизменяемый кортеж Lesson из кэша, повторный вызов ничего не создаёт"""
+        return self._day_lessons(date, subgroup)
     
     def get_all_lessons_in_month(self, year, month, subgroup='all'):
         """Получает все пары в указанном месяце"""
@@ -115,8 +519,8 @@ class ScheduleManager:
             for lesson in lessons:
                 all_lessons.append({
                     'date': current_date,
-                    'lesson': lesson['number'],
-                    'subject': lesson['subject']
+                    'lesson': lesson.number,
+                    'subject': lesson.subject
                 })
             current_date += datetime.timedelta(days=1)
         
@@ -132,13 +536,43 @@ class ScheduleManager:
             for lesson in day_lessons:
                 lessons.append({
                     'date': current_date,
-                    'lesson': lesson['number'],
-                    'subject': lesson['subject']
+                    'lesson': lesson.number,
+                    'subject': lesson.subject
                 })
             current_date += datetime.timedelta(days=1)
         
         return lessons
     
+    def get_calendar_entries(self, start_date, end_date):
+        """Все пары в диапазоне дат для каждой подгруппы (для соединения с отметками)"""
+        entries = []
+        current_date = start_date
+        
+        while current_date <= end_date:
+            week_type = self.get_week_type(self.exceptions.source_date(current_date))
+            for subgroup in ('all', '1', '2'):
+                for lesson in self.get_day_lessons(current_date, subgroup):
+                    entries.append({
+                        'date': current_date,
+                        'lesson': lesson.number,
+                        'subgroup': subgroup,
+                        'subject': lesson.subject,
+                        'week_type': week_type
+                    })
+            current_date += datetime.timedelta(days=1)
+        
+        return entries
+    
+    def get_subject(self, date, lesson_num, subgroup='all'):
+        """Название пары по дате и номеру для подгруппы студента.
+        Сначала пары самой подгруппы, затем общие, затем первое совпадение среди остальных"""
+        order = [subgroup] + [other for other in ('all', '1', '2') if other != subgroup]
+        for subgroup in order:
+            for lesson in self.get_day_lessons(date, subgroup):
+                if lesson.number == lesson_num:
+                    return lesson.subject
+        return None
+    
     def get_next_unmarked_lesson(self, year, month, marked_lessons, subgroup='all'):
         """Находит следующую неотмеченную пару в указанном месяце"""
         all_lessons = self.get_all_lessons_in_month(year, month, subgroup)
@@ -162,6 +596,165 @@ class ScheduleManager:
         return None
 # ====================================================
 
+# ==================== МЕТРИКИ ====================
+# Границы корзин гистограмм задержек, сек
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    """Счётчики и гистограммы задержек: обработчики, Google Sheets, Telegram, кэш"""
+    
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+    
+    def inc(self, name, label='', value=1):
+        with self.lock:
+            key = (name, label)
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def set_gauge(self, name, label, value):
+        with self.lock:
+            self.gauges[(name, label)] = value
+    
+    def observe(self, name, label, seconds):
+        with self.lock:
+            key = (name, label)
+            if key not in self.histograms:
+                self.histograms[key] = {
+                    'buckets': [0] * len(LATENCY_BUCKETS),
+                    'sum': 0.0,
+                    'count': 0
+                }
+            hist = self.histograms[key]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist['buckets'][i] += 1
+            hist['sum'] += seconds
+            hist['count'] += 1
+    
+    def snapshot(self):
+        """Текущие значения в виде словаря (для JSON-лога)"""
+        with self.lock:
+            counters = {f"{name}{{{label}}}": value for (name, label), value in self.counters.items()}
+            gauges = {f"{name}{{{label}}}": value for (name, label), value in self.gauges.items()}
+            latency = {}
+            for (name, label), hist in self.histograms.items():
+                latency[f"{name}{{{label}}}"] = {
+                    'count': hist['count'],
+                    'avg_ms': round(hist['sum'] / hist['count'] * 1000, 1),
+                    'buckets': dict(zip(map(str, LATENCY_BUCKETS), hist['buckets']))
+                }
+            cache_ratio = {}
+            for (name, label), hits in self.counters.items():
+                if name == 'cache_hits':
+                    misses = self.counters.get(('cache_misses', label), 0)
+                    cache_ratio[label] = round(hits / (hits + misses), 3)
+        return {'counters': counters, 'gauges': gauges, 'latency': latency, 'cache_hit_ratio': cache_ratio}
+    
+    def render_prometheus(self):
+        """Текущие значения в текстовом формате Prometheus"""
+        lines = []
+        with self.lock:
+            for (name, label), value in sorted(self.counters.items()):
+                lines.append(f'attendance_bot_{name}_total{{name="{label}"}} {value}')
+            for (name, label), value in sorted(self.gauges.items()):
+                lines.append(f'attendance_bot_{name}{{name="{label}"}} {value}')
+            for (name, label), hist in sorted(self.histograms.items()):
+                for bound, count in zip(LATENCY_BUCKETS, hist['buckets']):
+                    lines.append(f'attendance_bot_{name}_bucket{{name="{label}",le="{bound}"}} {count}')
+                lines.append(f'attendance_bot_{name}_bucket{{name="{label}",le="+Inf"}} {hist["count"]}')
+                lines.append(f'attendance_bot_{name}_sum{{name="{label}"}} {hist["sum"]:.6f}')
+                lines.append(f'attendance_bot_{name}_count{{name="{label}"}} {hist["count"]}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def instrumented(func):
+    """Декоратор для обработчиков: время выполнения и число ошибок"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            metrics.inc('handler_errors', func.__name__)
+            raise
+        finally:
+            metrics.observe('handler_seconds', func.__name__, time.perf_counter() - started)
+    return wrapper
+
+# Методы gspread, которые только читают данные
+SHEETS_READ_PREFIXES = ('get', 'row_values', 'col_values', 'find', 'acell', 'cell', 'range')
+
+def instrument_sheets_call(func, method_name):
+    """Оборачивает вызов gspread: число чтений/записей и время ответа"""
+    kind = 'sheets_reads' if method_name.startswith(SHEETS_READ_PREFIXES) else 'sheets_writes'
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        metrics.inc(kind, method_name)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.observe('sheets_seconds', method_name, time.perf_counter() - started)
+    return wrapper
+
+def track_http_response(response, *args, **kwargs):
+    """Хук requests: считает вызовы Telegram API и запросы токена Google"""
+    host = response.request.url.split('/')[2] if response.request.url else ''
+    if host == 'api.telegram.org':
+        method_name = response.request.url.split('?')[0].rsplit('/', 1)[-1]
+        metrics.inc('telegram_calls', method_name)
+        metrics.observe('telegram_seconds', method_name, response.elapsed.total_seconds())
+        if response.status_code == 429:
+            metrics.inc('quota_errors', 'telegram')
+    else:
+        metrics.inc('google_auth_calls', host)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """HTTP-эндпоинт /metrics для Prometheus"""
+    
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+class MetricsReporter:
+    """Периодически пишет метрики в лог одной JSON-строкой и,
+    если задан METRICS_PORT, отдаёт их в формате Prometheus"""
+    
+    def __init__(self, interval=METRICS_LOG_INTERVAL, port=METRICS_PORT):
+        self.interval = interval
+        self.port = port
+    
+    def _log_loop(self):
+        while True:
+            time.sleep(self.interval)
+            print(json.dumps({'metrics': metrics.snapshot()}, ensure_ascii=False))
+    
+    def start(self):
+        Thread(target=self._log_loop, name='metrics-log', daemon=True).start()
+        if self.port:
+            server = ThreadingHTTPServer(('0.0.0.0', self.port), MetricsHandler)
+            Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+            print(f"📈 Метрики доступны на порту {self.port} (/metrics)")
+
+metrics_reporter = MetricsReporter()
+# ====================================================
+
 # ==================== НАСТРОЙКА СЕССИИ ====================
 session = requests.Session()
 retry = Retry(
@@ -171,27 +764,672 @@ retry = Retry(
     backoff_factor=0.5,
     status_forcelist=(500, 502, 503, 504),
 )
-adapter = HTTPAdapter(max_retries=retry, pool_connections=10, pool_maxsize=10)
-session.mount('http://', adapter)
-session.mount('https://', adapter)
+# Один адаптер (и один пул keep-alive соединений) на Telegram и Google Sheets.
+# Отдельно - потоки отправки сообщений и запас в 2 соединения для фоновых потоков
+adapter = HTTPAdapter(max_retries=retry, pool_connections=10,
+                      pool_maxsize=HANDLER_THREADS + TELEGRAM_SENDERS + 2)
+
+def mount_shared_adapter(http_session):
+    """Подключает общий пул соединений к сессии"""
+    http_session.mount('http://', adapter)
+    http_session.mount('https://', adapter)
+    return http_session
+
+mount_shared_adapter(session)
+session.hooks['response'].append(track_http_response)
+telebot.apihelper.session = session
+# ====================================================
+
+# ==================== ФОНОВОЕ ОБНОВЛЕНИЕ ТОКЕНА GOOGLE ====================
+class TokenRefresher:
+    """Обновляет токен сервисного аккаунта заранее, в фоновом потоке,
+    чтобы запрос токена никогда не выполнялся внутри обработчика пользователя"""
+    
+    def __init__(self, credentials, auth_request, margin=TOKEN_REFRESH_MARGIN):
+        self.credentials = credentials
+        self.auth_request = auth_request
+        self.margin = margin
+        self.check_interval = 60
+        self.lock = Lock()
+    
+    def seconds_left(self):
+        if not self.credentials.token or not self.credentials.expiry:
+            return 0
+        return (self.credentials.expiry - datetime.datetime.utcnow()).total_seconds()
+    
+    def refresh_if_needed(self):
+        with self.lock:
+            if self.seconds_left() > self.margin:
+                return False
+            self.credentials.refresh(self.auth_request)
+            print("🔑 Токен Google обновлён заранее")
+            return True
+    
+    def _run(self):
+        while True:
+            try:
+                self.refresh_if_needed()
+            except Exception as e:
+                print(f"⚠️ Ошибка фонового обновления токена: {e}")
+            time.sleep(self.check_interval)
+    
+    def start(self):
+        Thread(target=self._run, name='token-refresher', daemon=True).start()
+# ====================================================
+
+# ==================== ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ====================
+# Приоритеты: ответы на нажатия уходят первыми, отчёты и файлы - последними
+PRIORITY_ANSWER = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+class TokenBucket:
+    """Ведро токенов: rate в секунду, подряд - не больше burst"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+    
+    def delay(self, now):
+        """Сколько секунд ждать токен"""
+        self._refill(now)
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.0)
+    
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+    
+    def block(self, now, seconds):
+        """После 429: до конца паузы токенов нет"""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = min(self.tokens, 0.0)
+        self.updated = max(self.updated, self.blocked_until)
+    
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.blocked_until
+
+class Outbox:
+    """Очередь исходящих вызовов Telegram. Обработчики только ставят вызов в очередь
+    и сразу возвращаются; отправкой занимаются фоновые потоки с учётом лимитов
+    на чат и на весь бот. Сообщения одного чата уходят строго по порядку постановки
+    (приоритет решает только, какой чат обслужить раньше: чат с ответом на нажатие
+    идёт первым, даже если перед ответом у него в очереди файл),
+    а несколько ещё не отправленных правок одного сообщения сливаются в последнюю"""
+    
+    def __init__(self, senders=TELEGRAM_SENDERS):
+        self.senders = senders
+        self.jobs = (deque(), deque(), deque())
+        self.chat_jobs = {}  # чат -> его вызовы в порядке постановки
+        self.sequence = 0
+        self.edits = {}  # (чат, сообщение) -> ещё не отправленная правка
+        self.in_flight = set()
+        self.busy = 0
+        self.chat_buckets = {}
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self.condition = Condition()
+        self.stopped = False
+    
+    # ---------- те же методы, что у TeleBot, но без ожидания ответа ----------
+    def send_message(self, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+        self._put('send_message', chat_id, (chat_id, text), kwargs, priority)
+    
+    def edit_message_text(self, text, chat_id, message_id, priority=PRIORITY_NORMAL, **kwargs):
+        kwargs.update(chat_id=chat_id, message_id=message_id)
+        self._put('edit_message_text', chat_id, (text,), kwargs, priority, merge_key=(chat_id, message_id))
+    
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        # Ответ на нажатие не считается сообщением в чат, его ограничивает только общий лимит
+        self._put('answer_callback_query', None, (callback_query_id, text), kwargs, PRIORITY_ANSWER)
+    
+    def delete_message(self, chat_id, message_id, priority=PRIORITY_NORMAL):
+        self._put('delete_message', chat_id, (chat_id, message_id), {}, priority)
+    
+    def send_chat_action(self, chat_id, action, priority=PRIORITY_NORMAL):
+        self._put('send_chat_action', chat_id, (chat_id, action), {}, priority)
+    
+    def send_document(self, chat_id, document, priority=PRIORITY_BULK, error_text=None, **kwargs):
+        """document - байты или файловый объект; хранятся байты, чтобы повтор после 429
+        отправил файл целиком. error_text - что написать в чат, если отправка не удастся"""
+        if not isinstance(document, bytes):
+            document.seek(0)
+            document = document.read()
+        self._put('send_document', chat_id, (chat_id, document), kwargs, priority, error_text=error_text)
+    
+    def send_file(self, chat_id, path, priority=PRIORITY_BULK, error_text=None, **kwargs):
+        """Отправляет файл с диска и удаляет его после отправки (или окончательной ошибки)"""
+        self._put('send_file', chat_id, (chat_id, path), kwargs, priority, error_text=error_text)
+    
+    # ---------- очередь ----------
+    def _put(self, method, chat_id, args, kwargs, priority, merge_key=None, error_text=None):
+        with self.condition:
+            if merge_key is not None and merge_key in self.edits:
+                self.edits[merge_key].update(args=args, kwargs=kwargs)
+                metrics.inc('outbox_merged', method)
+                return
+            self.sequence += 1
+            job = {'method': method, 'chat_id': chat_id, 'args': args, 'kwargs': kwargs,
+                   'priority': priority, 'merge_key': merge_key, 'attempts': 0,
+                   'error_text': error_text, 'sequence': self.sequence}
+            if merge_key is not None:
+                self.edits[merge_key] = job
+            self.jobs[priority].append(job)
+            if chat_id is not None:
+                self.chat_jobs.setdefault(chat_id, deque()).append(job)
+            self._publish()
+            self.condition.notify()
+    
+    def pending(self):
+        with self.condition:
+            return sum(len(queue) for queue in self.jobs) + self.busy
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        return bucket
+    
+    def _take_next(self, now):
+        """Следующий вызов, который можно отправить сейчас. Возвращает (вызов, пауза):
+        вызова нет - пауза до ближайшего готового (None - очередь пуста или остановлена)"""
+        if self.stopped:
+            return None, None
+        wait = None
+        global_delay = self.global_bucket.delay(now)
+        # Первый вызов чата в очередях приоритетов лишь выбирает чат; отправляется
+        # самый ранний вызов этого чата, поэтому порядок внутри чата не нарушается
+        skipped = set()
+        for queue in self.jobs:
+            for job in queue:
+                chat_id = job['chat_id']
+                if chat_id in skipped:
+                    continue
+                if chat_id is not None:
+                    skipped.add(chat_id)
+                    if chat_id in self.in_flight:
+                        continue
+                    chat_delay = self._chat_bucket(chat_id).delay(now)
+                    if chat_delay > 0:
+                        wait = chat_delay if wait is None else min(wait, chat_delay)
+                        continue
+                if global_delay > 0:
+                    return None, global_delay
+                if chat_id is not None:
+                    job = self.chat_jobs[chat_id].popleft()
+                    if not self.chat_jobs[chat_id]:
+                        del self.chat_jobs[chat_id]
+                    self._chat_bucket(chat_id).take(now)
+                    self.in_flight.add(chat_id)
+                self.jobs[job['priority']].remove(job)
+                if job['merge_key'] is not None and self.edits.get(job['merge_key']) is job:
+                    del self.edits[job['merge_key']]
+                self.global_bucket.take(now)
+                self.busy += 1
+                return job, None
+        return None, wait
+    
+    def _retry(self, job, seconds):
+        """429: чат (или весь бот для ответов на нажатия) молчит seconds, вызов - в начало очереди"""
+        now = time.monotonic()
+        bucket = self.global_bucket if job['chat_id'] is None else self._chat_bucket(job['chat_id'])
+        bucket.block(now, seconds)
+        merge_key = job['merge_key']
+        if merge_key is not None:
+            if merge_key in self.edits:
+                # Пока ждали, пришла более свежая правка - старая уже не нужна
+                return
+            self.edits[merge_key] = job
+        self.jobs[job['priority']].appendleft(job)
+        if job['chat_id'] is not None:
+            self.chat_jobs.setdefault(job['chat_id'], deque()).appendleft(job)
+    
+    def _send(self, job):
+        """Выполняет вызов. Возвращает паузу перед повтором (None - повтор не нужен)"""
+        method, args, kwargs = job['method'], job['args'], job['kwargs']
+        error = None
+        try:
+            if method == 'send_file':
+                chat_id, path = args
+                with open(path, 'rb') as f:
+                    bot.send_document(chat_id, f, **kwargs)
+            elif method == 'send_document':
+                # Каждая попытка читает файл с начала
+                chat_id, data = args
+                bot.send_document(chat_id, BytesIO(data), **kwargs)
+            else:
+                getattr(bot, method)(*args, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429 and job['attempts'] + 1 < TELEGRAM_SEND_ATTEMPTS:
+                job['attempts'] += 1
+                metrics.inc('telegram_retries', method)
+                return float(e.result_json.get('parameters', {}).get('retry_after', 1))
+            if (e.error_code == 400 and "can't parse entities" in e.description.lower()
+                    and kwargs.get('parse_mode')):
+                # Разметку сломал текст из данных (например, _ в названии) - отправляем без неё
+                job['kwargs'] = {key: value for key, value in kwargs.items() if key != 'parse_mode'}
+                metrics.inc('telegram_retries', method)
+                return 0.0
+            if "message is not modified" not in e.description.lower():
+                print(f"⚠️ Ошибка отправки ({method}): {e}")
+                error = e
+        except Exception as e:
+            print(f"⚠️ Ошибка отправки ({method}): {e}")
+            error = e
+        if error is not None and job.get('error_text') and job['chat_id'] is not None:
+            self.send_message(job['chat_id'], f"{job['error_text']}: {error}")
+        if method == 'send_file':
+            try:
+                os.remove(job['args'][1])
+            except OSError as e:
+                print(f"⚠️ Не удалось удалить временный файл: {e}")
+        return None
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                job, wait = self._take_next(time.monotonic())
+                while job is None and wait is None:
+                    self.condition.wait()
+                    job, wait = self._take_next(time.monotonic())
+            if job is None:
+                # Ближайший вызов упирается в лимит; новые вызовы заберут другие потоки
+                time.sleep(min(wait, 0.1))
+                continue
+            retry_after = None
+            try:
+                retry_after = self._send(job)
+            finally:
+                # Иначе чат навсегда останется занятым, а wait_idle не дождётся очереди
+                with self.condition:
+                    self.busy -= 1
+                    self.in_flight.discard(job['chat_id'])
+                    if retry_after is not None:
+                        self._retry(job, retry_after)
+                    self._cleanup(time.monotonic())
+                    self._publish()
+                    self.condition.notify_all()
+    
+    def _cleanup(self, now):
+        """Забывает ведра чатов, которые давно ничего не отправляли"""
+        if len(self.chat_buckets) > 1000:
+            for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items()
+                            if chat_id not in self.in_flight and bucket.idle(now)]:
+                del self.chat_buckets[chat_id]
+    
+    def _publish(self):
+        metrics.set_gauge('outbox_pending', 'telegram', sum(len(queue) for queue in self.jobs) + self.busy)
+    
+    def wait_idle(self, timeout=None):
+        """Ждёт, пока очередь опустеет. False - не успела за timeout"""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.busy and not any(self.jobs), timeout)
+    
+    # Ответы на нажатия после перезапуска уже недействительны, а файлы отчётов
+    # живут только в памяти - на диск сохраняются лишь сообщения и правки
+    PERSISTENT_METHODS = ('send_message', 'edit_message_text', 'delete_message')
+    
+    def snapshot(self):
+        """Ещё не отправленные вызовы в виде, пригодном для JSON"""
+        with self.condition:
+            jobs = sorted((job for queue in self.jobs for job in queue if job['method'] in self.PERSISTENT_METHODS),
+                          key=lambda job: job['sequence'])
+        saved = []
+        for job in jobs:
+            kwargs = dict(job['kwargs'])
+            markup = kwargs.get('reply_markup')
+            if isinstance(markup, telebot.types.JsonSerializable):
+                kwargs['reply_markup'] = markup.to_json()
+            saved.append({'method': job['method'], 'chat_id': job['chat_id'], 'args': list(job['args']),
+                          'kwargs': kwargs, 'priority': job['priority']})
+        return saved
+    
+    def restore(self, jobs):
+        for job in jobs:
+            merge_key = None
+            if job['method'] == 'edit_message_text':
+                merge_key = (job['kwargs']['chat_id'], job['kwargs']['message_id'])
+            self._put(job['method'], job['chat_id'], tuple(job['args']), job['kwargs'], job['priority'], merge_key)
+    
+    def stop(self):
+        """Потоки больше не берут вызовы из очереди (уже начатые досылаются).
+        После этого snapshot() не разойдётся с тем, что ещё уйдёт в Telegram"""
+        with self.condition:
+            self.stopped = True
+    
+    def start(self):
+        for i in range(self.senders):
+            Thread(target=self._run, name=f'outbox-{i}', daemon=True).start()
+
+outbox = Outbox()
 # ====================================================
 
 # ==================== БЕЗОПАСНОЕ РЕДАКТИРОВАНИЕ СООБЩЕНИЙ ====================
 def safe_edit_message(chat_id, message_id, text, reply_markup=None, parse_mode='Markdown'):
-    """Безопасное обновление сообщения - игнорирует ошибку 'message is not modified'"""
-    try:
-        bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=text,
-            parse_mode=parse_mode,
-            reply_markup=reply_markup
-        )
-    except Exception as e:
-        if "message is not modified" in str(e).lower():
-            pass
+    """Обновление сообщения через очередь: правки подряд сливаются в одну,
+    ошибка 'message is not modified' игнорируется при отправке"""
+    outbox.edit_message_text(text, chat_id, message_id, parse_mode=parse_mode, reply_markup=reply_markup)
+# ====================================================
+
+# ==================== СПИСОК СТУДЕНТОВ ====================
+Student = namedtuple('Student', ['id', 'name', 'subgroup', 'bit'])
+
+def student_id(name, salt=0):
+    """Короткий стабильный ID студента (base36 от crc32 имени)"""
+    value = zlib.crc32(f"{name}#{salt}".encode('utf-8') if salt else name.encode('utf-8'))
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    result = ''
+    while True:
+        value, rest = divmod(value, 36)
+        result = digits[rest] + result
+        if not value:
+            return result
+
+def selection_mask(students):
+    """Битовая маска выбора для списка студентов"""
+    mask = 0
+    for student in students:
+        mask |= student.bit
+    return mask
+
+class Roster:
+    """Список студентов, собранный один раз на обновление кэша:
+    индексы по имени и ID, заранее разбитый по подгруппам"""
+    
+    def __init__(self, rows, previous=None):
+        """rows - результат students_sheet.get_all_values() (первая строка - заголовок).
+        previous - прошлая версия списка: оставшиеся в нём студенты сохраняют номера битов,
+        поэтому выбор переживает обновление списка. Номера ушедших студентов освобождаются"""
+        self.rows = rows
+        entries = []
+        self.by_name = {}
+        self.by_id = {}
+        partitions = {'all': [], '1': [], '2': []}
+        for row in rows[1:]:
+            if len(row) < 2 or not str(row[1]).strip():
+                continue
+            name = row[1]
+            subgroup = str(row[2]).strip() if len(row) >= 3 else ''
+            subgroup = subgroup if subgroup in ('1', '2') else 'all'
+            
+            # ID зависит только от имени; при совпадении crc32 добавляется соль
+            salt = 0
+            sid = student_id(name)
+            while sid in self.by_id:
+                salt += 1
+                sid = student_id(name, salt)
+            
+            index = len(entries)
+            entries.append((sid, name, subgroup))
+            self.by_name.setdefault(name, index)
+            self.by_id[sid] = index
+            partitions['all'].append(index)
+            if subgroup != 'all':
+                partitions[subgroup].append(index)
+        
+        # ID -> номер бита в масках выбора; новые студенты занимают свободные номера
+        inherited = previous.bit_positions if previous is not None else {}
+        self.bit_positions = {sid: inherited[sid] for sid in self.by_id if sid in inherited}
+        taken = set(self.bit_positions.values())
+        position = 0
+        for sid, name, subgroup in entries:
+            if sid not in self.bit_positions:
+                while position in taken:
+                    position += 1
+                self.bit_positions[sid] = position
+                taken.add(position)
+        students = [Student(sid, name, subgroup, 1 << self.bit_positions[sid]) for sid, name, subgroup in entries]
+        
+        self.students = tuple(students)
+        self.names = tuple(student.name for student in students)
+        self.partitions = {key: tuple(indexes) for key, indexes in partitions.items()}
+        self.by_subgroup = {
+            key: tuple(self.students[i] for i in indexes) for key, indexes in self.partitions.items()
+        }
+        self.masks = {key: selection_mask(students) for key, students in self.by_subgroup.items()}
+    
+    def __len__(self):
+        return len(self.students)
+    
+    def __contains__(self, name):
+        return name in self.by_name
+    
+    def for_subgroup(self, subgroup):
+        """Студенты подгруппы ('all' - вся группа)"""
+        return self.by_subgroup.get(subgroup, ())
+    
+    def get(self, sid):
+        index = self.by_id.get(sid)
+        return self.students[index] if index is not None else None
+    
+    def subgroups(self):
+        """Подгруппа каждого студента ('all', если не указана)"""
+        return [student.subgroup for student in self.students]
+
+# ==================== КЭШ ОТМЕТОК ====================
+CacheEntry = namedtuple('CacheEntry', ['marks', 'timestamp', 'ttl', 'size'])
+
+class AttendanceLRU:
+    """Кэш отметок по парам с ключом (дата, пара).
+    Ограничен числом пар и примерным объёмом, вытесняются давно не использованные.
+    Индекс по дате позволяет очистить день, не перебирая все ключи.
+    Сам не блокирует: вызывается под блокировкой SheetsCache"""
+    
+    def __init__(self, max_entries=ATTENDANCE_CACHE_MAX_ENTRIES, max_bytes=ATTENDANCE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.by_date = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def key(date, lesson):
+        return (str(date), str(lesson))
+    
+    @staticmethod
+    def estimate_size(marks):
+        """Примерный объём в памяти: словарь пары и по словарю на студента"""
+        size = 400
+        for name, data in marks.items():
+            size += 350 + 2 * (len(name) + sum(len(str(value)) for value in data.values()))
+        return size
+    
+    def lookup(self, key, now, default_ttl):
+        """Возвращает (отметки или None, свежие ли они). Устаревшие отдаются для запасного варианта"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, False
+        self.entries.move_to_end(key)
+        fresh = now - entry.timestamp <= (entry.ttl or default_ttl)
+        if fresh:
+            self.hits += 1
         else:
-            print(f"⚠️ Ошибка при редактировании: {e}")
+            self.misses += 1
+        return entry.marks, fresh
+    
+    def put(self, key, marks, timestamp, ttl=None):
+        self._remove(key)
+        entry = CacheEntry(marks, timestamp, ttl, self.estimate_size(marks))
+        self.entries[key] = entry
+        self.by_date.setdefault(key[0], set()).add(key)
+        self.bytes += entry.size
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+            metrics.inc('cache_evictions', 'attendance')
+        self._update_gauges()
+    
+    def pop(self, key):
+        removed = self._remove(key)
+        self._update_gauges()
+        return removed
+    
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        self.bytes -= entry.size
+        keys = self.by_date.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_date[key[0]]
+        return True
+    
+    def pop_date(self, date):
+        """Удаляет все пары дня: O(число пар в этот день)"""
+        for key in list(self.by_date.get(str(date), ())):
+            self._remove(key)
+        self._update_gauges()
+    
+    def clear(self):
+        self.entries.clear()
+        self.by_date.clear()
+        self.bytes = 0
+        self._update_gauges()
+    
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+    
+    def _update_gauges(self):
+        metrics.set_gauge('cache_entries', 'attendance', len(self.entries))
+        metrics.set_gauge('cache_bytes', 'attendance', self.bytes)
+
+# ==================== КВОТА GOOGLE SHEETS ====================
+class QuotaExceeded(Exception):
+    """Квота Sheets закрыта дольше, чем вызывающий готов ждать"""
+    
+    def __init__(self, wait):
+        super().__init__(f"квота Google Sheets исчерпана, ожидание {wait:.0f} сек")
+        self.wait = wait
+
+def quota_retry_after(error):
+    """Пауза из Retry-After для ответа 429 (0 - заголовка нет); None - ошибка не про квоту"""
+    if not isinstance(error, gspread.exceptions.APIError):
+        return None
+    details = error.args[0] if error.args and isinstance(error.args[0], dict) else {}
+    if (error.response.status_code != 429 and details.get('code') != 429
+            and details.get('status') != 'RESOURCE_EXHAUSTED'):
+        return None
+    value = error.response.headers.get('Retry-After')
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        # Retry-After может прийти и датой
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return 0.0
+        return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+class SheetsQuota:
+    """Общее для всех потоков состояние квоты Sheets (ведро токенов).
+    Подряд можно сделать burst запросов, дальше - один за interval сек.
+    Каждый 429 закрывает квоту для всех потоков на Retry-After (или экспоненциальную
+    паузу с разбросом) и увеличивает интервал; успешные ответы понемногу возвращают его к базовому"""
+    
+    def __init__(self, burst=SHEETS_BURST, interval=SHEETS_MIN_INTERVAL,
+                 max_backoff=QUOTA_MAX_BACKOFF, max_wait=QUOTA_HANDLER_MAX_WAIT):
+        self.burst = burst
+        self.base_interval = interval
+        self.interval = interval
+        # После серии 429 запросы идут не реже, чем раз в 4 базовых интервала
+        self.max_interval = interval * 4
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.strikes = 0
+        self.lock = Lock()
+        self.local = local()
+        self.random = random.Random()
+    
+    def wait_without_limit(self):
+        """Текущий (фоновый) поток ждёт квоту сколько потребуется, а не отказывает"""
+        self.local.max_wait = None
+    
+    def _refill(self, now):
+        if now > self.refilled_at:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) / self.interval)
+            self.refilled_at = now
+    
+    def _check_budget(self, wait):
+        max_wait = getattr(self.local, 'max_wait', self.max_wait)
+        if max_wait is not None and wait > max_wait:
+            metrics.inc('quota_shed', 'sheets')
+            raise QuotaExceeded(wait)
+    
+    def acquire(self):
+        """Берёт токен на запрос, при необходимости дожидаясь его"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            ready_at = max(now, self.refilled_at) + max(0.0, 1 - self.tokens) * self.interval
+            self._check_budget(ready_at - now)
+            self.tokens -= 1
+        if ready_at > now:
+            time.sleep(ready_at - now)
+    
+    def wait_open(self):
+        """Только дожидается открытия квоты после 429, без учёта токенов"""
+        with self.lock:
+            wait = self.blocked_until - time.monotonic()
+            self._check_budget(wait)
+        if wait > 0:
+            time.sleep(wait)
+    
+    def penalize(self, retry_after=0.0):
+        """Ответ 429: закрывает квоту для всех потоков. Возвращает паузу, сек"""
+        with self.lock:
+            now = time.monotonic()
+            # 429 на запросы, отправленные до закрытия квоты, - тот же эпизод, не новый
+            if now >= self.blocked_until:
+                self.strikes += 1
+                self.interval = min(self.max_interval, self.interval * 1.5)
+            backoff = min(self.max_backoff, self.base_interval * 2 ** self.strikes)
+            # Разброс не даёт всем ожидающим потокам ударить в API одновременно
+            delay = max(retry_after, self.random.uniform(backoff / 2, backoff))
+            self.blocked_until = max(self.blocked_until, now + delay)
+            # Токены снова копятся только после открытия квоты
+            self.tokens = min(self.tokens, 0.0)
+            self.refilled_at = max(self.refilled_at, self.blocked_until)
+            self._publish()
+            return delay
+    
+    def reward(self):
+        """Успешный ответ: интервал плавно возвращается к базовому"""
+        with self.lock:
+            if self.strikes or self.interval > self.base_interval:
+                self.strikes = max(0, self.strikes - 1)
+                self.interval = max(self.base_interval, self.interval * 0.9)
+                self._publish()
+    
+    def _publish(self):
+        metrics.set_gauge('quota_interval_seconds', 'sheets', round(self.interval, 3))
+        metrics.set_gauge('quota_strikes', 'sheets', self.strikes)
+
+sheets_quota = SheetsQuota()
 # ====================================================
 
 # ==================== БАЗОВОЕ КЭШИРОВАНИЕ ====================
@@ -200,34 +1438,46 @@ class SheetsCache:
     def __init__(self):
         self.students_cache = []
         self.students_timestamp = 0
-        self.attendance_cache = {}
-        self.attendance_timestamp = {}
+        self.roster = Roster([])
+        self.attendance = AttendanceLRU()
         self.cache_ttl = 30
+        # Для заранее подгруженных отметок действует увеличенный срок жизни
+        self.prefetch_ttl = PREFETCH_TTL
+        # Растёт при каждой очистке кэша отметок: подгрузка, начатая до очистки, не кладёт старые данные
+        self.attendance_generation = 0
         self.lock = Lock()
         self.max_retries = 5
-        self.base_delay = 1
+    
+    def _before_request(self):
+        sheets_quota.wait_open()
     
     def _safe_call(self, func, *args, **kwargs):
+        """Вызов Sheets с учётом общей квоты. Если квота закрыта дольше, чем готов
+        ждать текущий поток, - QuotaExceeded без ожидания"""
         for attempt in range(self.max_retries):
+            self._before_request()
             try:
-                return func(*args, **kwargs)
+                result = func(*args, **kwargs)
             except Exception as e:
-                error_str = str(e)
-                if '429' in error_str or 'RESOURCE_EXHAUSTED' in error_str:
-                    if attempt < self.max_retries - 1:
-                        delay = self.base_delay * (2 ** attempt)
-                        print(f"⚠️ Превышена квота API. Ожидание {delay} сек... (попытка {attempt + 1}/{self.max_retries})")
-                        time.sleep(delay)
-                    else:
-                        print("❌ Исчерпаны все попытки вызова API")
-                        raise e
-                else:
-                    raise e
+                retry_after = quota_retry_after(e)
+                if retry_after is None:
+                    raise
+                metrics.inc('quota_errors', 'sheets')
+                delay = sheets_quota.penalize(retry_after)
+                if attempt == self.max_retries - 1:
+                    print("❌ Исчерпаны все попытки вызова API")
+                    raise
+                metrics.inc('quota_retries', 'sheets')
+                print(f"⚠️ Квота API превышена. Пауза {delay:.1f} сек для всех запросов... (попытка {attempt + 1}/{self.max_retries})")
+            else:
+                sheets_quota.reward()
+                return result
     
     def get_students(self):
         with self.lock:
             current_time = time.time()
             if not self.students_cache or current_time - self.students_timestamp > self.cache_ttl:
+                metrics.inc('cache_misses', 'students')
                 try:
                     self.students_cache = self._safe_call(students_sheet.get_all_values)
                     self.students_timestamp = current_time
@@ -237,95 +1487,111 @@ class SheetsCache:
                         print("⚠️ Используем устаревший кэш студентов")
                         return self.students_cache
                     raise e
+            else:
+                metrics.inc('cache_hits', 'students')
             return self.students_cache
     
+    def get_roster(self):
+        """Roster по текущему кэшу студентов; пересобирается только после обновления кэша"""
+        rows = self.get_students()
+        with self.lock:
+            if self.roster.rows is not rows:
+                self.roster = Roster(rows, previous=self.roster)
+            return self.roster
+    
+    def _filter_attendance(self, records, date, lesson):
+        filtered = {}
+        for record in records:
+            if (str(record.get('Дата', '')) == date and
+                str(record.get('Пара', '')) == str(lesson)):
+                student_name = record.get('Студент', '')
+                if student_name:
+                    filtered[student_name] = {
+                        'status': record.get('Статус', ''),
+                        'reason': record.get('Причина', '')
+                    }
+        return filtered
+    
     def get_attendance(self, date, lesson):
-        key = f"{date}_{lesson}"
+        key = AttendanceLRU.key(date, lesson)
         with self.lock:
             current_time = time.time()
-            if key not in self.attendance_cache or current_time - self.attendance_timestamp.get(key, 0) > self.cache_ttl:
+            marks, fresh = self.attendance.lookup(key, current_time, self.cache_ttl)
+            if not fresh:
+                metrics.inc('cache_misses', 'attendance')
                 try:
                     records = self._safe_call(attendance_sheet.get_all_records)
-                    filtered = {}
-                    for record in records:
-                        if (str(record.get('Дата', '')) == date and
-                            str(record.get('Пара', '')) == str(lesson)):
-                            student_name = record.get('Студент', '')
-                            if student_name:
-                                filtered[student_name] = {
-                                    'status': record.get('Статус', ''),
-                                    'reason': record.get('Причина', '')
-                                }
-                    self.attendance_cache[key] = filtered
-                    self.attendance_timestamp[key] = current_time
+                    marks = self._filter_attendance(records, date, lesson)
+                    self.attendance.put(key, marks, current_time)
                     print(f"📥 Загружены отметки для {date} пара {lesson} (кэш обновлён)")
                 except Exception as e:
-                    if key in self.attendance_cache:
+                    if marks is not None:
                         print(f"⚠️ Используем устаревший кэш для {date} пара {lesson}")
-                        return self.attendance_cache[key]
+                        return marks
                     raise e
-            return self.attendance_cache[key]
+            else:
+                metrics.inc('cache_hits', 'attendance')
+            return marks
+    
+    def prefetch(self, date, lessons):
+        """Заранее подгружает студентов и отметки на дату для списка пар.
+        Все пары заполняются из одного чтения листа. Листы читаются без блокировки
+        (обработчики тем временем пользуются кэшем), результат подменяется под ней.
+        Студенты живут обычный срок - новый студент появится так же быстро, как без подгрузки"""
+        with self.lock:
+            generation = self.attendance_generation
+        students_time = time.time()
+        students = self._safe_call(students_sheet.get_all_values)
+        records_time = time.time()
+        records = self._safe_call(attendance_sheet.get_all_records)
+        
+        with self.lock:
+            if students_time >= self.students_timestamp:
+                self.students_cache = students
+                self.students_timestamp = students_time
+            if generation != self.attendance_generation:
+                print(f"⚠️ Кэш отметок очищен во время подгрузки для {date}, результат отброшен")
+                return
+            for lesson in lessons:
+                key = AttendanceLRU.key(date, lesson)
+                entry = self.attendance.entries.get(key)
+                # Запись уже положила в кэш отметки новее прочитанных
+                if entry is not None and entry.timestamp >= records_time:
+                    continue
+                self.attendance.put(key, self._filter_attendance(records, date, lesson), records_time, self.prefetch_ttl)
+            print(f"📥 Подгружены заранее отметки для {date} пары {', '.join(map(str, lessons))}")
+    
+    def store_attendance(self, date, lesson, marks):
+        """Кладёт в кэш отметки пары, уже известные после записи (без повторного чтения листа)"""
+        with self.lock:
+            self.attendance.put(AttendanceLRU.key(date, lesson), marks, time.time())
     
     def clear_attendance_cache(self, date=None, lesson=None):
         with self.lock:
+            self.attendance_generation += 1
             if date and lesson:
-                key = f"{date}_{lesson}"
-                self.attendance_cache.pop(key, None)
-                self.attendance_timestamp.pop(key, None)
+                self.attendance.pop(AttendanceLRU.key(date, lesson))
                 print(f"🗑️ Очищен кэш для {date} пара {lesson}")
             elif date:
-                keys_to_remove = [key for key in self.attendance_cache.keys() if key.startswith(f"{date}_")]
-                for key in keys_to_remove:
-                    self.attendance_cache.pop(key, None)
-                    self.attendance_timestamp.pop(key, None)
+                self.attendance.pop_date(date)
                 print(f"🗑️ Очищен кэш для всех пар {date}")
             else:
-                self.attendance_cache.clear()
-                self.attendance_timestamp.clear()
+                self.attendance.clear()
                 print("🗑️ Очищен весь кэш отметок")
     
     def clear_students_cache(self):
         with self.lock:
             self.students_cache = []
             self.students_timestamp = 0
+            # Список (и номера битов выбора) пересоберётся из следующего чтения листа
             print("🗑️ Очищен кэш студентов")
 
 # ==================== УЛУЧШЕННОЕ КЭШИРОВАНИЕ ====================
 class ImprovedSheetsCache(SheetsCache):
-    """Улучшенный кэш с принудительным ожиданием между запросами"""
-    
-    def __init__(self):
-        super().__init__()
-        self.last_request_time = 0
-        self.min_request_interval = 1.1
-    
-    def _wait_for_rate_limit(self):
-        now = time.time()
-        time_since_last = now - self.last_request_time
-        if time_since_last < self.min_request_interval:
-            wait_time = self.min_request_interval - time_since_last
-            time.sleep(wait_time)
-        self.last_request_time = time.time()
+    """Улучшенный кэш: запросы расходуют общее ведро токенов квоты"""
     
-    def _safe_call(self, func, *args, **kwargs):
-        self._wait_for_rate_limit()
-        
-        for attempt in range(self.max_retries):
-            try:
-                return func(*args, **kwargs)
-            except Exception as e:
-                error_str = str(e)
-                if '429' in error_str or 'RESOURCE_EXHAUSTED' in error_str:
-                    if attempt < self.max_retries - 1:
-                        delay = self.base_delay * (4 ** attempt)
-                        print(f"⚠️ Квота API превышена. Ожидание {delay} сек... (попытка {attempt + 1}/{self.max_retries})")
-                        time.sleep(delay)
-                        self._wait_for_rate_limit()
-                    else:
-                        print("❌ Исчерпаны все попытки вызова API")
-                        raise
-                else:
-                    raise
+    def _before_request(self):
+        sheets_quota.acquire()
 # ====================================================
 
 # Расписание пар
@@ -356,18 +1622,59 @@ try:
         GOOGLE_KEY_FILE,
         scopes=scope
     )
-    client = gspread.authorize(creds)
-    print("✅ Google Таблица подключена!")
+    # Sheets работает через общий пул соединений, токен запрашивается через него же
+    auth_request = Request(session)
+    google_session = mount_shared_adapter(AuthorizedSession(creds, auth_request=auth_request))
+    client = gspread.Client(auth=creds, session=google_session)
+    token_refresher = TokenRefresher(creds, auth_request)
+    print("✅ Доступ к Google настроен!")
 except Exception as e:
     print(f"❌ Ошибка подключения к Google: {e}")
     exit()
 
-# Открываем таблицу
+# ==================== ЛЕНИВОЕ ОТКРЫТИЕ ТАБЛИЦЫ ====================
+spreadsheet = None
+spreadsheet_lock = Lock()
+
+def get_spreadsheet():
+    """Открывает таблицу при первом обращении (по ключу, если он задан)"""
+    global spreadsheet
+    with spreadsheet_lock:
+        if spreadsheet is None:
+            metrics.inc('sheets_reads', 'open')
+            if SPREADSHEET_KEY:
+                spreadsheet = client.open_by_key(SPREADSHEET_KEY)
+            else:
+                spreadsheet = client.open(SPREADSHEET_NAME)
+            print("✅ Google Таблица подключена!")
+        return spreadsheet
+
+class LazyWorksheet:
+    """Лист, который открывается при первом обращении к нему.
+    Все атрибуты и методы пробрасываются в настоящий gspread.Worksheet"""
+    
+    def __init__(self, title):
+        self.title = title
+        self._worksheet = None
+        self._lock = Lock()
+    
+    def resolve(self):
+        if self._worksheet is None:
+            with self._lock:
+                if self._worksheet is None:
+                    self._worksheet = get_spreadsheet().worksheet(self.title)
+        return self._worksheet
+    
+    def __getattr__(self, name):
+        value = getattr(self.resolve(), name)
+        if callable(value):
+            return instrument_sheets_call(value, name)
+        return value
+# ====================================================
+
 try:
-    spreadsheet = client.open(SPREADSHEET_NAME)
-    attendance_sheet = spreadsheet.worksheet("Посещаемость")
-    students_sheet = spreadsheet.worksheet("Студенты")
-    print("✅ Google Таблица подключена!")
+    attendance_sheet = LazyWorksheet("Посещаемость")
+    students_sheet = LazyWorksheet("Студенты")
     
     cache = ImprovedSheetsCache()
     print("✅ Улучшенная система кэширования запущена")
@@ -379,8 +1686,7 @@ except Exception as e:
     exit()
 
 # Создаём бота
-bot = telebot.TeleBot(BOT_TOKEN, threaded=True, skip_pending=True)
-bot.session = session
+bot = telebot.TeleBot(BOT_TOKEN, threaded=True, skip_pending=True, num_threads=HANDLER_THREADS)
 
 # ==================== ХРАНЕНИЕ ТЕКУЩЕГО ВЫБОРА ====================
 user_data = {}
@@ -394,49 +1700,90 @@ def get_user_data(user_id):
             'marking_mode': False,
             'current_page': 0,
             'students_list': [],
-            'selected_students': set()
+            'selected_students': 0
         }
     return user_data[user_id]
 
+# ==================== ИДЕМПОТЕНТНОСТЬ ЗАПИСЕЙ ====================
+class RecentKeys:
+    """Ограниченное множество недавно применённых ключей (старые вытесняются первыми)"""
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.keys = OrderedDict()  # ключ -> момент истечения (None - пока не вытеснят)
+        self.lock = Lock()
+    
+    def claim(self, key, ttl=None):
+        """Занимает ключ; False - ключ уже был применён"""
+        now = time.monotonic()
+        with self.lock:
+            expires = self.keys.get(key, False)
+            if expires is None or (expires is not False and expires > now):
+                return False
+            self.keys[key] = now + ttl if ttl else None
+            self.keys.move_to_end(key)
+            while len(self.keys) > self.limit:
+                self.keys.popitem(last=False)
+            return True
+    
+    def release(self, key):
+        with self.lock:
+            self.keys.pop(key, None)
+
+applied_writes = RecentKeys(IDEMPOTENCY_KEYS_LIMIT)
+
+def write_keys(update):
+    """Ключи идемпотентности обновления: (ключ, время жизни).
+    Повтор того же callback/сообщения отсекается всегда, двойное нажатие - в пределах окна"""
+    if isinstance(update, telebot.types.CallbackQuery):
+        chat_id = update.message.chat.id
+        selected = get_user_data(chat_id).get('selected_students', 0)
+        return [
+            (f"cb:{update.id}", None),
+            (f"tap:{chat_id}:{update.message.message_id}:{update.data}:{selected}", IDEMPOTENCY_TAP_WINDOW)
+        ]
+    return [(f"msg:{update.chat.id}:{update.message_id}", None)]
+
+def idempotent(func):
+    """Декоратор для обработчиков с записью в лист: повтор обновления не пишет ничего"""
+    @functools.wraps(func)
+    def wrapper(update, *args, **kwargs):
+        claimed = []
+        for key, ttl in write_keys(update):
+            if not applied_writes.claim(key, ttl):
+                for done in claimed:
+                    applied_writes.release(done)
+                metrics.inc('duplicate_updates', func.__name__)
+                # Повтор от Telegram не трогаем вовсе, на двойное нажатие только гасим часики
+                if claimed and isinstance(update, telebot.types.CallbackQuery):
+                    outbox.answer_callback_query(update.id, "⏳ Уже сохранено")
+                return None
+            claimed.append(key)
+        try:
+            return func(update, *args, **kwargs)
+        except Exception:
+            # Запись не прошла - повтор должен её выполнить
+            for key in claimed:
+                applied_writes.release(key)
+            raise
+    return wrapper
+
 # ==================== ПОЛУЧЕНИЕ ОТМЕЧЕННЫХ ПАР ====================
+def build_attendance_matrix(records, students=()):
+    """Матрица посещаемости для векторной аналитики (numpy загружается при первом вызове)"""
+    import analytics
+    status_texts = [info['text'] for info in STATUSES.values()]
+    return analytics.AttendanceMatrix.from_records(records, students, status_texts)
+
 def get_marked_lessons(year, month):
     """Получает список отмеченных пар за указанный месяц"""
     try:
-        records = attendance_sheet.get_all_records()
-        marked = []
-        seen = set()
-        
-        # Начало и конец месяца для фильтрации
-        start_date = datetime.date(year, month, 1)
-        if month == 12:
-            end_date = datetime.date(year + 1, 1, 1)
-        else:
-            end_date = datetime.date(year, month + 1, 1)
-        
-        for record in records:
-            date_str = record.get('Дата', '')
-            if not date_str:
-                continue
-                
-            try:
-                date = datetime.datetime.strptime(date_str, "%d.%m.%Y").date()
-                
-                # Проверяем, что дата в нужном месяце
-                if start_date <= date < end_date:
-                    lesson_num = int(record.get('Пара', 0))
-                    pair_key = f"{date_str}_{lesson_num}"
-                    
-                    if pair_key not in seen:
-                        seen.add(pair_key)
-                        marked.append({
-                            'date': date_str,
-                            'lesson': lesson_num
-                        })
-            except Exception as e:
-                print(f"⚠️ Ошибка обработки даты {date_str}: {e}")
-                continue
-        
-        return marked
+        records = cache._safe_call(attendance_sheet.get_all_records)
+        matrix = build_attendance_matrix(records).month(year, month)
+        return [
+            {'date': date.strftime("%d.%m.%Y"), 'lesson': lesson}
+            for date, lesson in matrix.marked_slots()
+        ]
         
     except Exception as e:
         print(f"❌ Ошибка получения отмеченных пар: {e}")
@@ -444,6 +1791,7 @@ def get_marked_lessons(year, month):
 
 # ==================== ГЛАВНОЕ МЕНЮ ====================
 @bot.message_handler(commands=['start'])
+@instrumented
 def start(message):
     user = get_user_data(message.chat.id)
     
@@ -485,19 +1833,20 @@ def start(message):
     
     progress_text = f"📊 *Прогресс за {month_name}:* {marked_count} из {total} пар"
     
-    bot.send_message(message.chat.id,
-                    f"👋 *Система учёта посещаемости*\n"
-                    f"👥 *Группа:* {GROUP_NAME}\n"
-                    f"👤 *Режим:* {subgroup_text}\n"
-                    f"{lessons_text}\n"
-                    f"📅 *Дата:* {user['current_date']}\n"
-                    f"{progress_text}\n\n"
-                    f"Выберите действие:",
-                    parse_mode='Markdown',
-                    reply_markup=markup)
+    outbox.send_message(message.chat.id,
+                       f"👋 *Система учёта посещаемости*\n"
+                       f"👥 *Группа:* {GROUP_NAME}\n"
+                       f"👤 *Режим:* {subgroup_text}\n"
+                       f"{lessons_text}\n"
+                       f"📅 *Дата:* {user['current_date']}\n"
+                       f"{progress_text}\n\n"
+                       f"Выберите действие:",
+                       parse_mode='Markdown',
+                       reply_markup=markup)
 
 # ==================== СОСТОЯНИЕ ====================
 @bot.message_handler(func=lambda message: message.text == '📊 Состояние')
+@instrumented
 def show_status(message):
     user = get_user_data(message.chat.id)
     
@@ -549,9 +1898,10 @@ def show_status(message):
         status_text += f"🎉 *Все пары за {month_name} отмечены!*\n\n"
         markup = None
     
-    bot.send_message(message.chat.id, status_text, parse_mode='Markdown', reply_markup=markup)
+    outbox.send_message(message.chat.id, status_text, parse_mode='Markdown', reply_markup=markup)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('goto_'))
+@instrumented
 def goto_lesson(call):
     """Переход к указанной паре"""
     user = get_user_data(call.message.chat.id)
@@ -564,7 +1914,7 @@ def goto_lesson(call):
     user['current_date'] = date_str
     user['selected_lessons'] = {lesson_num}
     
-    bot.answer_callback_query(call.id, f"✅ Переход к паре {lesson_num} ({date_str})")
+    outbox.answer_callback_query(call.id, f"✅ Переход к паре {lesson_num} ({date_str})")
     
     # Сразу открываем отметку студентов
     mark_students_for_date(call.message.chat.id, date_str, lesson_num)
@@ -574,21 +1924,14 @@ def mark_students_for_date(chat_id, date_str, lesson_num):
     user = get_user_data(chat_id)
     
     try:
-        all_students = cache.get_students()
-        all_students_list = all_students[1:] if len(all_students) > 1 else []
-        
-        if user['selected_subgroup'] != 'all':
-            students = [s for s in all_students_list 
-                       if len(s) >= 3 and str(s[2]) == user['selected_subgroup']]
-        else:
-            students = all_students_list
+        students = cache.get_roster().for_subgroup(user['selected_subgroup'])
         
         if len(students) <= 0:
-            bot.send_message(chat_id, "❌ Нет студентов в выбранной подгруппе!")
+            outbox.send_message(chat_id, "❌ Нет студентов в выбранной подгруппе!")
             return
         
         user['students_list'] = students
-        user['selected_students'] = set()
+        user['selected_students'] = 0
         user['current_page'] = 0
         
         existing_marks = get_existing_marks(date_str, lesson_num)
@@ -597,10 +1940,11 @@ def mark_students_for_date(chat_id, date_str, lesson_num):
         show_students_list_with_checkboxes(chat_id, students, existing_marks, 0)
         
     except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка: {e}")
+        outbox.send_message(chat_id, f"❌ Ошибка: {e}")
 
 # ==================== ВЫБОР ДАТЫ ====================
 @bot.message_handler(func=lambda message: message.text == '📅 Выбор даты')
+@instrumented
 def date_choice_menu(message):
     markup = telebot.types.InlineKeyboardMarkup(row_width=2)
     markup.add(
@@ -608,20 +1952,21 @@ def date_choice_menu(message):
         telebot.types.InlineKeyboardButton("📅 Другая дата", callback_data="date_custom")
     )
     
-    bot.send_message(message.chat.id,
-                    "📅 *Выберите дату:*\n\n"
-                    "• ✅ Сегодня — установит текущую дату\n"
-                    "• 📅 Другая дата — введите вручную",
-                    parse_mode='Markdown',
-                    reply_markup=markup)
+    outbox.send_message(message.chat.id,
+                       "📅 *Выберите дату:*\n\n"
+                       "• ✅ Сегодня — установит текущую дату\n"
+                       "• 📅 Другая дата — введите вручную",
+                       parse_mode='Markdown',
+                       reply_markup=markup)
 
 @bot.callback_query_handler(func=lambda call: call.data == 'date_today')
+@instrumented
 def set_today(call):
     user = get_user_data(call.message.chat.id)
     user['current_date'] = datetime.date.today().strftime("%d.%m.%Y")
     
-    bot.answer_callback_query(call.id, "✅ Дата установлена")
-    bot.edit_message_text(
+    outbox.answer_callback_query(call.id, "✅ Дата установлена")
+    outbox.edit_message_text(
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
         text=f"✅ Установлена сегодняшняя дата: {user['current_date']}",
@@ -629,8 +1974,9 @@ def set_today(call):
     )
 
 @bot.callback_query_handler(func=lambda call: call.data == 'date_custom')
+@instrumented
 def ask_custom_date(call):
-    bot.edit_message_text(
+    outbox.edit_message_text(
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
         text="📅 *Введите дату*\n\n"
@@ -641,17 +1987,19 @@ def ask_custom_date(call):
     )
     bot.register_next_step_handler(call.message, process_custom_date)
 
+@instrumented
 def process_custom_date(message):
     user = get_user_data(message.chat.id)
     try:
         datetime.datetime.strptime(message.text, "%d.%m.%Y")
         user['current_date'] = message.text
-        bot.send_message(message.chat.id, f"✅ Дата установлена: {message.text}")
+        outbox.send_message(message.chat.id, f"✅ Дата установлена: {message.text}")
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Неверный формат! Используйте ДД.ММ.ГГГГ")
+        outbox.send_message(message.chat.id, "❌ Неверный формат! Используйте ДД.ММ.ГГГГ")
 
 # ==================== ВЫБОР ПАР ====================
 @bot.message_handler(func=lambda message: message.text == '🔢 Выбрать пары')
+@instrumented
 def choose_lessons(message):
     user = get_user_data(message.chat.id)
     
@@ -666,15 +2014,15 @@ def choose_lessons(message):
     )
     
     if not available_lessons:
-        bot.send_message(message.chat.id,
-                        "❌ На выбранную дату нет пар в расписании")
+        outbox.send_message(message.chat.id,
+                           "❌ На выбранную дату нет пар в расписании")
         return
     
     markup = telebot.types.InlineKeyboardMarkup(row_width=2)
     
     for lesson in available_lessons:
-        lesson_num = lesson['number']
-        subject = lesson['subject']
+        lesson_num = lesson.number
+        subject = lesson.subject
         
         if lesson_num in user.get('selected_lessons', set()):
             btn_text = f"✅ {lesson_num} - {subject}"
@@ -700,17 +2048,18 @@ def choose_lessons(message):
     selected = user.get('selected_lessons', set())
     selected_text = f"✅ *Выбрано пар:* {len(selected)}" if selected else "❌ *Ничего не выбрано*"
     
-    schedule_text = "\n".join([f"{l['number']}. {l['subject']}" for l in available_lessons])
+    schedule_text = "\n".join([f"{l.number}. {l.subject}" for l in available_lessons])
     
-    bot.send_message(message.chat.id,
-                    f"🔢 *ВЫБОР ПАР*\n\n"
-                    f"{selected_text}\n\n"
-                    f"*Расписание на {user['current_date']}:*\n{schedule_text}\n\n"
-                    f"*Нажимайте на пары, чтобы выбрать/снять выбор*",
-                    parse_mode='Markdown',
-                    reply_markup=markup)
+    outbox.send_message(message.chat.id,
+                       f"🔢 *ВЫБОР ПАР*\n\n"
+                       f"{selected_text}\n\n"
+                       f"*Расписание на {user['current_date']}:*\n{schedule_text}\n\n"
+                       f"*Нажимайте на пары, чтобы выбрать/снять выбор*",
+                       parse_mode='Markdown',
+                       reply_markup=markup)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('toggle_lesson_'))
+@instrumented
 def toggle_lesson(call):
     user = get_user_data(call.message.chat.id)
     lesson_num = int(call.data.split('_')[2])
@@ -720,10 +2069,10 @@ def toggle_lesson(call):
     
     if lesson_num in user['selected_lessons']:
         user['selected_lessons'].remove(lesson_num)
-        bot.answer_callback_query(call.id, f"❌ Пара {lesson_num} снята")
+        outbox.answer_callback_query(call.id, f"❌ Пара {lesson_num} снята")
     else:
         user['selected_lessons'].add(lesson_num)
-        bot.answer_callback_query(call.id, f"✅ Пара {lesson_num} выбрана")
+        outbox.answer_callback_query(call.id, f"✅ Пара {lesson_num} выбрана")
     
     update_lessons_display(call)
 
@@ -743,8 +2092,8 @@ def update_lessons_display(call):
     markup = telebot.types.InlineKeyboardMarkup(row_width=2)
     
     for lesson in available_lessons:
-        lesson_num = lesson['number']
-        subject = lesson['subject']
+        lesson_num = lesson.number
+        subject = lesson.subject
         
         if lesson_num in user['selected_lessons']:
             btn_text = f"✅ {lesson_num} - {subject}"
@@ -770,7 +2119,7 @@ def update_lessons_display(call):
     selected = user['selected_lessons']
     selected_text = f"✅ *Выбрано пар:* {len(selected)}" if selected else "❌ *Ничего не выбрано*"
     
-    schedule_text = "\n".join([f"{l['number']}. {l['subject']}" for l in available_lessons])
+    schedule_text = "\n".join([f"{l.number}. {l.subject}" for l in available_lessons])
     
     safe_edit_message(
         chat_id=call.message.chat.id,
@@ -784,6 +2133,7 @@ def update_lessons_display(call):
     )
 
 @bot.callback_query_handler(func=lambda call: call.data == 'lessons_all')
+@instrumented
 def lessons_all(call):
     user = get_user_data(call.message.chat.id)
     
@@ -797,30 +2147,32 @@ def lessons_all(call):
         user['selected_subgroup']
     )
     
-    user['selected_lessons'] = {l['number'] for l in available_lessons}
-    bot.answer_callback_query(call.id, f"✅ Выбраны все пары ({len(available_lessons)})")
+    user['selected_lessons'] = {l.number for l in available_lessons}
+    outbox.answer_callback_query(call.id, f"✅ Выбраны все пары ({len(available_lessons)})")
     
     update_lessons_display(call)
 
 @bot.callback_query_handler(func=lambda call: call.data == 'lessons_clear')
+@instrumented
 def lessons_clear(call):
     user = get_user_data(call.message.chat.id)
     user['selected_lessons'] = set()
-    bot.answer_callback_query(call.id, "❌ Выбор очищен")
+    outbox.answer_callback_query(call.id, "❌ Выбор очищен")
     update_lessons_display(call)
 
 @bot.callback_query_handler(func=lambda call: call.data == 'lessons_done')
+@instrumented
 def lessons_done(call):
     user = get_user_data(call.message.chat.id)
     
     if not user.get('selected_lessons'):
-        bot.answer_callback_query(call.id, "❌ Выберите хотя бы одну пару!")
+        outbox.answer_callback_query(call.id, "❌ Выберите хотя бы одну пару!")
         return
     
     selected = sorted(user['selected_lessons'])
     selected_text = ", ".join(map(str, selected))
     
-    bot.answer_callback_query(call.id, f"✅ Выбраны пары: {selected_text}")
+    outbox.answer_callback_query(call.id, f"✅ Выбраны пары: {selected_text}")
     
     safe_edit_message(
         chat_id=call.message.chat.id,
@@ -834,6 +2186,7 @@ def lessons_done(call):
 
 # ==================== ВЫБОР ПОДГРУППЫ ====================
 @bot.message_handler(func=lambda message: message.text == '👥 Подгруппа')
+@instrumented
 def choose_subgroup(message):
     user = get_user_data(message.chat.id)
     
@@ -859,14 +2212,15 @@ def choose_subgroup(message):
         '2': '2️⃣ Подгруппа 2'
     }.get(user['selected_subgroup'], 'не выбрана')
     
-    bot.send_message(message.chat.id,
-                    f"👥 *Выбор подгруппы*\n\n"
-                    f"Текущий выбор: {current}\n\n"
-                    f"Выберите, кого хотите отмечать:",
-                    parse_mode='Markdown',
-                    reply_markup=markup)
+    outbox.send_message(message.chat.id,
+                       f"👥 *Выбор подгруппы*\n\n"
+                       f"Текущий выбор: {current}\n\n"
+                       f"Выберите, кого хотите отмечать:",
+                       parse_mode='Markdown',
+                       reply_markup=markup)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('subgroup_'))
+@instrumented
 def set_subgroup(call):
     user = get_user_data(call.message.chat.id)
     subgroup = call.data.split('_')[1]
@@ -878,8 +2232,8 @@ def set_subgroup(call):
         '2': 'подгруппа 2'
     }.get(subgroup, 'не выбрана')
     
-    bot.answer_callback_query(call.id, f"✅ Выбрана {subgroup_text}")
-    bot.edit_message_text(
+    outbox.answer_callback_query(call.id, f"✅ Выбрана {subgroup_text}")
+    outbox.edit_message_text(
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
         text=f"✅ *Подгруппа выбрана*\n\n"
@@ -889,32 +2243,26 @@ def set_subgroup(call):
 
 # ==================== ОТМЕТКА СТУДЕНТОВ ====================
 @bot.message_handler(func=lambda message: message.text == '📝 Отметить')
+@instrumented
 def mark_students(message):
     user = get_user_data(message.chat.id)
     
     if not user.get('selected_lessons'):
-        bot.send_message(message.chat.id, 
-                        "❌ *Сначала выберите пары!*\n"
-                        "Нажмите 🔢 Выбрать пары",
-                        parse_mode='Markdown')
+        outbox.send_message(message.chat.id, 
+                           "❌ *Сначала выберите пары!*\n"
+                           "Нажмите 🔢 Выбрать пары",
+                           parse_mode='Markdown')
         return
     
     try:
-        all_students = cache.get_students()
-        all_students_list = all_students[1:] if len(all_students) > 1 else []
-        
-        if user['selected_subgroup'] != 'all':
-            students = [s for s in all_students_list 
-                       if len(s) >= 3 and str(s[2]) == user['selected_subgroup']]
-        else:
-            students = all_students_list
+        students = cache.get_roster().for_subgroup(user['selected_subgroup'])
         
         if len(students) <= 0:
-            bot.send_message(message.chat.id, "❌ Нет студентов в выбранной подгруппе!")
+            outbox.send_message(message.chat.id, "❌ Нет студентов в выбранной подгруппе!")
             return
         
         user['students_list'] = students
-        user['selected_students'] = set()
+        user['selected_students'] = 0
         user['current_page'] = 0
         
         existing_marks = {}
@@ -935,18 +2283,18 @@ def mark_students(message):
             '2': 'подгруппа 2'
         }.get(user['selected_subgroup'], 'не выбрана')
         
-        bot.send_message(message.chat.id,
-                        f"📌 *Отметка*\n"
-                        f"👥 {subgroup_text}\n"
-                        f"🔢 *Пары:* {lessons_text}\n"
-                        f"📅 *Дата:* {user['current_date']}\n\n"
-                        f"*Отметки будут применены ко ВСЕМ выбранным парам!*",
-                        parse_mode='Markdown')
+        outbox.send_message(message.chat.id,
+                           f"📌 *Отметка*\n"
+                           f"👥 {subgroup_text}\n"
+                           f"🔢 *Пары:* {lessons_text}\n"
+                           f"📅 *Дата:* {user['current_date']}\n\n"
+                           f"*Отметки будут применены ко ВСЕМ выбранным парам!*",
+                           parse_mode='Markdown')
         
         show_students_list_with_checkboxes(message.chat.id, students, existing_marks, 0)
         
     except Exception as e:
-        bot.send_message(message.chat.id, f"❌ Ошибка: {e}")
+        outbox.send_message(message.chat.id, f"❌ Ошибка: {e}")
 
 # ==================== ПОЛУЧЕНИЕ СУЩЕСТВУЮЩИХ ОТМЕТОК ====================
 def get_existing_marks(date, lesson):
@@ -956,101 +2304,640 @@ def get_existing_marks(date, lesson):
         print(f"❌ Ошибка получения отметок: {e}")
         return {}
 
-# ==================== СОХРАНЕНИЕ ЗАПИСИ ====================
-def save_attendance_record(date, lessons, student, status, reason, force_overwrite=True):
-    """Сохраняет запись о посещении для одной или нескольких пар
-    Если force_overwrite=True, удаляет старые записи перед сохранением"""
-    try:
-        if isinstance(lessons, (list, set)):
-            lesson_list = list(lessons)
-        else:
-            lesson_list = [lessons]
-        
-        time.sleep(1.1)
-        records = attendance_sheet.get_all_values()
-        
-        rows_to_delete = []
-        rows_to_add = []
+# ==================== ПОДПИСКИ НА УВЕДОМЛЕНИЯ ====================
+class Subscriptions:
+    """Чаты, подписанные на уведомления по темам ('alerts', ...).
+    Хранятся в JSON-файле, чтобы переживать перезапуск.
+    Чаты из defaults подписаны по умолчанию; если такой чат отписался,
+    он запоминается в opted_out и больше не получает уведомления темы"""
+    
+    def __init__(self, filename=SUBSCRIPTIONS_FILE, defaults=None):
+        self.filename = filename
+        self.defaults = defaults or {}
+        self.topics = {}
+        self.opted_out = {}
+        self.lock = Lock()
+        self.load()
+    
+    def load(self):
+        self.topics, self.opted_out = {}, {}
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"⚠️ Ошибка загрузки подписок: {e}")
+            return
         
-        for lesson in lesson_list:
-            # Всегда удаляем старые записи для этого студента на эту дату и пару
-            for i, row in enumerate(records):
-                if (i > 0 and len(row) >= 4 and
-                    str(row[0]) == date and
-                    str(row[1]) == str(lesson) and
-                    str(row[3]) == student):
-                    rows_to_delete.append(i + 1)
-            
-            time_now = datetime.datetime.now().strftime("%H:%M")
-            rows_to_add.append([
-                date,
-                lesson,
-                GROUP_NAME,
-                student,
-                status,
-                reason,
-                time_now
-            ])
-        
-        if rows_to_delete:
-            for row_num in sorted(rows_to_delete, reverse=True):
-                attendance_sheet.delete_rows(row_num)
-            print(f"🗑️ Удалено {len(rows_to_delete)} записей")
-        
-        if rows_to_add:
-            for row in rows_to_add:
-                attendance_sheet.append_row(row)
-            print(f"📝 Добавлено {len(rows_to_add)} записей")
-        
-        for lesson in lesson_list:
-            cache.clear_attendance_cache(date, lesson)
-        
-        return len(rows_to_add)
-    except Exception as e:
-        print(f"❌ Ошибка сохранения: {e}")
-        return 0
-
-# ==================== ПРИМЕНЕНИЕ БОЛЬНИЧНОГО НА ПЕРИОД ====================
-def apply_sick_leave(user, student_name, start_date, end_date):
-    """Применяет статус 'Болел' ко всем парам в указанном диапазоне,
-    перезаписывая любые предыдущие отметки"""
-    lessons_in_range = schedule_manager.get_lessons_in_range(
-        start_date, end_date, user['selected_subgroup']
-    )
+        if 'subscribed' not in data and 'unsubscribed' not in data:
+            # Старый формат файла: {тема: [чаты]}
+            data = {'subscribed': data}
+        self.topics = {topic: set(chats) for topic, chats in data.get('subscribed', {}).items()}
+        self.opted_out = {topic: set(chats) for topic, chats in data.get('unsubscribed', {}).items()}
     
-    updated_count = 0
-    for lesson in lessons_in_range:
-        # Сохраняем с force_overwrite=True, чтобы перезаписать старые отметки
-        save_attendance_record(
-            lesson['date'].strftime("%d.%m.%Y"),
+    def _save(self):
+        try:
+            with open(self.filename, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'subscribed': {topic: sorted(chats) for topic, chats in self.topics.items()},
+                    'unsubscribed': {topic: sorted(chats) for topic, chats in self.opted_out.items()},
+                }, f)
+        except Exception as e:
+            print(f"⚠️ Ошибка сохранения подписок: {e}")
+    
+    def _get(self, topic):
+        defaults = set(self.defaults.get(topic, ())) - self.opted_out.get(topic, set())
+        return defaults | self.topics.get(topic, set())
+    
+    def get(self, topic):
+        with self.lock:
+            return self._get(topic)
+    
+    def toggle(self, topic, chat_id):
+        """Подписывает или отписывает чат. Возвращает True, если чат теперь подписан"""
+        with self.lock:
+            chats = self.topics.setdefault(topic, set())
+            opted_out = self.opted_out.setdefault(topic, set())
+            if chat_id in self._get(topic):
+                chats.discard(chat_id)
+                if chat_id in self.defaults.get(topic, ()):
+                    opted_out.add(chat_id)
+                subscribed = False
+            else:
+                opted_out.discard(chat_id)
+                if chat_id not in self.defaults.get(topic, ()):
+                    chats.add(chat_id)
+                subscribed = True
+            self._save()
+            return subscribed
+
+subscriptions = Subscriptions(defaults={'alerts': CURATOR_CHAT_IDS, 'reports': CURATOR_CHAT_IDS})
+
+# ==================== УВЕДОМЛЕНИЯ О ПРОГУЛАХ ====================
+class AbsenceTracker:
+    """Счётчики прогулов (UNRESPECTFUL_STATUSES) по студентам: за месяц и по предмету.
+    Базовые значения считаются один раз при старте, дальше счётчики меняются
+    только по событиям записи - без чтения таблицы. Проверка порога - O(1)"""
+    
+    def __init__(self, month_thresholds=ABSENCE_ALERT_MONTH_THRESHOLDS,
+                 subject_thresholds=ABSENCE_ALERT_SUBJECT_THRESHOLDS):
+        self.month_thresholds = month_thresholds
+        self.subject_thresholds = subject_thresholds
+        self.month_counts = {}
+        self.subject_counts = {}
+        self.subjects = {}
+        self.queue = Queue()
+        self.running = False
+        self.load_started = None
+        self.load_finished = None
+        # (дата, пара, студент) -> прогулов в ячейке по начальному чтению;
+        # нужно, чтобы события, пришедшие во время чтения, не учитывались дважды
+        self.loaded_cells = {}
+        schedule_manager.on_reload(self.subjects_changed)
+    
+    def subjects_changed(self):
+        """Расписание перезагружено: названия пар берутся заново"""
+        self.subjects = {}
+    
+    def record_change(self, date_str, lesson, student, old_statuses, new_status):
+        """Событие записи: вызывается из пути сохранения, только ставит событие в очередь"""
+        if not self.running:
+            return
+        old_count = sum(1 for status in old_statuses if status in UNRESPECTFUL_STATUSES)
+        new_count = 1 if new_status in UNRESPECTFUL_STATUSES else 0
+        if old_count != new_count:
+            self.queue.put((time.time(), date_str, int(lesson), student, old_count, new_count))
+    
+    def _subject(self, date, lesson, subgroup):
+        key = (date, lesson, subgroup)
+        if key not in self.subjects:
+            self.subjects[key] = schedule_manager.get_subject(date, lesson, subgroup) or '—'
+        return self.subjects[key]
+    
+    def _keys(self, date_str, lesson, student, roster=None):
+        date = datetime.datetime.strptime(date_str, "%d.%m.%Y").date()
+        roster = roster or cache.get_roster()
+        index = roster.by_name.get(student)
+        subgroup = roster.students[index].subgroup if index is not None else 'all'
+        month_key = (student, date.year, date.month)
+        subject_key = (student, academic_year(date), self._subject(date, lesson, subgroup))
+        return month_key, subject_key
+    
+    def load(self):
+        """Начальные значения счётчиков - единственное полное чтение листа"""
+        self.load_started = time.time()
+        records = cache._safe_call(attendance_sheet.get_all_records)
+        roster = cache.get_roster()
+        loaded_cells = {}
+        for record in records:
+            if record.get('Статус') not in UNRESPECTFUL_STATUSES or not record.get('Студент'):
+                continue
+            date_str = str(record.get('Дата', ''))
+            try:
+                lesson = int(record.get('Пара', 0))
+                month_key, subject_key = self._keys(date_str, lesson, record['Студент'], roster)
+            except ValueError:
+                continue
+            self.month_counts[month_key] = self.month_counts.get(month_key, 0) + 1
+            self.subject_counts[subject_key] = self.subject_counts.get(subject_key, 0) + 1
+            cell = (date_str, lesson, record['Студент'])
+            loaded_cells[cell] = loaded_cells.get(cell, 0) + 1
+        self.loaded_cells = loaded_cells
+        self.load_finished = time.time()
+        print(f"🚨 Счётчики прогулов загружены ({len(self.month_counts)} студенто-месяцев)")
+    
+    def _delta(self, created, date_str, lesson, student, old_count, new_count):
+        """Изменение счётчика от события с учётом начального чтения.
+        Запись до чтения в нём уже есть; запись во время чтения могла попасть
+        в снимок или нет - сверяемся с ячейкой снимка; после чтения - как есть"""
+        if created < self.load_started:
+            return 0
+        if created >= self.load_finished:
+            return new_count - old_count
+        cell = (date_str, lesson, student)
+        delta = new_count - self.loaded_cells.get(cell, 0)
+        self.loaded_cells[cell] = new_count
+        return delta
+    
+    def apply(self, date_str, lesson, student, delta):
+        """Обновляет счётчики и возвращает тексты уведомлений о пересечённых порогах"""
+        month_key, subject_key = self._keys(date_str, lesson, student)
+        alerts = []
+        
+        old = self.month_counts.get(month_key, 0)
+        new = old + delta
+        self.month_counts[month_key] = new
+        for threshold in self.month_thresholds:
+            if old < threshold <= new:
+                alerts.append(f"🚨 *{student}*: {new} прогулов за {month_key[2]:02d}.{month_key[1]}")
+        
+        old = self.subject_counts.get(subject_key, 0)
+        new = old + delta
+        self.subject_counts[subject_key] = new
+        for threshold in self.subject_thresholds:
+            if old < threshold <= new:
+                alerts.append(f"🚨 *{student}*: {new} прогулов по предмету «{subject_key[2]}»")
+        
+        return alerts
+    
+    def notify(self, alerts):
+        for chat_id in subscriptions.get('alerts'):
+            for text in alerts:
+                outbox.send_message(chat_id, text, parse_mode='Markdown')
+        for text in alerts:
+            print(text)
+    
+    def _run(self):
+        while True:
+            try:
+                if self.load_finished is None:
+                    self.load()
+                created, date_str, lesson, student, old_count, new_count = self.queue.get()
+                delta = self._delta(created, date_str, lesson, student, old_count, new_count)
+                if not delta:
+                    continue
+                alerts = self.apply(date_str, lesson, student, delta)
+                if alerts:
+                    self.notify(alerts)
+            except Exception as e:
+                print(f"⚠️ Ошибка обработки прогулов: {e}")
+                if self.load_finished is None:
+                    time.sleep(60)
+    
+    def start(self):
+        self.running = True
+        Thread(target=self._run, name='absence-tracker', daemon=True).start()
+
+absence_tracker = AbsenceTracker()
+
+@bot.message_handler(commands=['alerts'])
+@instrumented
+def toggle_alerts(message):
+    if subscriptions.toggle('alerts', message.chat.id):
+        outbox.send_message(message.chat.id,
+                           "🚨 *Уведомления о прогулах включены*\n\n"
+                           f"За месяц: {', '.join(map(str, ABSENCE_ALERT_MONTH_THRESHOLDS))} прогулов\n"
+                           f"По предмету: {', '.join(map(str, ABSENCE_ALERT_SUBJECT_THRESHOLDS))} прогулов\n\n"
+                           "Отключить: /alerts",
+                           parse_mode='Markdown')
+    else:
+        outbox.send_message(message.chat.id, "🔕 Уведомления о прогулах отключены")
+
+# ==================== СОХРАНЕНИЕ ЗАПИСИ ====================
+# ==================== ЗАПИСЬ В ЖУРНАЛ ====================
+class WriteConflict(Exception):
+    """Лист менялся быстрее, чем удавалось найти нужные строки"""
+
+id_header_lock = Lock()
+id_header_checked = False
+
+def ensure_id_header():
+    """Один раз за запуск подписывает столбец ID, если он ещё без заголовка"""
+    global id_header_checked
+    with id_header_lock:
+        if id_header_checked:
+            return
+        header = cache._safe_call(attendance_sheet.get, f"A1:{ATTENDANCE_ID_COLUMN}1")
+        header = header[0] if header else []
+        if len(header) < 8 or not header[7]:
+            cache._safe_call(attendance_sheet.update, f"{ATTENDANCE_ID_COLUMN}1", [['ID']])
+        id_header_checked = True
+
+def attendance_row(date, lesson, student, status, reason, time_now):
+    """Новая строка журнала с уникальным ID (префикс не даёт Sheets принять ID за число)"""
+    ensure_id_header()
+    return [date, lesson, GROUP_NAME, student, status, reason, time_now, f"r{uuid.uuid4().hex[:12]}"]
+
+def _trimmed(row):
+    values = [str(value) for value in row]
+    while values and values[-1] == '':
+        values.pop()
+    return values
+
+def _row_id(row):
+    values = _trimmed(row)
+    return values[7] if len(values) > 7 else ''
+
+def row_matches(row, expected):
+    """Та же ли это строка: по ID, а у старых строк без ID - по всему содержимому"""
+    if _row_id(expected):
+        return _row_id(row) == _row_id(expected)
+    return _trimmed(row) == _trimmed(expected)
+
+def locate_rows(rows):
+    """Новые позиции строк после изменения листа, без чтения всего листа:
+    строки с ID ищутся по столбцу ID, старые строки без ID - в окне
+    WRITE_CONFLICT_WINDOW вокруг прежнего места, а не нашедшиеся в окне - среди строк
+    того же студента. Строки, которых нет нигде, считаются уже удалёнными"""
+    relocated = []
+    with_id = [(row_num, expected) for row_num, expected in rows if _row_id(expected)]
+    without_id = [(row_num, expected) for row_num, expected in rows if not _row_id(expected)]
+    
+    if with_id:
+        id_column = gspread.utils.column_letter_to_index(ATTENDANCE_ID_COLUMN)
+        positions = {}
+        for i, value in enumerate(cache._safe_call(attendance_sheet.col_values, id_column)):
+            if i > 0 and value:
+                positions.setdefault(value, i + 1)
+        for row_num, expected in with_id:
+            if _row_id(expected) in positions:
+                relocated.append((positions[_row_id(expected)], expected))
+    
+    if without_id:
+        first = max(2, min(row_num for row_num, expected in without_id) - WRITE_CONFLICT_WINDOW)
+        last = max(row_num for row_num, expected in without_id) + WRITE_CONFLICT_WINDOW
+        window = cache._safe_call(attendance_sheet.get, f"A{first}:{ATTENDANCE_ID_COLUMN}{last}")
+        taken = set()
+        missing = []
+        for row_num, expected in without_id:
+            for i, row in enumerate(window):
+                if first + i not in taken and row_matches(row, expected):
+                    taken.add(first + i)
+                    relocated.append((first + i, expected))
+                    break
+            else:
+                missing.append(expected)
+        
+        if missing:
+            # Строка уехала дальше окна: ищем по столбцу студентов и читаем только его строки,
+            # иначе старая отметка осталась бы рядом с новой
+            students = cache._safe_call(attendance_sheet.col_values, 4)
+            names = {str(expected[3]) for expected in missing}
+            candidates = [i + 1 for i, name in enumerate(students)
+                          if i > 0 and name in names and i + 1 not in taken]
+            if candidates:
+                values = cache._safe_call(attendance_sheet.batch_get,
+                                          [f"A{row_num}:{ATTENDANCE_ID_COLUMN}{row_num}" for row_num in candidates])
+                for expected in missing:
+                    for row_num, found in zip(candidates, values):
+                        if row_num not in taken and row_matches(found[0] if found else [], expected):
+                            taken.add(row_num)
+                            relocated.append((row_num, expected))
+                            break
+    return relocated
+
+def delete_rows_checked(rows):
+    """Удаляет строки журнала с проверкой (compare-and-swap).
+    rows - список (номер строки, прочитанное содержимое). Перед удалением строки
+    перечитываются точечно (один batch_get); если на месте хотя бы одной уже другая,
+    позиции ищутся заново (locate_rows). Строки, которых уже нет, считаются удалёнными"""
+    pending = sorted(rows, key=lambda item: item[0], reverse=True)
+    for attempt in range(WRITE_CONFLICT_RETRIES + 1):
+        if not pending:
+            return
+        ranges = [f"A{row_num}:{ATTENDANCE_ID_COLUMN}{row_num}" for row_num, expected in pending]
+        current = cache._safe_call(attendance_sheet.batch_get, ranges)
+        if all(row_matches(values[0] if values else [], expected)
+               for values, (row_num, expected) in zip(current, pending)):
+            # Снизу вверх: удаление не сдвигает ещё не удалённые строки
+            for row_num, expected in pending:
+                cache._safe_call(attendance_sheet.delete_rows, row_num)
+            return
+        
+        metrics.inc('write_conflicts', 'attendance')
+        if attempt == WRITE_CONFLICT_RETRIES:
+            break
+        print(f"⚠️ Лист изменился во время записи, ищем строки заново (попытка {attempt + 1})")
+        pending = sorted(locate_rows(pending), key=lambda item: item[0], reverse=True)
+    raise WriteConflict(f"не удалось удалить {len(pending)} строк: лист постоянно меняется")
+
+def write_attendance_record(date, lesson_list, student, status, reason, old_statuses=None):
+    """Перезаписывает отметку студента на парах: старые строки удаляются, новые добавляются.
+    Повторный вызов с теми же аргументами приводит лист к тому же состоянию.
+    old_statuses - {пара (строкой): статусы до записи}. Пустой словарь заполняется
+    до первого изменения листа; повтор прерванной записи берёт статусы из него,
+    а не из листа, где старые строки уже могли быть удалены"""
+    records = cache._safe_call(attendance_sheet.get_all_values)
+    
+    rows_to_delete = []
+    rows_to_add = []
+    found_statuses = {}
+    
+    for lesson in lesson_list:
+        # Всегда удаляем старые записи для этого студента на эту дату и пару
+        found_statuses[str(lesson)] = []
+        for i, row in enumerate(records):
+            if (i > 0 and len(row) >= 4 and
+                str(row[0]) == date and
+                str(row[1]) == str(lesson) and
+                str(row[3]) == student):
+                rows_to_delete.append((i + 1, row))
+                found_statuses[str(lesson)].append(row[4] if len(row) > 4 else '')
+        
+        time_now = datetime.datetime.now().strftime("%H:%M")
+        rows_to_add.append(attendance_row(date, lesson, student, status, reason, time_now))
+    
+    if old_statuses is None:
+        old_statuses = found_statuses
+    elif not old_statuses:
+        old_statuses.update(found_statuses)
+    
+    if rows_to_delete:
+        delete_rows_checked(rows_to_delete)
+        print(f"🗑️ Удалено {len(rows_to_delete)} записей")
+    
+    if rows_to_add:
+        for row in rows_to_add:
+            cache._safe_call(attendance_sheet.append_row, row)
+        print(f"📝 Добавлено {len(rows_to_add)} записей")
+    
+    for lesson in lesson_list:
+        cache.clear_attendance_cache(date, lesson)
+        absence_tracker.record_change(date, lesson, student, old_statuses.get(str(lesson), []), status)
+    report_cache.invalidate(date)
+    
+    return len(rows_to_add)
+
+def save_attendance_record(date, lessons, student, status, reason, force_overwrite=True, chat_id=None):
+    """Сохраняет запись о посещении для одной или нескольких пар
+    Если force_overwrite=True, удаляет старые записи перед сохранением.
+    При закрытой квоте запись уходит в очередь отложенных и выполнится в фоне.
+    Возвращает True - запись в листе, False - в очереди, None - ошибка"""
+    try:
+        if isinstance(lessons, (list, set)):
+            lesson_list = sorted(lessons)
+        else:
+            lesson_list = [lessons]
+        
+        # Словарь старых статусов заполнится при первой попытке и уйдёт в очередь вместе с записью
+        return deferred_writes.run_or_defer('save', [date, lesson_list, student, status, reason, {}], chat_id)
+    except Exception as e:
+        print(f"❌ Ошибка сохранения: {e}")
+        return None
+
+def commit_attendance_rows(rows):
+    """Пакетно добавляет новые строки журнала и учитывает их в прогулах и кэше отчётов"""
+    cache._safe_call(attendance_sheet.append_rows, rows, value_input_option='RAW')
+    print(f"📝 Добавлено {len(rows)} записей одним запросом")
+    for row in rows:
+        absence_tracker.record_change(row[0], row[1], row[3], [], row[4])
+    for date_str in {row[0] for row in rows}:
+        report_cache.invalidate(date_str)
+
+def _to_lesson(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def fill_unmarked(date, lessons, students, status, reason='-', chat_id=None):
+    """Ставит статус всем студентам без отметки на выбранных парах.
+    Одно чтение листа, одна пакетная запись; кэш пар обновляется без перечитывания.
+    Возвращает (число добавленных записей, True - они уже в листе / False - в очереди)"""
+    records = cache._safe_call(attendance_sheet.get_all_values)
+    
+    marks = {lesson: {} for lesson in lessons}
+    for row in records[1:]:
+        if len(row) >= 4 and str(row[0]) == date:
+            lesson_marks = marks.get(_to_lesson(row[1]))
+            if lesson_marks is not None and row[3]:
+                lesson_marks[row[3]] = {
+                    'status': row[4] if len(row) > 4 else '',
+                    'reason': row[5] if len(row) > 5 else ''
+                }
+    
+    time_now = datetime.datetime.now().strftime("%H:%M")
+    rows_to_add = []
+    for lesson in sorted(lessons):
+        for student in students:
+            if student.name not in marks[lesson]:
+                rows_to_add.append(attendance_row(date, lesson, student.name, status, reason, time_now))
+                marks[lesson][student.name] = {'status': status, 'reason': reason}
+    
+    written = True
+    if rows_to_add:
+        written = deferred_writes.run_or_defer('append', [rows_to_add], chat_id)
+    
+    # В кэш - итоговые отметки, даже если сама запись отложена
+    for lesson in lessons:
+        cache.store_attendance(date, lesson, marks[lesson])
+    
+    return len(rows_to_add), written
+
+# ==================== ОТЛОЖЕННЫЕ ЗАПИСИ ====================
+def append_missing_rows(rows):
+    """Пакетная запись, повторяемая после перезапуска: строки, чей ID уже есть в листе, пропускаются"""
+    id_column = gspread.utils.column_letter_to_index(ATTENDANCE_ID_COLUMN)
+    existing = set(cache._safe_call(attendance_sheet.col_values, id_column))
+    missing = [row for row in rows if row[7] not in existing]
+    if missing:
+        commit_attendance_rows(missing)
+
+def describe_write(kind, args):
+    """Краткое описание записи для сообщения пользователю"""
+    if kind == 'save':
+        date, lesson_list, student, status = args[:4]
+        return f"{student}, {date}, пары {', '.join(map(str, lesson_list))} - {status}"
+    rows = args[0]
+    dates = sorted({row[0] for row in rows})
+    return f"{len(rows)} отметок за {', '.join(dates)}"
+
+# Операции, которые можно отложить: аргументы - только JSON-совместимые значения
+DEFERRED_OPERATIONS = {
+    'save': write_attendance_record,
+    'append': commit_attendance_rows,
+    'append_missing': append_missing_rows,
+}
+
+class DeferredWrites:
+    """Очередь записей, которые не дождались квоты в обработчике.
+    Выполняются по порядку в фоновом потоке, который ждёт квоту сколько нужно.
+    Пока очередь не пуста, новые записи тоже встают в неё, чтобы не обогнать старые"""
+    
+    def __init__(self):
+        self.jobs = deque()
+        # Записи, которые прямо сейчас выполняются в обработчиках (не через очередь)
+        self.active = {}
+        self.condition = Condition()
+        self.stopped = False
+    
+    def pending(self):
+        with self.condition:
+            return len(self.jobs)
+    
+    def submit(self, kind, args, chat_id=None):
+        """chat_id - чат, которому сообщить, если запись в итоге не удастся"""
+        with self.condition:
+            self.jobs.append({'kind': kind, 'args': args, 'attempts': 0, 'chat_id': chat_id})
+            metrics.inc('writes_deferred', kind)
+            metrics.set_gauge('deferred_writes', 'sheets', len(self.jobs))
+            self.condition.notify()
+    
+    def run_or_defer(self, kind, args, chat_id=None):
+        """Выполняет запись сразу или ставит в очередь. True - запись уже в листе"""
+        if not self.pending():
+            job = {'kind': kind, 'args': args, 'attempts': 0, 'chat_id': chat_id}
+            with self.condition:
+                self.active[id(job)] = job
+            try:
+                DEFERRED_OPERATIONS[kind](*args)
+                return True
+            except QuotaExceeded as e:
+                print(f"⏳ {e}: запись отложена")
+            finally:
+                with self.condition:
+                    del self.active[id(job)]
+                    self.condition.notify_all()
+        self.submit(kind, args, chat_id)
+        return False
+    
+    def _run(self):
+        sheets_quota.wait_without_limit()
+        while True:
+            with self.condition:
+                while not self.jobs or self.stopped:
+                    self.condition.wait()
+                job = self.jobs[0]
+            try:
+                DEFERRED_OPERATIONS[job['kind']](*job['args'])
+            except Exception as e:
+                if isinstance(e, QuotaExceeded) or quota_retry_after(e) is not None:
+                    # Квота не повод терять отметки: ждём, пока Google её откроет
+                    print(f"⏳ Отложенная запись ждёт квоту: {e}")
+                    sheets_quota.wait_open()
+                    continue
+                job['attempts'] += 1
+                if job['attempts'] < DEFERRED_WRITE_ATTEMPTS:
+                    print(f"⚠️ Отложенная запись не прошла ({job['attempts']}/{DEFERRED_WRITE_ATTEMPTS}): {e}")
+                    time.sleep(DEFERRED_RETRY_DELAY)
+                    continue
+                print(f"❌ Отложенная запись отброшена: {e}")
+                metrics.inc('writes_dropped', job['kind'])
+                self._report_dropped(job, e)
+            with self.condition:
+                self.jobs.popleft()
+                metrics.set_gauge('deferred_writes', 'sheets', len(self.jobs))
+                self.condition.notify_all()
+    
+    def _report_dropped(self, job, error):
+        """Сообщает чату, от которого пришла запись, что она не попала в лист"""
+        if job.get('chat_id') is None:
+            return
+        outbox.send_message(job['chat_id'],
+                           f"❌ Не удалось записать отметки: {describe_write(job['kind'], job['args'])}\n"
+                           f"Ошибка: {error}\n\n"
+                           f"Проверьте эти пары и отметьте заново")
+    
+    def wait_idle(self, timeout=None):
+        """Ждёт, пока очередь и записи в обработчиках закончатся. False - не успели за timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.jobs and not self.active, timeout)
+    
+    def snapshot(self):
+        """Незаконченные записи по порядку: сначала начатые в обработчиках, затем очередь.
+        Начатая запись могла успеть дойти до листа - при повторе это учитывается"""
+        with self.condition:
+            return [{'kind': job['kind'], 'args': job['args'], 'chat_id': job.get('chat_id')}
+                    for job in list(self.active.values()) + list(self.jobs)]
+    
+    def stop(self):
+        """Поток больше не берёт записи из очереди; начатая остаётся в очереди до конца,
+        поэтому попадает в snapshot() и повторяется после перезапуска"""
+        with self.condition:
+            self.stopped = True
+    
+    def restore(self, jobs):
+        for job in jobs:
+            # Пакет строк мог быть записан до остановки: повторяется только то, чего нет в листе
+            kind = 'append_missing' if job['kind'] == 'append' else job['kind']
+            self.submit(kind, job['args'], job.get('chat_id'))
+    
+    def start(self):
+        Thread(target=self._run, name='deferred-writes', daemon=True).start()
+
+deferred_writes = DeferredWrites()
+
+# ==================== ПРИМЕНЕНИЕ БОЛЬНИЧНОГО НА ПЕРИОД ====================
+def apply_sick_leave(user, student_name, start_date, end_date, chat_id=None):
+    """Применяет статус 'Болел' ко всем парам в указанном диапазоне,
+    перезаписывая любые предыдущие отметки.
+    Возвращает (сохранено пар, из них ждут в очереди)"""
+    lessons_in_range = schedule_manager.get_lessons_in_range(
+        start_date, end_date, user['selected_subgroup']
+    )
+    
+    updated_count = 0
+    queued_count = 0
+    for lesson in lessons_in_range:
+        # Сохраняем с force_overwrite=True, чтобы перезаписать старые отметки
+        written = save_attendance_record(
+            lesson['date'].strftime("%d.%m.%Y"),
             [lesson['lesson']],
             student_name,
             'Болел',
             '-',
-            force_overwrite=True
+            force_overwrite=True,
+            chat_id=chat_id
         )
-        updated_count += 1
+        if written is not None:
+            updated_count += 1
+        if written is False:
+            queued_count += 1
     
-    return updated_count
+    return updated_count, queued_count
 
 @bot.callback_query_handler(func=lambda call: call.data == 'sick_leave')
+@instrumented
 def sick_leave_period(call):
     user = get_user_data(call.message.chat.id)
     
     if not user.get('selected_students'):
-        bot.answer_callback_query(call.id, "❌ Сначала выберите студентов")
+        outbox.answer_callback_query(call.id, "❌ Сначала выберите студентов")
         return
     
-    msg = bot.send_message(
+    outbox.send_message(
         call.message.chat.id,
         f"📅 *Введите период больничного*\n\n"
         f"Формат: `ДД.ММ.ГГГГ-ДД.ММ.ГГГГ`\n"
         f"Пример: `01.03.2026-10.03.2026`\n\n"
-        f"👥 Будет применено для {len(user['selected_students'])} студентов\n"
+        f"👥 Будет применено для {len(get_selected_students(user))} студентов\n"
         f"📊 Система автоматически перезапишет все отметки в этом периоде на 'Болел'"
     )
-    bot.register_next_step_handler(msg, process_sick_leave)
+    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_sick_leave)
 
+@instrumented
+@idempotent
 def process_sick_leave(message):
     user = get_user_data(message.chat.id)
     
@@ -1064,45 +2951,48 @@ def process_sick_leave(message):
         end_date = datetime.datetime.strptime(date_str[1].strip(), "%d.%m.%Y").date()
         
         if end_date < start_date:
-            bot.send_message(message.chat.id, "❌ Конечная дата раньше начальной!")
+            outbox.send_message(message.chat.id, "❌ Конечная дата раньше начальной!")
             return
         
         total_updated = 0
-        for idx in user['selected_students']:
-            student_name = get_student_by_index(user, idx)
-            if student_name:
-                updated = apply_sick_leave(user, student_name, start_date, end_date)
-                total_updated += updated
+        total_queued = 0
+        selected = get_selected_students(user)
+        for student in selected:
+            updated, queued = apply_sick_leave(user, student.name, start_date, end_date, message.chat.id)
+            total_updated += updated
+            total_queued += queued
         
         # Очищаем кэш отметок
         cache.clear_attendance_cache()
         
         # Формируем сообщение о результате
         day_count = (end_date - start_date).days + 1
-        lessons_count = total_updated // len(user['selected_students']) if user['selected_students'] else 0
+        lessons_count = total_updated // len(selected) if selected else 0
         
-        bot.send_message(
+        outbox.send_message(
             message.chat.id,
             f"✅ *Больничный применён*\n\n"
-            f"👥 *Студентов:* {len(user['selected_students'])}\n"
+            f"👥 *Студентов:* {len(selected)}\n"
             f"📅 *Период:* {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}\n"
             f"📆 *Дней в периоде:* {day_count}\n"
             f"📊 *Всего обновлено отметок:* {total_updated}\n"
             f"📌 *Пар на студента:* {lessons_count}"
+            + (f"\n\n⏳ Из них {total_queued} запишутся, как только Google снимет ограничение"
+               if total_queued else "")
         )
         
         # Очищаем выбор
-        user['selected_students'] = set()
+        user['selected_students'] = 0
         
         # Предлагаем перейти к следующей неотмеченной
         offer_next_unmarked(message.chat.id, user)
         
     except ValueError as e:
-        bot.send_message(message.chat.id, 
-                        "❌ Неверный формат! Используйте: `ДД.ММ.ГГГГ-ДД.ММ.ГГГГ`\n"
-                        "Пример: `01.03.2026-10.03.2026`")
+        outbox.send_message(message.chat.id, 
+                           "❌ Неверный формат! Используйте: `ДД.ММ.ГГГГ-ДД.ММ.ГГГГ`\n"
+                           "Пример: `01.03.2026-10.03.2026`")
     except Exception as e:
-        bot.send_message(message.chat.id, f"❌ Ошибка: {e}")
+        outbox.send_message(message.chat.id, f"❌ Ошибка: {e}")
 
 # ==================== ПРЕДЛОЖЕНИЕ СЛЕДУЮЩЕЙ ПАРЫ ====================
 def offer_next_unmarked(chat_id, user):
@@ -1134,7 +3024,7 @@ def offer_next_unmarked(chat_id, user):
             )
         )
         
-        bot.send_message(
+        outbox.send_message(
             chat_id,
             f"📅 *Следующая неотмеченная пара:*\n"
             f"{next_lesson['date'].strftime('%d.%m')} ({day_name}) "
@@ -1144,15 +3034,16 @@ def offer_next_unmarked(chat_id, user):
         )
 
 @bot.callback_query_handler(func=lambda call: call.data == 'cancel_next')
+@instrumented
 def cancel_next(call):
-    bot.answer_callback_query(call.id, "❌ Отменено")
-    bot.delete_message(call.message.chat.id, call.message.message_id)
+    outbox.answer_callback_query(call.id, "❌ Отменено")
+    outbox.delete_message(call.message.chat.id, call.message.message_id)
 
 # ==================== СОЗДАНИЕ КЛАВИАТУРЫ СТУДЕНТОВ ====================
 def create_students_markup(students, existing_marks, page, selected_students):
     markup = telebot.types.InlineKeyboardMarkup(row_width=2)
     
-    selected_count = len(selected_students)
+    selected_count = (selected_students & selection_mask(students)).bit_count()
     
     if selected_count > 0:
         # Первая строка: ✅ и ❌
@@ -1200,34 +3091,33 @@ def create_students_markup(students, existing_marks, page, selected_students):
     
     for idx_in_list in range(start, end):
         student = students[idx_in_list]
-        if len(student) >= 2:
-            student_name = student[1]
-            
-            if student_name in existing_marks:
-                status_info = existing_marks[student_name]
-                status_text = status_info['status']
-                status_emoji = '❓'
-                for code, info in STATUSES.items():
-                    if info['text'] == status_text:
-                        status_emoji = info['emoji']
-                        break
-                if status_info.get('reason') and status_info['reason'] != '-':
-                    status_emoji = f"{status_emoji}📝"
-            else:
-                status_emoji = '⬜'
-            
-            checkbox = "☑️" if idx_in_list in selected_students else "◻️"
-            
-            display_name = student_name
-            if len(display_name) > 12:
-                display_name = display_name[:12] + "…"
-            
-            markup.add(
-                telebot.types.InlineKeyboardButton(
-                    f"{checkbox} {status_emoji} {display_name}",
-                    callback_data=f"toggle_{idx_in_list}"
-                )
+        student_name = student.name
+        
+        if student_name in existing_marks:
+            status_info = existing_marks[student_name]
+            status_text = status_info['status']
+            status_emoji = '❓'
+            for code, info in STATUSES.items():
+                if info['text'] == status_text:
+                    status_emoji = info['emoji']
+                    break
+            if status_info.get('reason') and status_info['reason'] != '-':
+                status_emoji = f"{status_emoji}📝"
+        else:
+            status_emoji = '⬜'
+        
+        checkbox = "☑️" if student.bit & selected_students else "◻️"
+        
+        display_name = student_name
+        if len(display_name) > 12:
+            display_name = display_name[:12] + "…"
+        
+        markup.add(
+            telebot.types.InlineKeyboardButton(
+                f"{checkbox} {status_emoji} {display_name}",
+                callback_data=f"toggle_{student.id}"
             )
+        )
     
     nav_buttons = []
     if page > 0:
@@ -1237,6 +3127,20 @@ def create_students_markup(students, existing_marks, page, selected_students):
     if nav_buttons:
         markup.add(*nav_buttons)
     
+    markup.add(
+        telebot.types.InlineKeyboardButton("✅ Остальные присутствовали", callback_data="rest_present")
+    )
+    
+    # Массовый выбор: одно нажатие - одна перерисовка
+    markup.add(
+        telebot.types.InlineKeyboardButton("☑️ Страницу", callback_data="select_page"),
+        telebot.types.InlineKeyboardButton("☑️ Всех", callback_data="select_all")
+    )
+    markup.add(
+        telebot.types.InlineKeyboardButton("🔄 Инвертировать", callback_data="select_invert"),
+        telebot.types.InlineKeyboardButton("⬜ Неотмеченных", callback_data="select_unmarked")
+    )
+    
     markup.add(
         telebot.types.InlineKeyboardButton("❌ Снять все выборы", callback_data="clear_selection"),
         telebot.types.InlineKeyboardButton("🔄 Обновить", callback_data="refresh_list")
@@ -1253,7 +3157,7 @@ def show_students_list_with_checkboxes(chat_id, students, existing_marks, page=N
     user = get_user_data(chat_id)
     
     if 'selected_students' not in user:
-        user['selected_students'] = set()
+        user['selected_students'] = 0
     
     if page is None:
         page = user.get('current_page', 0)
@@ -1273,7 +3177,7 @@ def show_students_list_with_checkboxes(chat_id, students, existing_marks, page=N
     
     markup = create_students_markup(students, existing_marks, page, user['selected_students'])
     
-    selected_count = len(user['selected_students'])
+    selected_count = len(get_selected_students(user))
     selected_text = f"✅ *Выбрано:* {selected_count} студентов\n" if selected_count > 0 else ""
     
     lessons_text = ""
@@ -1286,7 +3190,7 @@ def show_students_list_with_checkboxes(chat_id, students, existing_marks, page=N
     # Добавляем прогресс за день
     day_progress = f"📊 Прогресс за день: {len(selected_lessons)} из {len(selected_lessons)} пар\n" if selected_lessons else ""
     
-    bot.send_message(
+    outbox.send_message(
         chat_id,
         f"📝 *ОТМЕТКА ПОСЕЩАЕМОСТИ*\n\n"
         f"👥 *Группа:* {GROUP_NAME}\n"
@@ -1304,33 +3208,33 @@ def show_students_list_with_checkboxes(chat_id, students, existing_marks, page=N
         reply_markup=markup
     )
 
-# ==================== БЕЗОПАСНОЕ ПОЛУЧЕНИЕ СТУДЕНТА ====================
-def get_student_by_index(user, idx):
-    if 'students_list' not in user:
-        return None
-    if idx >= len(user['students_list']):
-        return None
-    if len(user['students_list'][idx]) < 2:
-        return None
-    return user['students_list'][idx][1]
+# ==================== ВЫБРАННЫЕ СТУДЕНТЫ ====================
+def get_selected_students(user, mask=None):
+    """Выбранные студенты текущего списка. Выбор - битовая маска по ID студентов,
+    студенты, которых больше нет в списке, просто не попадают в результат"""
+    if mask is None:
+        mask = user.get('selected_students', 0)
+    return [student for student in user.get('students_list', ()) if student.bit & mask]
 
 # ==================== ОБРАБОТЧИКИ ДЛЯ ОТМЕТКИ ====================
 @bot.callback_query_handler(func=lambda call: call.data.startswith('toggle_'))
+@instrumented
 def toggle_student(call):
     user = get_user_data(call.message.chat.id)
-    idx = int(call.data.split('_')[1])
+    sid = call.data.split('_', 1)[1]
+    # Кнопка могла остаться от другого списка (другая подгруппа или старое сообщение)
+    bit = next((student.bit for student in user.get('students_list', ()) if student.id == sid), 0)
     
-    if idx >= len(user.get('students_list', [])):
-        bot.answer_callback_query(call.id, "❌ Данные устарели, обновите список")
+    if not bit:
+        outbox.answer_callback_query(call.id, "❌ Данные устарели, обновите список")
         refresh_students_list(call.message.chat.id, call.message.message_id)
         return
     
-    if idx in user['selected_students']:
-        user['selected_students'].remove(idx)
-        bot.answer_callback_query(call.id, "❌ Выбор снят")
+    user['selected_students'] = user.get('selected_students', 0) ^ bit
+    if user['selected_students'] & bit:
+        outbox.answer_callback_query(call.id, "✅ Студент выбран")
     else:
-        user['selected_students'].add(idx)
-        bot.answer_callback_query(call.id, "✅ Студент выбран")
+        outbox.answer_callback_query(call.id, "❌ Выбор снят")
     
     students = user.get('students_list', [])
     existing_marks = {}
@@ -1342,11 +3246,43 @@ def toggle_student(call):
     
     update_students_message(call.message.chat.id, call.message.message_id, students, existing_marks)
 
+@bot.callback_query_handler(func=lambda call: call.data in ('select_page', 'select_all', 'select_invert', 'select_unmarked'))
+@instrumented
+def bulk_select(call):
+    """Массовый выбор студентов текущего списка одной битовой операцией"""
+    user = get_user_data(call.message.chat.id)
+    students = user.get('students_list', [])
+    selected = user.get('selected_students', 0)
+    list_mask = selection_mask(students)
+    
+    existing_marks = {}
+    for lesson in user['selected_lessons']:
+        marks = get_existing_marks(user['current_date'], lesson)
+        for student, data in marks.items():
+            if student not in existing_marks:
+                existing_marks[student] = data
+    
+    if call.data == 'select_page':
+        start = user.get('current_page', 0) * ITEMS_PER_PAGE
+        selected |= selection_mask(students[start:start + ITEMS_PER_PAGE])
+    elif call.data == 'select_all':
+        selected |= list_mask
+    elif call.data == 'select_invert':
+        selected = (selected ^ list_mask) & list_mask
+    else:
+        selected = selection_mask(s for s in students if s.name not in existing_marks)
+    
+    user['selected_students'] = selected
+    outbox.answer_callback_query(call.id, f"☑️ Выбрано: {(selected & list_mask).bit_count()}")
+    
+    update_students_message(call.message.chat.id, call.message.message_id, students, existing_marks)
+
 @bot.callback_query_handler(func=lambda call: call.data == 'clear_selection')
+@instrumented
 def clear_selection(call):
     user = get_user_data(call.message.chat.id)
-    user['selected_students'] = set()
-    bot.answer_callback_query(call.id, "❌ Все выборы сняты")
+    user['selected_students'] = 0
+    outbox.answer_callback_query(call.id, "❌ Все выборы сняты")
     
     students = user.get('students_list', [])
     existing_marks = {}
@@ -1362,7 +3298,7 @@ def update_students_message(chat_id, message_id, students, existing_marks):
     user = get_user_data(chat_id)
     
     markup = create_students_markup(students, existing_marks, user['current_page'], user['selected_students'])
-    selected_count = len(user['selected_students'])
+    selected_count = len(get_selected_students(user))
     selected_text = f"✅ *Выбрано:* {selected_count} студентов\n" if selected_count > 0 else ""
     
     lessons_text = ""
@@ -1397,13 +3333,15 @@ def update_students_message(chat_id, message_id, students, existing_marks):
     )
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('quick_'))
+@instrumented
+@idempotent
 def quick_apply_status(call):
     user = get_user_data(call.message.chat.id)
     status_code = call.data.split('_')[1]
     info = STATUSES[status_code]
     
     if not user.get('selected_students'):
-        bot.answer_callback_query(call.id, "❌ Нет выбранных студентов")
+        outbox.answer_callback_query(call.id, "❌ Нет выбранных студентов")
         return
     
     # Только 'valid' требует причины (уважительная причина)
@@ -1411,36 +3349,80 @@ def quick_apply_status(call):
         user['pending_status'] = {
             'status_code': status_code,
             'status_text': info['text'],
-            'students': list(user['selected_students']).copy(),
+            'students': user['selected_students'],
             'callback_message_id': call.message.message_id
         }
         
-        msg = bot.send_message(
+        outbox.send_message(
             call.message.chat.id,
-            f"📝 *Введите причину для {len(user['selected_students'])} студентов:*\n"
+            f"📝 *Введите причину для {len(get_selected_students(user))} студентов:*\n"
             f"Статус: {info['emoji']} {info['text']}\n\n"
             f"Причина будет применена ко всем выбранным студентам."
         )
-        bot.register_next_step_handler(msg, save_reason_for_selected)
+        bot.register_next_step_handler_by_chat_id(call.message.chat.id, save_reason_for_selected)
         return
     
     # Для остальных статусов (present, absent, sick) - без причины
-    for idx in user['selected_students']:
-        student_name = get_student_by_index(user, idx)
-        if student_name:
-            save_attendance_record(
-                user['current_date'],
-                user['selected_lessons'],
-                student_name,
-                info['text'],
-                "-",
-                force_overwrite=True
-            )
+    results = []
+    for student in get_selected_students(user):
+        results.append(save_attendance_record(
+            user['current_date'],
+            user['selected_lessons'],
+            student.name,
+            info['text'],
+            "-",
+            force_overwrite=True,
+            chat_id=call.message.chat.id
+        ))
+    
+    user['selected_students'] = 0
+    if None in results:
+        outbox.answer_callback_query(call.id, f"❌ Сохранено {len(results) - results.count(None)} из {len(results)}, "
+                                              f"проверьте отметки")
+    elif False in results:
+        outbox.answer_callback_query(call.id, f"⏳ Статус '{info['text']}' запишется, как только Google снимет ограничение")
+    else:
+        outbox.answer_callback_query(call.id, f"✅ Статус '{info['text']}' применён")
+    
+    students = user.get('students_list', [])
+    existing_marks = {}
+    for lesson in user['selected_lessons']:
+        marks = get_existing_marks(user['current_date'], lesson)
+        for student, data in marks.items():
+            if student not in existing_marks:
+                existing_marks[student] = data
     
-    user['selected_students'] = set()
-    bot.answer_callback_query(call.id, f"✅ Статус '{info['text']}' применён")
+    update_students_message(call.message.chat.id, call.message.message_id, students, existing_marks)
     
+    # Предлагаем перейти к следующей неотмеченной
+    offer_next_unmarked(call.message.chat.id, user)
+
+@bot.callback_query_handler(func=lambda call: call.data == 'rest_present')
+@instrumented
+@idempotent
+def mark_rest_present(call):
+    """Все, у кого нет отметки на выбранных парах, - 'Присутствовал' (одна запись в лист)"""
+    user = get_user_data(call.message.chat.id)
     students = user.get('students_list', [])
+    
+    if not user.get('selected_lessons') or not students:
+        outbox.answer_callback_query(call.id, "❌ Нет выбранных пар или студентов")
+        return
+    
+    try:
+        added, written = fill_unmarked(user['current_date'], user['selected_lessons'], students,
+                              STATUSES['present']['text'], chat_id=call.message.chat.id)
+    except Exception as e:
+        print(f"❌ Ошибка сохранения: {e}")
+        outbox.answer_callback_query(call.id, "❌ Не удалось сохранить, попробуйте ещё раз")
+        return
+    
+    user['selected_students'] = 0
+    if not written:
+        outbox.answer_callback_query(call.id, f"⏳ Присутствующих: {added}, запишутся, как только Google снимет ограничение")
+    else:
+        outbox.answer_callback_query(call.id, f"✅ Отмечено присутствующих: {added}")
+    
     existing_marks = {}
     for lesson in user['selected_lessons']:
         marks = get_existing_marks(user['current_date'], lesson)
@@ -1453,29 +3435,32 @@ def quick_apply_status(call):
     # Предлагаем перейти к следующей неотмеченной
     offer_next_unmarked(call.message.chat.id, user)
 
+@instrumented
+@idempotent
 def save_reason_for_selected(message):
     user = get_user_data(message.chat.id)
     reason = message.text
     
     if 'pending_status' not in user:
-        bot.send_message(message.chat.id, "❌ Ошибка: данные не найдены")
+        outbox.send_message(message.chat.id, "❌ Ошибка: данные не найдены")
         return
     
     pending = user['pending_status']
     
-    for idx in pending['students']:
-        student_name = get_student_by_index(user, idx)
-        if student_name:
-            save_attendance_record(
-                user['current_date'],
-                user['selected_lessons'],
-                student_name,
-                pending['status_text'],
-                reason,
-                force_overwrite=True
-            )
+    selected = get_selected_students(user, pending['students'])
+    results = []
+    for student in selected:
+        results.append(save_attendance_record(
+            user['current_date'],
+            user['selected_lessons'],
+            student.name,
+            pending['status_text'],
+            reason,
+            force_overwrite=True,
+            chat_id=message.chat.id
+        ))
     
-    user['selected_students'] = set()
+    user['selected_students'] = 0
     del user['pending_status']
     
     subgroup_text = {
@@ -1484,12 +3469,14 @@ def save_reason_for_selected(message):
         '2': 'подгруппа 2'
     }.get(user['selected_subgroup'], 'не выбрана')
     
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
-        f"✅ *Отмечено {len(pending['students'])} студентов*\n"
+        f"✅ *Отмечено {len(results) - results.count(None)} студентов*\n"
         f"👥 {subgroup_text}\n"
         f"📝 *Причина:* {reason}\n"
         f"🔢 *Пары:* {', '.join(map(str, sorted(user['selected_lessons'])))}"
+        + (f"\n\n❌ Не сохранено: {results.count(None)}, попробуйте ещё раз" if None in results else "")
+        + ("\n\n⏳ Запишется, как только Google снимет ограничение" if False in results else "")
     )
     
     students = user.get('students_list', [])
@@ -1505,10 +3492,12 @@ def save_reason_for_selected(message):
     offer_next_unmarked(message.chat.id, user)
 
 @bot.callback_query_handler(func=lambda call: call.data == 'back_to_list')
+@instrumented
 def back_to_list(call):
     refresh_students_list(call.message.chat.id, call.message.message_id)
 
 @bot.callback_query_handler(func=lambda call: call.data == 'refresh_list')
+@instrumented
 def refresh_list(call):
     refresh_students_list(call.message.chat.id, call.message.message_id)
 
@@ -1516,18 +3505,12 @@ def refresh_students_list(chat_id, message_id=None):
     user = get_user_data(chat_id)
     
     try:
-        all_students = cache.get_students()
-        all_students_list = all_students[1:] if len(all_students) > 1 else []
-        
-        if user['selected_subgroup'] != 'all':
-            students = [s for s in all_students_list 
-                       if len(s) >= 3 and str(s[2]) == user['selected_subgroup']]
-        else:
-            students = all_students_list
+        students = cache.get_roster().for_subgroup(user['selected_subgroup'])
         
-        old_selection = user.get('selected_students', set())
+        # Выбор хранится по ID студентов - после обновления списка он остаётся верным;
+        # биты ушедших студентов сбрасываются, их номера могут достаться новым
         user['students_list'] = students
-        user['selected_students'] = {idx for idx in old_selection if idx < len(students)}
+        user['selected_students'] = user.get('selected_students', 0) & selection_mask(students)
         
         existing_marks = {}
         for lesson in user['selected_lessons']:
@@ -1542,15 +3525,16 @@ def refresh_students_list(chat_id, message_id=None):
             show_students_list_with_checkboxes(chat_id, students, existing_marks, user.get('current_page', 0))
         
     except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка обновления: {e}")
+        outbox.send_message(chat_id, f"❌ Ошибка обновления: {e}")
 
 @bot.callback_query_handler(func=lambda call: call.data == 'save_exit')
+@instrumented
 def save_and_exit(call):
     user = get_user_data(call.message.chat.id)
     user['marking_mode'] = False
-    user['selected_students'] = set()
+    user['selected_students'] = 0
     
-    bot.answer_callback_query(call.id, "✅ Данные сохранены")
+    outbox.answer_callback_query(call.id, "✅ Данные сохранены")
     
     selected_lessons = sorted(user['selected_lessons'])
     lessons_text = ", ".join(map(str, selected_lessons)) if selected_lessons else "не выбраны"
@@ -1570,20 +3554,14 @@ def save_and_exit(call):
     offer_next_unmarked(call.message.chat.id, user)
 
 @bot.callback_query_handler(func=lambda call: call.data == 'page_prev')
+@instrumented
 def page_prev(call):
     user = get_user_data(call.message.chat.id)
     current_page = user.get('current_page', 0)
     if current_page > 0:
         students = user.get('students_list', [])
         if not students:
-            all_students = cache.get_students()
-            all_students_list = all_students[1:] if len(all_students) > 1 else []
-            
-            if user['selected_subgroup'] != 'all':
-                students = [s for s in all_students_list 
-                           if len(s) >= 3 and str(s[2]) == user['selected_subgroup']]
-            else:
-                students = all_students_list
+            students = cache.get_roster().for_subgroup(user['selected_subgroup'])
             user['students_list'] = students
         
         existing_marks = {}
@@ -1596,9 +3574,10 @@ def page_prev(call):
         user['current_page'] = current_page - 1
         update_students_message(call.message.chat.id, call.message.message_id, students, existing_marks)
     else:
-        bot.answer_callback_query(call.id, "Вы на первой странице")
+        outbox.answer_callback_query(call.id, "Вы на первой странице")
 
 @bot.callback_query_handler(func=lambda call: call.data == 'page_next')
+@instrumented
 def page_next(call):
     user = get_user_data(call.message.chat.id)
     current_page = user.get('current_page', 0)
@@ -1616,7 +3595,7 @@ def page_next(call):
         user['current_page'] = current_page + 1
         update_students_message(call.message.chat.id, call.message.message_id, students, existing_marks)
     else:
-        bot.answer_callback_query(call.id, "Вы на последней странице")
+        outbox.answer_callback_query(call.id, "Вы на последней странице")
 
 # ==================== ДОБАВЛЕНИЕ СТУДЕНТА ====================
 def save_new_student(message):
@@ -1624,39 +3603,258 @@ def save_new_student(message):
         name = message.text.strip()
         
         if not name:
-            bot.send_message(message.chat.id, "❌ Имя не может быть пустым!")
+            outbox.send_message(message.chat.id, "❌ Имя не может быть пустым!")
             return
         
-        students = students_sheet.get_all_values()
-        for student in students[1:]:
-            if len(student) >= 2 and student[1] == name:
-                bot.send_message(message.chat.id, f"⚠️ Студент '{name}' уже есть в списке!")
-                return
+        if name in cache.get_roster():
+            outbox.send_message(message.chat.id, f"⚠️ Студент '{name}' уже есть в списке!")
+            return
         
         students_sheet.append_row([GROUP_NAME, name])
         cache.clear_students_cache()
         
-        bot.send_message(message.chat.id,
-                        f"✅ *Студент добавлен!*\n\n"
-                        f"👤 *{name}*\n"
-                        f"👥 *Группа:* {GROUP_NAME}",
-                        parse_mode='Markdown')
+        outbox.send_message(message.chat.id,
+                           f"✅ *Студент добавлен!*\n\n"
+                           f"👤 *{name}*\n"
+                           f"👥 *Группа:* {GROUP_NAME}",
+                           parse_mode='Markdown')
         
     except Exception as e:
-        bot.send_message(message.chat.id, f"❌ Ошибка: {e}")
+        outbox.send_message(message.chat.id, f"❌ Ошибка: {e}")
 
 # ==================== ОТЧЁТЫ ====================
 @bot.message_handler(func=lambda message: message.text == '📤 Отчёт')
+@instrumented
 def get_report_menu(message):
     current_month = datetime.date.today().strftime("%m.%Y")
-    msg = bot.send_message(message.chat.id,
-                          f"📅 *Введите месяц и год для отчёта*\n\n"
-                          f"Формат: `ММ.ГГГГ`\n"
-                          f"*Пример:* `{current_month}`\n"
-                          f"Или введите `текущий` для текущего месяца",
-                          parse_mode='Markdown')
-    bot.register_next_step_handler(msg, generate_monthly_report)
+    outbox.send_message(message.chat.id,
+                       f"📅 *Введите месяц и год для отчёта*\n\n"
+                       f"Формат: `ММ.ГГГГ`\n"
+                       f"*Пример:* `{current_month}`\n"
+                       f"Или введите `текущий` для текущего месяца",
+                       parse_mode='Markdown')
+    bot.register_next_step_handler_by_chat_id(message.chat.id, generate_monthly_report)
+
+def build_monthly_report(month, year):
+    """Строит месячный отчёт (xlsx). Возвращает словарь с файлом и подписью
+    или None, если за месяц нет данных.
+    
+    Отчёт считается по матрице посещаемости, а не по строкам листа:
+    - одна пара студента - одно занятие; если пару отметили несколько раз,
+      учитывается последняя запись ('Всего занятий' не растёт от повторных строк);
+    - статус, которого нет в STATUSES, показывается как ❓ и входит
+      во 'Всего занятий', но не в столбцы статусов"""
+    # Тяжёлые библиотеки нужны только для отчётов - импортируем при первом использовании
+    import pandas as pd
+    from openpyxl.utils import get_column_letter
+    from openpyxl.styles import PatternFill, Font, Alignment
+    
+    month_year = f"{month:02d}.{year}"
+    
+    records = cache._safe_call(attendance_sheet.get_all_records)
+    if not records:
+        return None
+    
+    all_students = list(cache.get_roster().names)
+    
+    # Студенты из списка идут первыми строками матрицы
+    matrix = build_attendance_matrix(records, all_students).month(year, month)
+    if not matrix.marked_slots():
+        return None
+    matrix = matrix.select_students(all_students)
+    
+    # ЛИСТ ПОСЕЩАЕМОСТИ: статус самой ранней отмеченной пары дня
+    days, day_status = matrix.first_mark_per_day()
+    all_dates = [day.strftime('%d.%m.%Y') for day in days]
+    status_emojis = [''] + [info['emoji'] for info in STATUSES.values()] + ['❓']
+    
+    df_attendance = pd.DataFrame(
+        [[status_emojis[code] for code in row] for row in day_status],
+        columns=all_dates
+    )
+    df_attendance.insert(0, 'Студент', all_students)
+    
+    # ЛИСТ СТАТИСТИКИ: последний столбец counts - неизвестные статусы (❓)
+    counts = matrix.counts_by_student()
+    
+    df_stats = pd.DataFrame({
+        'Студент': all_students,
+        'Всего занятий': counts.sum(axis=1),
+        '✅ Присутствовал': counts[:, 0],
+        '❌ ПРОГУЛЫ': counts[:, 1],
+        '🤒 Болел': counts[:, 2],
+        '📄 Уважительная причина': counts[:, 3],
+        '% посещения': matrix.attendance_rate(counts)
+    })
+    
+    # Причины берутся из записей за месяц
+    df = pd.DataFrame(records)
+    df['Дата'] = pd.to_datetime(df['Дата'], format='%d.%m.%Y', errors='coerce')
+    filtered = df[(df['Дата'].dt.month == month) & (df['Дата'].dt.year == year)]
+    
+    # СОЗДАНИЕ EXCEL
+    output = BytesIO()
+    
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df_attendance.to_excel(writer, sheet_name='Посещаемость', index=False)
+        df_stats.to_excel(writer, sheet_name='Статистика', index=False)
+    
+        reasons_df = filtered[filtered['Причина'] != '-']
+        if not reasons_df.empty:
+            reasons_df = reasons_df[['Дата', 'Пара', 'Студент', 'Статус', 'Причина']]
+            reasons_df.to_excel(writer, sheet_name='Причины', index=False)
+    
+        workbook = writer.book
+        worksheet_stats = writer.sheets['Статистика']
+    
+        # НАСТРОЙКА ШИРИНЫ СТОЛБЦОВ
+        worksheet_stats.column_dimensions['A'].width = 25
+        worksheet_stats.column_dimensions['B'].width = 15
+        worksheet_stats.column_dimensions['C'].width = 18
+        worksheet_stats.column_dimensions['D'].width = 15
+        worksheet_stats.column_dimensions['E'].width = 12
+        worksheet_stats.column_dimensions['F'].width = 20
+        worksheet_stats.column_dimensions['G'].width = 15
+    
+        # ЦВЕТОВАЯ ИНДИКАЦИЯ
+        green_fill = PatternFill(start_color='FFFFFF', end_color='FFFFFF', fill_type='solid')
+        yellow_fill = PatternFill(start_color='FFFF00', end_color='FFFF00', fill_type='solid')
+        red_fill = PatternFill(start_color='FF0000', end_color='FF0000', fill_type='solid')
+    
+        for row in range(2, len(df_stats) + 2):
+            cell = worksheet_stats.cell(row=row, column=4)
+            if cell.value is not None:
+                if cell.value == 0:
+                    cell.fill = green_fill
+                elif cell.value <= 10:
+                    cell.fill = yellow_fill
+                else:
+                    cell.fill = red_fill
+    
+        # ЗАГОЛОВКИ
+        header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
+        header_font = Font(color='FFFFFF', bold=True)
+    
+        for col in range(1, 8):
+            col_letter = get_column_letter(col)
+            cell = worksheet_stats[f'{col_letter}1']
+            cell.fill = header_fill
+            cell.font = header_font
+            cell.alignment = Alignment(horizontal='center')
+    
+        worksheet_stats.auto_filter.ref = worksheet_stats.dimensions
+    
+    output.seek(0)
+    
+    total_unexcused = df_stats['❌ ПРОГУЛЫ'].sum()
+    students_with_absences = len(df_stats[df_stats['❌ ПРОГУЛЫ'] > 0])
+    
+    caption = (
+        f"📊 *ОТЧЁТ ЗА {month_year}*\n\n"
+        f"👥 *Группа:* {GROUP_NAME}\n"
+        f"📅 *Занятий:* {len(all_dates)}\n"
+        f"👤 *Студентов:* {len(all_students)}\n"
+        f"❌ *ВСЕГО ПРОГУЛОВ:* {total_unexcused}\n"
+        f"⚠️ *Студентов с прогулами:* {students_with_absences}\n\n"
+        f"*Цветовая индикация:*\n"
+        f"🟢 0 прогулов — без заливки\n"
+        f"🟡 ≤ 10 прогулов — жёлтый\n"
+        f"🔴 > 10 прогулов — красный"
+    )
+    
+    
+    return {
+        'data': output.getvalue(),
+        'caption': caption,
+        'filename': f'прогулы_{GROUP_NAME}_{month_year}.xlsx'
+    }
+
+def send_report(chat_id, report):
+    outbox.send_chat_action(chat_id, 'upload_document')
+    outbox.send_document(
+        chat_id,
+        report['data'],
+        caption=report['caption'],
+        parse_mode='Markdown',
+        visible_file_name=report['filename'],
+        error_text="❌ Ошибка отправки отчёта"
+    )
+
+# ==================== КЭШ ОТЧЁТОВ ====================
+class ReportCache:
+    """Готовые месячные отчёты. Отчёт за месяц сбрасывается при любой записи бота в этот месяц;
+    правки прямо в таблице бот не видит, поэтому отчёт за незакрытый месяц живёт
+    не дольше REPORT_CACHE_TTL, а за закрытый - не дольше REPORT_CACHE_CLOSED_TTL.
+    Одновременные запросы одного месяца ждут одно построение.
+    Каждая запись увеличивает поколение месяца: отчёт, построенный до записи,
+    в кэш не попадает"""
+    
+    def __init__(self, ttl=REPORT_CACHE_TTL, closed_ttl=REPORT_CACHE_CLOSED_TTL):
+        self.ttl = ttl
+        self.closed_ttl = closed_ttl
+        self.reports = {}
+        self.build_locks = {}
+        self.generations = {}
+        self.lock = Lock()
+    
+    def generation(self, month, year):
+        with self.lock:
+            return self.generations.get((year, month), 0)
+    
+    def _is_fresh(self, key, report):
+        today = datetime.date.today()
+        ttl = self.closed_ttl if key < (today.year, today.month) else self.ttl
+        return time.time() - report['created'] <= ttl
+    
+    def get(self, month, year):
+        key = (year, month)
+        with self.lock:
+            report = self.reports.get(key)
+            if report and self._is_fresh(key, report):
+                metrics.inc('cache_hits', 'reports')
+                return report
+        metrics.inc('cache_misses', 'reports')
+        return None
+    
+    def put(self, month, year, report, generation):
+        """Кладёт отчёт, построенный при поколении generation. Если с тех пор
+        в месяц были записи, отчёт устарел и не сохраняется"""
+        key = (year, month)
+        with self.lock:
+            if self.generations.get(key, 0) != generation:
+                return False
+            self.reports[key] = dict(report, created=time.time())
+            return True
+    
+    def invalidate(self, date_str):
+        try:
+            date = datetime.datetime.strptime(date_str, "%d.%m.%Y").date()
+        except ValueError:
+            return
+        key = (date.year, date.month)
+        with self.lock:
+            self.generations[key] = self.generations.get(key, 0) + 1
+            self.reports.pop(key, None)
+    
+    def get_or_build(self, month, year):
+        report = self.get(month, year)
+        if report:
+            return report
+        with self.lock:
+            build_lock = self.build_locks.setdefault((year, month), Lock())
+        with build_lock:
+            report = self.get(month, year)
+            if report:
+                return report
+            generation = self.generation(month, year)
+            report = build_monthly_report(month, year)
+            if report:
+                self.put(month, year, report, generation)
+            return report
 
+report_cache = ReportCache()
+
+@instrumented
 def generate_monthly_report(message):
     try:
         if message.text.lower() == 'текущий':
@@ -1666,163 +3864,760 @@ def generate_monthly_report(message):
         
         month, year = map(int, month_year.split('.'))
         
-        time.sleep(1.1)
-        records = attendance_sheet.get_all_records()
-        if not records:
-            bot.send_message(message.chat.id, "📭 Нет данных для отчёта")
+        report = report_cache.get_or_build(month, year)
+        if report is None:
+            outbox.send_message(message.chat.id, f"📭 Нет данных за {month_year}")
             return
         
-        df = pd.DataFrame(records)
-        df['Дата'] = pd.to_datetime(df['Дата'], format='%d.%m.%Y', errors='coerce')
-        
-        mask = (df['Дата'].dt.month == month) & (df['Дата'].dt.year == year)
-        filtered = df[mask]
+        send_report(message.chat.id, report)
         
-        if filtered.empty:
-            bot.send_message(message.chat.id, f"📭 Нет данных за {month_year}")
+    except ValueError:
+        outbox.send_message(message.chat.id, "❌ Неправильный формат! Используйте ММ.ГГГГ")
+    except Exception as e:
+        outbox.send_message(message.chat.id, f"❌ Ошибка генерации отчёта: {str(e)}")
+
+# ==================== АВТОМАТИЧЕСКАЯ РАССЫЛКА ОТЧЁТОВ ====================
+class MonthlyReportScheduler:
+    """Ночью после закрытия месяца строит отчёт за прошедший месяц,
+    кладёт его в кэш отчётов и рассылает подписанным чатам.
+    Разосланный месяц запоминается в state_file: если бот был выключен
+    в час рассылки, отчёт уходит при запуске"""
+    
+    def __init__(self, hour=REPORT_DELIVERY_HOUR, state_file=REPORT_STATE_FILE):
+        self.hour = hour
+        self.state_file = state_file
+    
+    def last_delivered(self):
+        """(год, месяц) последнего разосланного отчёта; None - рассылок ещё не было"""
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            return tuple(state['last_delivered'])
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"⚠️ Ошибка чтения состояния автоотчётов: {e}")
+            return None
+    
+    def _mark_delivered(self, year, month):
+        temp = f"{self.state_file}.tmp"
+        try:
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump({'last_delivered': [year, month]}, f)
+            os.replace(temp, self.state_file)
+        except Exception as e:
+            print(f"⚠️ Ошибка сохранения состояния автоотчётов: {e}")
+    
+    def missed_month(self, now):
+        """(год, месяц), отчёт за который уже должен был уйти, но не ушёл; иначе None"""
+        if now < datetime.datetime(now.year, now.month, 1, self.hour):
+            return None
+        last_day = now.date().replace(day=1) - datetime.timedelta(days=1)
+        due = (last_day.year, last_day.month)
+        last = self.last_delivered()
+        if last is None:
+            # Без истории рассылок догоняем только в тот же день, иначе первый запуск
+            # посреди месяца прислал бы давно устаревший отчёт
+            return due if now.day == 1 else None
+        return due if last < due else None
+    
+    def next_run(self, now):
+        run_at = datetime.datetime(now.year, now.month, 1, self.hour)
+        if run_at <= now:
+            if now.month == 12:
+                run_at = datetime.datetime(now.year + 1, 1, 1, self.hour)
+            else:
+                run_at = datetime.datetime(now.year, now.month + 1, 1, self.hour)
+        return run_at
+    
+    def run_once(self, today):
+        last_day = today.replace(day=1) - datetime.timedelta(days=1)
+        month, year = last_day.month, last_day.year
+        started = time.time()
+        generation = report_cache.generation(month, year)
+        report = build_monthly_report(month, year)
+        if report is None:
+            print(f"📭 Автоотчёт за {month:02d}.{year}: нет данных")
+            self._mark_delivered(year, month)
             return
+        report_cache.put(month, year, report, generation)
+        print(f"📊 Автоотчёт за {month:02d}.{year} построен за {time.time() - started:.1f} сек")
+        for chat_id in subscriptions.get('reports'):
+            send_report(chat_id, report)
+        self._mark_delivered(year, month)
+    
+    def _run(self):
+        try:
+            now = datetime.datetime.now()
+            if self.missed_month(now):
+                print("📊 Автоотчёт за прошедший месяц не был разослан - рассылаем сейчас")
+                self.run_once(now.date())
+        except Exception as e:
+            print(f"⚠️ Ошибка автоотчёта: {e}")
+        while True:
+            try:
+                now = datetime.datetime.now()
+                run_at = self.next_run(now)
+                # Спим частями, чтобы не зависеть от перевода часов
+                time.sleep(min((run_at - now).total_seconds(), 3600))
+                if datetime.datetime.now() >= run_at:
+                    self.run_once(run_at.date())
+            except Exception as e:
+                print(f"⚠️ Ошибка автоотчёта: {e}")
+                time.sleep(600)
+    
+    def start(self):
+        Thread(target=self._run, name='monthly-reports', daemon=True).start()
+
+monthly_report_scheduler = MonthlyReportScheduler()
+
+@bot.message_handler(commands=['reports'])
+@instrumented
+def toggle_reports(message):
+    if subscriptions.toggle('reports', message.chat.id):
+        outbox.send_message(message.chat.id,
+                           f"📊 *Автоотчёты включены*\n\n"
+                           f"Отчёт за прошедший месяц придёт 1-го числа около {REPORT_DELIVERY_HOUR:02d}:00\n"
+                           f"Отключить: /reports",
+                           parse_mode='Markdown')
+    else:
+        outbox.send_message(message.chat.id, "🔕 Автоотчёты отключены")
+
+# ==================== ПРОГРЕВ ====================
+def warm_up():
+    """Прогрев в фоне: токен, листы и список студентов.
+    Polling стартует сразу, не дожидаясь окончания прогрева"""
+    started = time.time()
+    try:
+        token_refresher.refresh_if_needed()
+        attendance_sheet.resolve()
+        students_sheet.resolve()
+        cache.get_students()
+        print(f"🔥 Прогрев завершён за {time.time() - started:.1f} сек")
+    except Exception as e:
+        print(f"⚠️ Ошибка прогрева (данные загрузятся при первом запросе): {e}")
+
+# ==================== ПОДГРУЗКА ПАР НА СЕГОДНЯ ====================
+class LessonPrefetcher:
+    """Фоновый планировщик: незадолго до начала каждой пары из LESSON_TIMES
+    подгружает в кэш студентов и отметки на сегодня, чтобы первый экран
+    отметки открывался без обращения к таблице"""
+    
+    def __init__(self, lead_minutes=PREFETCH_LEAD_MINUTES):
+        self.lead = datetime.timedelta(minutes=lead_minutes)
+    
+    def get_today_lessons(self, today):
+        """Номера пар на сегодня для всех подгрупп"""
+        numbers = set()
+        for subgroup in ('all', '1', '2'):
+            for lesson in schedule_manager.get_day_lessons(today, subgroup):
+                numbers.add(lesson.number)
+        return sorted(numbers)
+    
+    def seconds_until_next(self, now):
+        """Сколько ждать до следующей подгрузки сегодня (None - сегодня больше нечего)"""
+        for lesson_num in self.get_today_lessons(now.date()):
+            if lesson_num not in LESSON_TIMES:
+                continue
+            start = datetime.datetime.strptime(LESSON_TIMES[lesson_num].split(' - ')[0], "%H:%M").time()
+            prefetch_at = datetime.datetime.combine(now.date(), start) - self.lead
+            if prefetch_at > now:
+                return (prefetch_at - now).total_seconds()
+        return None
+    
+    def prefetch_today(self):
+        today = datetime.date.today()
+        lessons = self.get_today_lessons(today)
+        if lessons:
+            cache.prefetch(today.strftime("%d.%m.%Y"), lessons)
+    
+    def _run(self):
+        while True:
+            try:
+                now = datetime.datetime.now()
+                wait = self.seconds_until_next(now)
+                if wait is None:
+                    # Ждём начала следующих суток
+                    tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time.min)
+                    time.sleep((tomorrow - now).total_seconds() + 1)
+                    continue
+                time.sleep(wait)
+                self.prefetch_today()
+            except Exception as e:
+                print(f"⚠️ Ошибка фоновой подгрузки: {e}")
+                time.sleep(60)
+    
+    def start(self):
+        Thread(target=self._run, name='lesson-prefetcher', daemon=True).start()
+
+lesson_prefetcher = LessonPrefetcher()
+
+# ==================== ОТЧЁТ ПО ПРЕДМЕТАМ ====================
+def parse_report_period(text):
+    """Разбирает период отчёта: 'текущий', ММ.ГГГГ или ДД.ММ.ГГГГ-ДД.ММ.ГГГГ.
+    Возвращает (начальная дата, конечная дата включительно, подпись)"""
+    text = text.strip()
+    if text.lower() == 'текущий':
+        text = datetime.date.today().strftime("%m.%Y")
+    
+    if '-' in text:
+        parts = text.split('-')
+        if len(parts) != 2:
+            raise ValueError("Неверный формат")
+        start_date = datetime.datetime.strptime(parts[0].strip(), "%d.%m.%Y").date()
+        end_date = datetime.datetime.strptime(parts[1].strip(), "%d.%m.%Y").date()
+        if end_date < start_date:
+            raise ValueError("Конечная дата раньше начальной")
+        return start_date, end_date, f"{start_date.strftime('%d.%m.%Y')}-{end_date.strftime('%d.%m.%Y')}"
+    
+    month, year = map(int, text.split('.'))
+    start_date = datetime.date(year, month, 1)
+    if month == 12:
+        end_date = datetime.date(year + 1, 1, 1)
+    else:
+        end_date = datetime.date(year, month + 1, 1)
+    return start_date, end_date - datetime.timedelta(days=1), text
+
+@bot.message_handler(commands=['subjects'])
+@instrumented
+def subject_report_menu(message):
+    current_month = datetime.date.today().strftime("%m.%Y")
+    outbox.send_message(message.chat.id,
+                       f"📚 *Отчёт по предметам*\n\n"
+                       f"Введите месяц `ММ.ГГГГ` (пример: `{current_month}`),\n"
+                       f"период `ДД.ММ.ГГГГ-ДД.ММ.ГГГГ` (например, весь семестр)\n"
+                       f"или `текущий` для текущего месяца",
+                       parse_mode='Markdown')
+    bot.register_next_step_handler_by_chat_id(message.chat.id, generate_subject_report)
+
+@instrumented
+def generate_subject_report(message):
+    import pandas as pd
+    import analytics
+    from openpyxl.styles import PatternFill, Font, Alignment
+    
+    try:
+        start_date, end_date, period_text = parse_report_period(message.text)
         
-        all_students_data = cache.get_students()
-        all_students = [s[1] for s in all_students_data[1:] if len(s) >= 2]
+        records = cache._safe_call(attendance_sheet.get_all_records)
         
-        all_dates = sorted(filtered['Дата'].dt.strftime('%d.%m.%Y').unique())
+        roster = cache.get_roster()
+        names = list(roster.names)
+        subgroups = roster.subgroups()
         
-        # ЛИСТ ПОСЕЩАЕМОСТИ
-        attendance_matrix = []
-        for student in all_students:
-            row = {'Студент': student}
-            student_records = filtered[filtered['Студент'] == student]
-            
-            for date in all_dates:
-                day_records = student_records[student_records['Дата'].dt.strftime('%d.%m.%Y') == date]
-                if not day_records.empty:
-                    status = day_records.iloc[0]['Статус']
-                    if status == 'Присутствовал':
-                        row[date] = '✅'
-                    elif status == 'Отсутствовал':
-                        row[date] = '❌'
-                    elif status == 'Болел':
-                        row[date] = '🤒'
-                    elif status == 'Уважительная причина':
-                        row[date] = '📄'
-                    else:
-                        row[date] = status
-                else:
-                    row[date] = ''
-            attendance_matrix.append(row)
+        matrix = build_attendance_matrix(records, names).between(start_date, end_date + datetime.timedelta(days=1))
+        if not matrix.marked_slots():
+            outbox.send_message(message.chat.id, f"📭 Нет данных за {period_text}")
+            return
+        # Студенты, которых нет в списке, сопоставляются с расписанием всей группы
+        subgroups += ['all'] * (len(matrix.students) - len(subgroups))
         
-        df_attendance = pd.DataFrame(attendance_matrix)
+        # Расписание периода считается один раз и соединяется с отметками целиком
+        entries = schedule_manager.get_calendar_entries(start_date, end_date)
+        subject_calendar = analytics.ScheduleCalendar(
+            (e['date'], e['lesson'], e['subgroup'], e['subject']) for e in entries
+        )
+        slot_calendar = analytics.ScheduleCalendar(
+            (e['date'], e['lesson'], e['subgroup'],
+             (e['date'].weekday(), e['week_type'], e['lesson'], e['subject'])) for e in entries
+        )
+        subjects, subject_counts, outside = matrix.counts_by_calendar(subject_calendar, subgroups)
+        slots, slot_counts, _ = matrix.counts_by_calendar(slot_calendar, subgroups)
         
-        # ЛИСТ СТАТИСТИКИ
-        stats_data = []
-        for student in all_students:
-            student_records = filtered[filtered['Студент'] == student]
-            
-            total_classes = len(student_records)
-            present = len(student_records[student_records['Статус'] == 'Присутствовал'])
-            unexcused = len(student_records[student_records['Статус'] == 'Отсутствовал'])
-            sick = len(student_records[student_records['Статус'] == 'Болел'])
-            excused = len(student_records[student_records['Статус'] == 'Уважительная причина'])
-            
-            attendance_rate = round(present / total_classes * 100, 1) if total_classes > 0 else 0
-            
-            stats_data.append({
-                'Студент': student,
-                'Всего занятий': total_classes,
-                '✅ Присутствовал': present,
-                '❌ ПРОГУЛЫ': unexcused,
-                '🤒 Болел': sick,
-                '📄 Уважительная причина': excused,
-                '% посещения': attendance_rate
+        def stats_frame(label_column, labels, counts):
+            return pd.DataFrame({
+                label_column: labels,
+                'Всего отметок': counts.sum(axis=1),
+                '✅ Присутствовал': counts[:, 0],
+                '❌ ПРОГУЛЫ': counts[:, 1],
+                '🤒 Болел': counts[:, 2],
+                '📄 Уважительная причина': counts[:, 3],
+                '% посещения': matrix.attendance_rate(counts)
             })
         
-        df_stats = pd.DataFrame(stats_data)
+        df_subjects = stats_frame('Предмет', subjects, subject_counts).sort_values('Предмет')
         
-        # СОЗДАНИЕ EXCEL
-        output = BytesIO()
+        day_names = ['пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс']
+        week_names = {'odd': 'верхняя', 'even': 'нижняя'}
+        slot_order = sorted(range(len(slots)), key=lambda i: slots[i])
+        df_slots = stats_frame(
+            'Слот',
+            [f"{day_names[slots[i][0]]}, {week_names[slots[i][1]]}, {slots[i][2]} пара - {slots[i][3]}" for i in slot_order],
+            slot_counts[slot_order]
+        )
         
+        output = BytesIO()
         with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df_attendance.to_excel(writer, sheet_name='Посещаемость', index=False)
-            df_stats.to_excel(writer, sheet_name='Статистика', index=False)
-            
-            reasons_df = filtered[filtered['Причина'] != '-']
-            if not reasons_df.empty:
-                reasons_df = reasons_df[['Дата', 'Пара', 'Студент', 'Статус', 'Причина']]
-                reasons_df.to_excel(writer, sheet_name='Причины', index=False)
-            
-            workbook = writer.book
-            worksheet_stats = writer.sheets['Статистика']
-            
-            # НАСТРОЙКА ШИРИНЫ СТОЛБЦОВ
-            worksheet_stats.column_dimensions['A'].width = 25
-            worksheet_stats.column_dimensions['B'].width = 15
-            worksheet_stats.column_dimensions['C'].width = 18
-            worksheet_stats.column_dimensions['D'].width = 15
-            worksheet_stats.column_dimensions['E'].width = 12
-            worksheet_stats.column_dimensions['F'].width = 20
-            worksheet_stats.column_dimensions['G'].width = 15
-            
-            # ЦВЕТОВАЯ ИНДИКАЦИЯ
-            from openpyxl.styles import PatternFill
+            df_subjects.to_excel(writer, sheet_name='По предметам', index=False)
+            df_slots.to_excel(writer, sheet_name='По слотам', index=False)
             
-            green_fill = PatternFill(start_color='FFFFFF', end_color='FFFFFF', fill_type='solid')
-            yellow_fill = PatternFill(start_color='FFFF00', end_color='FFFF00', fill_type='solid')
-            red_fill = PatternFill(start_color='FF0000', end_color='FF0000', fill_type='solid')
-            
-            for row in range(2, len(df_stats) + 2):
-                cell = worksheet_stats.cell(row=row, column=4)
-                if cell.value is not None:
-                    if cell.value == 0:
-                        cell.fill = green_fill
-                    elif cell.value <= 10:
-                        cell.fill = yellow_fill
-                    else:
-                        cell.fill = red_fill
-            
-            # ЗАГОЛОВКИ
             header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
             header_font = Font(color='FFFFFF', bold=True)
-            
-            for col in range(1, 8):
-                col_letter = get_column_letter(col)
-                cell = worksheet_stats[f'{col_letter}1']
-                cell.fill = header_fill
-                cell.font = header_font
-                cell.alignment = Alignment(horizontal='center')
-            
-            worksheet_stats.auto_filter.ref = worksheet_stats.dimensions
-        
+            for worksheet in writer.sheets.values():
+                worksheet.column_dimensions['A'].width = 40
+                for cell in worksheet[1]:
+                    cell.fill = header_fill
+                    cell.font = header_font
+                    cell.alignment = Alignment(horizontal='center')
+                worksheet.auto_filter.ref = worksheet.dimensions
         output.seek(0)
         
-        total_unexcused = df_stats['❌ ПРОГУЛЫ'].sum()
-        students_with_absences = len(df_stats[df_stats['❌ ПРОГУЛЫ'] > 0])
-        
-        caption = (
-            f"📊 *ОТЧЁТ ЗА {month_year}*\n\n"
-            f"👥 *Группа:* {GROUP_NAME}\n"
-            f"📅 *Занятий:* {len(all_dates)}\n"
-            f"👤 *Студентов:* {len(all_students)}\n"
-            f"❌ *ВСЕГО ПРОГУЛОВ:* {total_unexcused}\n"
-            f"⚠️ *Студентов с прогулами:* {students_with_absences}\n\n"
-            f"*Цветовая индикация:*\n"
-            f"🟢 0 прогулов — без заливки\n"
-            f"🟡 ≤ 10 прогулов — жёлтый\n"
-            f"🔴 > 10 прогулов — красный"
+        lines = [
+            f"{row['Предмет']}: {row['% посещения']}% ✅, ❌ {row['❌ ПРОГУЛЫ']}"
+            for _, row in df_subjects.sort_values('% посещения').iterrows()
+        ]
+        outside_text = f"\n⚠️ *Отметок вне расписания:* {outside}" if outside else ""
+        header = (
+            f"📚 *ПОСЕЩАЕМОСТЬ ПО ПРЕДМЕТАМ*\n"
+            f"📅 *Период:* {period_text}\n"
+            f"👥 *Группа:* {GROUP_NAME}\n\n"
         )
+        # Длинный список обрезается целыми строками, чтобы не разорвать разметку;
+        # первыми идут предметы с худшей посещаемостью
+        more_text = ""
+        while lines and len(header + "\n".join(lines) + more_text + outside_text) > CAPTION_MAX_LENGTH:
+            lines.pop()
+            more_text = f"\n… ещё предметов в файле: {len(df_subjects) - len(lines)}"
+        caption = header + "\n".join(lines) + more_text + outside_text
         
-        bot.send_chat_action(message.chat.id, 'upload_document')
-        bot.send_document(
+        outbox.send_chat_action(message.chat.id, 'upload_document')
+        outbox.send_document(
             message.chat.id,
-            output,
+            output.getvalue(),
             caption=caption,
             parse_mode='Markdown',
-            visible_file_name=f'прогулы_{GROUP_NAME}_{month_year}.xlsx'
+            visible_file_name=f'предметы_{GROUP_NAME}_{period_text}.xlsx',
+            error_text="❌ Ошибка отправки отчёта"
         )
         
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Неправильный формат! Используйте ММ.ГГГГ")
+        outbox.send_message(message.chat.id,
+                           "❌ Неправильный формат! Используйте ММ.ГГГГ или ДД.ММ.ГГГГ-ДД.ММ.ГГГГ")
     except Exception as e:
-        bot.send_message(message.chat.id, f"❌ Ошибка генерации отчёта: {str(e)}")
+        outbox.send_message(message.chat.id, f"❌ Ошибка генерации отчёта: {str(e)}")
+
+# ==================== ВЫГРУЗКА ЖУРНАЛА ====================
+def iter_attendance_chunks(chunk_rows=EXPORT_CHUNK_ROWS):
+    """Читает лист посещаемости кусками по chunk_rows строк.
+    Первый кусок начинается со строки заголовка"""
+    row_count = attendance_sheet.row_count
+    start = 1
+    while True:
+        end = start + chunk_rows - 1
+        rows = cache._safe_call(attendance_sheet.get, f"A{start}:{ATTENDANCE_LAST_COLUMN}{end}")
+        if rows:
+            yield rows
+        # get отбрасывает пустые строки в конце диапазона: короткий кусок означает
+        # конец данных, только если дальше в листе строк уже нет
+        if len(rows) < chunk_rows and end >= row_count:
+            return
+        start = end + 1
+
+class CsvExport:
+    """Запись выгрузки в CSV со сжатием gzip"""
+    extension = 'csv.gz'
+    
+    def __init__(self, path, header):
+        self.file = gzip.open(path, 'wt', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header)
+    
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+    
+    def close(self):
+        self.file.close()
+
+class ParquetExport:
+    """Запись выгрузки в Parquet (нужен пакет pyarrow)"""
+    extension = 'parquet'
+    
+    def __init__(self, path, header):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.header = header
+        self.schema = pa.schema([(name, pa.string()) for name in header])
+        self.writer = pq.ParquetWriter(path, self.schema, compression='snappy')
+    
+    def write_rows(self, rows):
+        columns = [[row[i] for row in rows] for i in range(len(self.header))]
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+    
+    def close(self):
+        self.writer.close()
+
+EXPORT_FORMATS = {'csv': CsvExport, 'parquet': ParquetExport}
+
+def write_attendance_export(path, export_format, year=None):
+    """Потоково пишет журнал в файл: в памяти одновременно только один кусок листа.
+    Возвращает число выгруженных строк"""
+    export = None
+    count = 0
+    year_suffix = f".{year}" if year else None
+    try:
+        for chunk in iter_attendance_chunks():
+            if export is None:
+                header, chunk = chunk[0], chunk[1:]
+                export = EXPORT_FORMATS[export_format](path, header)
+                width = len(header)
+            rows = [
+                (row + [''] * (width - len(row)))[:width]
+                for row in chunk
+                if row and (year_suffix is None or str(row[0]).endswith(year_suffix))
+            ]
+            if rows:
+                export.write_rows(rows)
+                count += len(rows)
+    finally:
+        if export is not None:
+            export.close()
+    return count
+
+@bot.message_handler(commands=['export'])
+@instrumented
+def export_attendance(message):
+    """/export [csv|parquet] [ГГГГ] - выгрузка сырого журнала посещаемости"""
+    args = message.text.split()[1:]
+    export_format = 'parquet' if 'parquet' in args else 'csv'
+    year = next((int(arg) for arg in args if arg.isdigit()), None)
+    
+    if export_format == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            outbox.send_message(message.chat.id, "❌ Parquet недоступен (не установлен pyarrow). Используйте /export csv")
+            return
+    
+    period_text = str(year) if year else "весь период"
+    outbox.send_message(message.chat.id, f"⏳ Выгрузка журнала ({period_text})...")
+    
+    extension = EXPORT_FORMATS[export_format].extension
+    fd, path = tempfile.mkstemp(suffix=f".{extension}")
+    os.close(fd)
+    try:
+        count = write_attendance_export(path, export_format, year)
+        if count == 0:
+            os.remove(path)
+            outbox.send_message(message.chat.id, f"📭 Нет данных за {period_text}")
+            return
+    except Exception as e:
+        os.remove(path)
+        outbox.send_message(message.chat.id, f"❌ Ошибка выгрузки: {e}")
+        return
+    
+    # Файл читается с диска при отправке и удаляется очередью после неё
+    outbox.send_chat_action(message.chat.id, 'upload_document')
+    outbox.send_file(
+        message.chat.id,
+        path,
+        caption=f"📦 *Журнал посещаемости*\n"
+                f"👥 *Группа:* {GROUP_NAME}\n"
+                f"📅 *Период:* {period_text}\n"
+                f"📄 *Строк:* {count}",
+        parse_mode='Markdown',
+        visible_file_name=f'журнал_{GROUP_NAME}_{year or "все"}.{extension}',
+        error_text="❌ Ошибка отправки выгрузки"
+    )
+
+# ==================== ДОЛГИ ПО ОТМЕТКАМ ====================
+# Порядок, в котором меняется статус клетки при нажатии (⬜ - нет отметки)
+BACKLOG_CYCLE = (None, 'present', 'absent', 'sick')
+
+@bot.message_handler(commands=['backlog'])
+@instrumented
+def backlog_menu(message):
+    outbox.send_message(message.chat.id,
+                       f"🗂 *Долги по отметкам*\n\n"
+                       f"Введите период `ДД.ММ.ГГГГ-ДД.ММ.ГГГГ`,\n"
+                       f"месяц `ММ.ГГГГ` или `текущий`.\n"
+                       f"Все неотмеченные пары периода откроются одной таблицей",
+                       parse_mode='Markdown')
+    bot.register_next_step_handler_by_chat_id(message.chat.id, open_backlog)
+
+@instrumented
+def open_backlog(message):
+    """Одно чтение листа: все неотмеченные пары периода для выбранной подгруппы"""
+    user = get_user_data(message.chat.id)
+    
+    try:
+        start_date, end_date, period_text = parse_report_period(message.text)
+        end_date = min(end_date, datetime.date.today())
+        
+        records = cache._safe_call(attendance_sheet.get_all_records)
+        marked = set(build_attendance_matrix(records).between(
+            start_date, end_date + datetime.timedelta(days=1)).marked_slots())
+        
+        pairs = [
+            (lesson['date'].strftime("%d.%m.%Y"), lesson['lesson'], lesson['subject'])
+            for lesson in schedule_manager.get_lessons_in_range(start_date, end_date, user['selected_subgroup'])
+            if (lesson['date'], lesson['lesson']) not in marked
+        ]
+        students = cache.get_roster().for_subgroup(user['selected_subgroup'])
+    except ValueError:
+        outbox.send_message(message.chat.id, "❌ Неверный формат! Пример: `01.03.2026-10.03.2026`", parse_mode='Markdown')
+        return
+    except Exception as e:
+        outbox.send_message(message.chat.id, f"❌ Ошибка: {e}")
+        return
+    
+    if not pairs:
+        outbox.send_message(message.chat.id, f"🎉 За {period_text} все пары отмечены")
+        return
+    if not students:
+        outbox.send_message(message.chat.id, "❌ Нет студентов в выбранной подгруппе!")
+        return
+    
+    user['backlog'] = {
+        'period': period_text,
+        # Самые старые долги - первыми; сетка и состояние не растут с длиной периода
+        'pairs': pairs[:BACKLOG_MAX_PAIRS],
+        'more_pairs': max(0, len(pairs) - BACKLOG_MAX_PAIRS),
+        'students': students,
+        'cells': {},
+        'page': 0,
+        'pair_page': 0
+    }
+    text, markup = render_backlog(user['backlog'])
+    outbox.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=markup)
+
+def render_backlog(backlog):
+    """Сетка студент × пара для текущих страниц. Возвращает (текст, клавиатура)"""
+    pairs = backlog['pairs']
+    students = backlog['students']
+    cells = backlog['cells']
+    
+    pair_pages = (len(pairs) + BACKLOG_PAIRS_PER_PAGE - 1) // BACKLOG_PAIRS_PER_PAGE
+    pages = (len(students) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
+    first_col = backlog['pair_page'] * BACKLOG_PAIRS_PER_PAGE
+    columns = range(first_col, min(first_col + BACKLOG_PAIRS_PER_PAGE, len(pairs)))
+    first_row = backlog['page'] * ITEMS_PER_PAGE
+    
+    markup = telebot.types.InlineKeyboardMarkup()
+    # Заголовок: нажатие на пару ставит ✅ всем, у кого в ней пусто
+    markup.row(
+        telebot.types.InlineKeyboardButton("👤", callback_data="bl_noop"),
+        *[telebot.types.InlineKeyboardButton(f"{pairs[col][0][:5]} {pairs[col][1]}", callback_data=f"bl_col_{col}")
+          for col in columns]
+    )
+    for student in students[first_row:first_row + ITEMS_PER_PAGE]:
+        name = student.name if len(student.name) <= 12 else student.name[:12] + "…"
+        buttons = [telebot.types.InlineKeyboardButton(name, callback_data="bl_noop")]
+        for col in columns:
+            status_code = cells.get((student.id, col))
+            emoji = STATUSES[status_code]['emoji'] if status_code else '⬜'
+            buttons.append(telebot.types.InlineKeyboardButton(emoji, callback_data=f"bl_cell_{student.id}_{col}"))
+        markup.row(*buttons)
+    
+    nav_buttons = []
+    if backlog['pair_page'] > 0:
+        nav_buttons.append(telebot.types.InlineKeyboardButton("⏪ Пары", callback_data="bl_left"))
+    if backlog['page'] > 0:
+        nav_buttons.append(telebot.types.InlineKeyboardButton("◀", callback_data="bl_prev"))
+    if backlog['page'] < pages - 1:
+        nav_buttons.append(telebot.types.InlineKeyboardButton("▶", callback_data="bl_next"))
+    if backlog['pair_page'] < pair_pages - 1:
+        nav_buttons.append(telebot.types.InlineKeyboardButton("Пары ⏩", callback_data="bl_right"))
+    if nav_buttons:
+        markup.row(*nav_buttons)
+    markup.row(
+        telebot.types.InlineKeyboardButton("💾 Сохранить всё", callback_data="bl_save"),
+        telebot.types.InlineKeyboardButton("❌ Отмена", callback_data="bl_cancel")
+    )
+    
+    legend = "\n".join(f"{col + 1}. {pairs[col][0]}, {pairs[col][1]} пара - {pairs[col][2]}" for col in columns)
+    more = f" (ещё {backlog['more_pairs']} - после сохранения)" if backlog['more_pairs'] else ""
+    text = (
+        f"🗂 *Долги по отметкам* за {backlog['period']}\n\n"
+        f"📚 *Неотмеченных пар:* {len(pairs)}{more}\n"
+        f"✏️ *Заполнено клеток:* {len(cells)}\n"
+        f"📄 Студенты {backlog['page'] + 1}/{pages}, пары {backlog['pair_page'] + 1}/{pair_pages}\n\n"
+        f"{legend}\n\n"
+        f"Нажатие на клетку: ⬜ → ✅ → ❌ → 🤒\n"
+        f"Нажатие на пару: ✅ всем пустым"
+    )
+    return text, markup
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('bl_'))
+@instrumented
+def backlog_action(call):
+    """Все действия в сетке меняют только состояние пользователя; лист пишется при сохранении"""
+    user = get_user_data(call.message.chat.id)
+    backlog = user.get('backlog')
+    if not backlog:
+        outbox.answer_callback_query(call.id, "❌ Таблица устарела, откройте /backlog заново")
+        return
+    
+    action = call.data[3:]
+    cells = backlog['cells']
+    if action == 'noop':
+        outbox.answer_callback_query(call.id)
+        return
+    if action == 'save':
+        save_backlog(call, user)
+        return
+    if action == 'cancel':
+        del user['backlog']
+        outbox.answer_callback_query(call.id, "❌ Отменено")
+        safe_edit_message(call.message.chat.id, call.message.message_id, "❌ Заполнение долгов отменено")
+        return
+    
+    if action.startswith('cell_'):
+        sid, col = action[5:].rsplit('_', 1)
+        key = (sid, int(col))
+        next_code = BACKLOG_CYCLE[(BACKLOG_CYCLE.index(cells.get(key)) + 1) % len(BACKLOG_CYCLE)]
+        if next_code:
+            cells[key] = next_code
+        else:
+            cells.pop(key, None)
+    elif action.startswith('col_'):
+        col = int(action[4:])
+        for student in backlog['students']:
+            cells.setdefault((student.id, col), 'present')
+    elif action == 'prev':
+        backlog['page'] = max(0, backlog['page'] - 1)
+    elif action == 'next':
+        pages = (len(backlog['students']) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
+        backlog['page'] = min(pages - 1, backlog['page'] + 1)
+    elif action == 'left':
+        backlog['pair_page'] = max(0, backlog['pair_page'] - 1)
+    elif action == 'right':
+        pair_pages = (len(backlog['pairs']) + BACKLOG_PAIRS_PER_PAGE - 1) // BACKLOG_PAIRS_PER_PAGE
+        backlog['pair_page'] = min(pair_pages - 1, backlog['pair_page'] + 1)
+    
+    outbox.answer_callback_query(call.id)
+    text, markup = render_backlog(backlog)
+    safe_edit_message(call.message.chat.id, call.message.message_id, text, reply_markup=markup)
+
+@idempotent
+def save_backlog(call, user):
+    """Все заполненные клетки - одной пакетной записью в лист.
+    Сетка могла устареть, пока её заполняли: лист перечитывается, и клетки,
+    в которых уже есть отметка, пропускаются"""
+    backlog = user['backlog']
+    pairs = backlog['pairs']
+    names = {student.id: student.name for student in backlog['students']}
+    if not backlog['cells']:
+        outbox.answer_callback_query(call.id, "❌ Не заполнено ни одной клетки")
+        return
+    
+    try:
+        affected = {(pairs[col][0], str(pairs[col][1])) for sid, col in backlog['cells']}
+        marked = {
+            (str(row[0]), str(row[1]), row[3])
+            for row in cache._safe_call(attendance_sheet.get_all_values)[1:]
+            if len(row) >= 4 and row[3] and (str(row[0]), str(row[1])) in affected
+        }
+        time_now = datetime.datetime.now().strftime("%H:%M")
+        rows_to_add = [
+            attendance_row(pairs[col][0], pairs[col][1], names[sid], STATUSES[status_code]['text'], '-', time_now)
+            for (sid, col), status_code in sorted(backlog['cells'].items(), key=lambda item: (item[0][1], item[0][0]))
+            if (pairs[col][0], str(pairs[col][1]), names[sid]) not in marked
+        ]
+        skipped = len(backlog['cells']) - len(rows_to_add)
+        written = (deferred_writes.run_or_defer('append', [rows_to_add], call.message.chat.id)
+                   if rows_to_add else True)
+    except Exception as e:
+        print(f"❌ Ошибка сохранения: {e}")
+        outbox.answer_callback_query(call.id, "❌ Не удалось сохранить, попробуйте ещё раз")
+        return
+    
+    for date_str, lesson in {(row[0], row[1]) for row in rows_to_add}:
+        cache.clear_attendance_cache(date_str, lesson)
+    
+    filled_pairs = len({col for sid, col in backlog['cells']})
+    more_pairs = backlog['more_pairs']
+    del user['backlog']
+    if written:
+        outbox.answer_callback_query(call.id, f"✅ Сохранено {len(rows_to_add)} отметок")
+    else:
+        outbox.answer_callback_query(call.id, "⏳ Google перегружен, отметки запишутся автоматически")
+    safe_edit_message(
+        call.message.chat.id,
+        call.message.message_id,
+        f"✅ *Долги сохранены*\n\n"
+        f"📚 *Пар отмечено:* {filled_pairs} из {len(pairs)}\n"
+        f"📝 *Отметок:* {len(rows_to_add)}"
+        + (f"\n⏭ *Уже были отмечены:* {skipped}" if skipped else "")
+        + (f"\n\n🗂 Осталось неотмеченных пар: {more_pairs}, откройте /backlog ещё раз" if more_pairs else "")
+    )
+
+# ==================== ОСТАНОВКА И ВОЗОБНОВЛЕНИЕ ====================
+shutdown_requested = Event()
+shutdown_started = None
+
+def request_shutdown(signum, frame):
+    """SIGTERM/SIGINT: больше не забираем обновления, дальше работает shutdown()"""
+    global shutdown_started
+    if shutdown_requested.is_set():
+        return
+    shutdown_started = time.monotonic()
+    print(f"🛑 Получен сигнал {signal.Signals(signum).name}, останавливаемся...")
+    shutdown_requested.set()
+    bot.stop_polling()
+
+def save_pending_work(filename=PENDING_WORK_FILE):
+    """Сохраняет недоделанную работу на диск (атомарно). Возвращает (записей, сообщений)"""
+    work = {'writes': deferred_writes.snapshot(), 'messages': outbox.snapshot()}
+    if not work['writes'] and not work['messages']:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return 0, 0
+    temp = f"{filename}.tmp"
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(work, f, ensure_ascii=False)
+    os.replace(temp, filename)
+    return len(work['writes']), len(work['messages'])
+
+def resume_pending_work(filename=PENDING_WORK_FILE):
+    """Ставит в очереди работу, сохранённую при прошлой остановке"""
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            work = json.load(f)
+        deferred_writes.restore(work.get('writes', []))
+        outbox.restore(work.get('messages', []))
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        # Испорченный файл откладывается в сторону, иначе он мешал бы каждому запуску
+        print(f"⚠️ Ошибка загрузки незавершённой работы: {e}, файл сохранён как {filename}.bad")
+        os.replace(filename, f"{filename}.bad")
+        return
+    os.remove(filename)
+    print(f"♻️ Возобновлено после перезапуска: записей {len(work.get('writes', []))}, "
+          f"сообщений {len(work.get('messages', []))}")
+
+def shutdown(deadline=SHUTDOWN_DEADLINE):
+    """Дожидается начатых обработчиков, отложенных записей и очереди сообщений,
+    но не дольше deadline секунд с момента сигнала. Что не успело - сохраняется на диск"""
+    finish_by = (shutdown_started or time.monotonic()) + deadline
+    
+    def remaining():
+        return max(0.0, finish_by - time.monotonic())
+    
+    # Обновления, уже полученные от Telegram, обрабатываются до конца
+    while not bot.worker_pool.tasks.empty() and remaining():
+        time.sleep(0.1)
+    closer = Thread(target=bot.worker_pool.close, name='handlers-close', daemon=True)
+    closer.start()
+    closer.join(remaining())
+    
+    writes_done = deferred_writes.wait_idle(remaining())
+    messages_done = outbox.wait_idle(remaining())
+    if writes_done and messages_done and not closer.is_alive():
+        save_pending_work()
+        print("✅ Очереди пусты, бот остановлен")
+        return
+    
+    # Потоки-отправители ещё живы: без остановки они дошлют то, что попадёт в снимок,
+    # и после перезапуска это уйдёт второй раз
+    outbox.stop()
+    deferred_writes.stop()
+    try:
+        writes, messages = save_pending_work()
+        print(f"💾 Не успели за {deadline} сек, сохранено на диск: записей {writes}, сообщений {messages}")
+    except Exception as e:
+        print(f"❌ Не удалось сохранить незавершённую работу: {e}")
 
 # ==================== ЗАПУСК ====================
 if __name__ == "__main__":
@@ -1842,28 +4637,55 @@ if __name__ == "__main__":
     print(f"✅ Показывает только текущий месяц")
     print(f"✅ Показывает все неотмеченные пары (включая прошедшие)")
     print(f"✅ Расписание с названиями пар")
-    print(f"✅ Тип недели: нижняя = нечётные недели")
+    print(f"✅ Тип недели: от начала семестра, первая - {'верхняя' if FIRST_WEEK_TYPE == 'odd' else 'нижняя'}")
     print(f"✅ УЛУЧШЕННОЕ КЭШИРОВАНИЕ - АКТИВНО")
     print(f"✅ Батчевые операции - АКТИВНЫ")
     print(f"✅ Автоперезапуск при ошибках - АКТИВЕН")
     print(f"📊 Отчёт: цветовая индикация прогулов")
+    print(f"📚 Отчёт по предметам и слотам (/subjects)")
+    print(f"📦 Потоковая выгрузка журнала (/export)")
+    print(f"🚨 Уведомления о прогулах (/alerts)")
+    print(f"📬 Автоотчёты в конце месяца (/reports)")
+    print(f"🔄 Горячая перезагрузка расписания")
+    print(f"🗂 Заполнение долгов таблицей (/backlog)")
+    print(f"📈 Метрики обработчиков и API - АКТИВНЫ")
+    print(f"⏳ Общая квота Sheets и отложенные записи - АКТИВНЫ")
+    print(f"📨 Очередь сообщений с лимитами Telegram - АКТИВНА")
+    print(f"🛑 Мягкая остановка по SIGTERM ({SHUTDOWN_DEADLINE} сек на дозапись)")
     print(f"📅 Расписание пар загружено")
     print("=" * 60)
     
-    while True:
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    resume_pending_work()
+    
+    Thread(target=warm_up, name='warm-up', daemon=True).start()
+    token_refresher.start()
+    lesson_prefetcher.start()
+    metrics_reporter.start()
+    absence_tracker.start()
+    deferred_writes.start()
+    outbox.start()
+    monthly_report_scheduler.start()
+    schedule_manager.start_watching()
+    
+    # Пауза перед перезапуском прерывается сигналом остановки
+    while not shutdown_requested.is_set():
         try:
             print("🔄 Запуск polling...")
-            bot.polling(none_stop=False, interval=1, timeout=30)
+            bot.polling(none_stop=False, interval=1, timeout=30, long_polling_timeout=POLLING_TIMEOUT)
         except requests.exceptions.ReadTimeout:
             print("⚠️ Timeout Telegram API, перезапуск через 5 секунд...")
-            time.sleep(5)
+            shutdown_requested.wait(5)
             continue
         except requests.exceptions.ConnectionError:
             print("⚠️ Ошибка соединения, перезапуск через 10 секунд...")
-            time.sleep(10)
+            shutdown_requested.wait(10)
             continue
         except Exception as e:
             print(f"❌ Неожиданная ошибка: {e}")
             print("🔄 Перезапуск через 10 секунд...")
-            time.sleep(10)
+            shutdown_requested.wait(10)
             continue
+    
+    shutdown()
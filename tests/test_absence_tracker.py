@@ -0,0 +1,82 @@
+import os
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import bot
+
+
+class FakeCache:
+    def __init__(self, roster):
+        self.roster = roster
+    
+    def _safe_call(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+    
+    def get_roster(self):
+        return self.roster
+
+
+class FakeSheet:
+    def __init__(self, records, during_read=None):
+        self.records = records
+        self.during_read = during_read
+    
+    def get_all_records(self):
+        records = list(self.records)
+        if self.during_read:
+            self.during_read()
+        return records
+
+
+def make_tracker(monkeypatch, records, during_read=None):
+    roster = bot.Roster([['ID', 'ФИО', 'Подгруппа'], ['1', 'A', '1'], ['2', 'B', '2']])
+    monkeypatch.setattr(bot, 'cache', FakeCache(roster))
+    monkeypatch.setattr(bot, 'attendance_sheet', FakeSheet(records, during_read))
+    monkeypatch.setattr(bot.schedule_manager, 'get_day_lessons', lambda date, subgroup='all': {
+        '1': (bot.Lesson(1, 'Химия', '1'),),
+        '2': (bot.Lesson(1, 'Физика', '2'),),
+    }.get(subgroup, ()))
+    tracker = bot.AbsenceTracker(month_thresholds=(), subject_thresholds=())
+    tracker.running = True
+    return tracker
+
+
+def drain(tracker):
+    while not tracker.queue.empty():
+        created, date_str, lesson, student, old_count, new_count = tracker.queue.get()
+        delta = tracker._delta(created, date_str, lesson, student, old_count, new_count)
+        if delta:
+            tracker.apply(date_str, lesson, student, delta)
+
+
+def record(student, status):
+    return {'Дата': '02.02.2026', 'Пара': 1, 'Студент': student, 'Статус': status}
+
+
+def test_change_during_initial_read_is_counted_once(monkeypatch):
+    absent = next(iter(bot.UNRESPECTFUL_STATUSES))
+    sheet_records = [record('A', absent)]
+    
+    def write_during_read():
+        # Запись успела попасть в снимок, событие о ней пришло во время чтения
+        tracker.record_change('02.02.2026', 1, 'A', [], absent)
+        # А эта запись в снимок не попала
+        tracker.record_change('02.02.2026', 1, 'B', [], absent)
+    
+    tracker = make_tracker(monkeypatch, sheet_records, write_during_read)
+    tracker.load()
+    drain(tracker)
+    assert tracker.month_counts[('A', 2026, 2)] == 1
+    assert tracker.month_counts[('B', 2026, 2)] == 1
+    
+    tracker.record_change('02.02.2026', 1, 'A', [absent], 'Присутствовал')
+    drain(tracker)
+    assert tracker.month_counts[('A', 2026, 2)] == 0
+
+
+def test_subject_follows_student_subgroup(monkeypatch):
+    absent = next(iter(bot.UNRESPECTFUL_STATUSES))
+    tracker = make_tracker(monkeypatch, [record('A', absent), record('B', absent)])
+    tracker.load()
+    year = bot.academic_year(bot.datetime.date(2026, 2, 2))
+    assert tracker.subject_counts == {('A', year, 'Химия'): 1, ('B', year, 'Физика'): 1}
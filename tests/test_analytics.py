@@ -0,0 +1,39 @@
+import datetime
+
+import numpy as np
+
+import analytics
+
+
+def record(date, lesson, student, status):
+    return {'Дата': date, 'Пара': lesson, 'Студент': student, 'Статус': status}
+
+
+def test_last_mark_of_a_pair_wins():
+    # Много повторов одной клетки: при неявном присваивании NumPy мог бы оставить любой
+    records = [record('02.02.2026', 1, 'A', 'Отсутствовал') for _ in range(50)]
+    records.append(record('02.02.2026', 1, 'A', 'Присутствовал'))
+    records.append(record('02.02.2026', 2, 'A', 'Болел'))
+    matrix = analytics.AttendanceMatrix.from_records(records, ['A'])
+    
+    assert matrix.status.tolist() == [[1, 3]]
+    assert matrix.counts_by_student().tolist() == [[1, 0, 1, 0, 0]]
+
+
+def test_counts_by_week_and_subgroup():
+    records = [
+        record('02.02.2026', 1, 'A', 'Присутствовал'),
+        record('04.02.2026', 1, 'A', 'Отсутствовал'),
+        record('09.02.2026', 1, 'B', 'Присутствовал'),
+    ]
+    matrix = analytics.AttendanceMatrix.from_records(records, ['A', 'B'])
+    
+    mondays, weekly = matrix.counts_by_week()
+    assert mondays == [datetime.date(2026, 2, 2), datetime.date(2026, 2, 9)]
+    assert weekly[0].tolist() == [[1, 1, 0, 0, 0], [0, 0, 0, 0, 0]]
+    assert weekly[1].tolist() == [[0, 0, 0, 0, 0], [1, 0, 0, 0, 0]]
+    
+    subgroups, counts = matrix.counts_by_subgroup(['1', '2'])
+    assert subgroups == ['1', '2']
+    assert counts.tolist() == [[1, 1, 0, 0, 0], [1, 0, 0, 0, 0]]
+    assert np.array_equal(matrix.attendance_rate(counts), [50.0, 100.0])
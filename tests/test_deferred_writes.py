@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import bot
+
+
+class Recorder:
+    def __init__(self):
+        self.messages = []
+    
+    def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    calls = []
+    monkeypatch.setattr(bot, 'sheets_quota', bot.SheetsQuota())
+    monkeypatch.setattr(bot, 'outbox', Recorder())
+    monkeypatch.setattr(bot, 'DEFERRED_RETRY_DELAY', 0)
+    monkeypatch.setattr(bot, 'DEFERRED_WRITE_ATTEMPTS', 2)
+    monkeypatch.setitem(bot.DEFERRED_OPERATIONS, 'test', lambda *args: calls.append(args))
+    return calls
+
+
+def test_quota_errors_do_not_use_up_attempts(writes, monkeypatch):
+    failures = [bot.QuotaExceeded(60) for _ in range(5)]
+    
+    def operation(*args):
+        writes.append(args)
+        if failures:
+            raise failures.pop()
+    monkeypatch.setitem(bot.DEFERRED_OPERATIONS, 'test', operation)
+    
+    deferred = bot.DeferredWrites()
+    deferred.submit('test', [1], chat_id=7)
+    deferred.start()
+    assert deferred.wait_idle(5)
+    assert len(writes) == 6
+    assert bot.outbox.messages == []
+
+
+def test_dropped_write_is_reported_to_its_chat(writes, monkeypatch):
+    def operation(*args):
+        raise ValueError('broken')
+    monkeypatch.setitem(bot.DEFERRED_OPERATIONS, 'save', operation)
+    
+    deferred = bot.DeferredWrites()
+    deferred.submit('save', ['01.02.2026', [1, 2], 'A', 'Отсутствовал', '-', {}], chat_id=7)
+    deferred.start()
+    assert deferred.wait_idle(5)
+    [(chat_id, text)] = bot.outbox.messages
+    assert chat_id == 7
+    assert 'A, 01.02.2026, пары 1, 2' in text
+
+
+def test_writes_queue_behind_pending_ones(writes):
+    deferred = bot.DeferredWrites()
+    deferred.submit('test', ['first'])
+    assert deferred.run_or_defer('test', ['second']) is False
+    deferred.start()
+    assert deferred.wait_idle(5)
+    assert writes == [('first',), ('second',)]
+    assert deferred.run_or_defer('test', ['third']) is True
+
+
+def test_stopped_queue_is_not_written_after_snapshot(writes, monkeypatch):
+    started = bot.Event()
+    release = bot.Event()
+    
+    def operation(*args):
+        writes.append(args)
+        started.set()
+        release.wait(5)
+    monkeypatch.setitem(bot.DEFERRED_OPERATIONS, 'test', operation)
+    
+    deferred = bot.DeferredWrites()
+    deferred.submit('test', ['first'])
+    deferred.submit('test', ['second'])
+    deferred.start()
+    assert started.wait(5)
+    deferred.stop()
+    saved = deferred.snapshot()
+    release.set()
+    assert not deferred.wait_idle(0.2)
+    # Начатая запись попадает в снимок, следующая уже не выполняется
+    assert [job['args'] for job in saved] == [['first'], ['second']]
+    assert writes == [('first',)]
+
+
+def test_broken_pending_work_file_is_moved_aside(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'deferred_writes', bot.DeferredWrites())
+    monkeypatch.setattr(bot, 'outbox', bot.Outbox())
+    filename = tmp_path / 'pending_work.json'
+    filename.write_text('{"writes": [{"args": []}]}', encoding='utf-8')
+    bot.resume_pending_work(str(filename))
+    assert not filename.exists()
+    assert (tmp_path / 'pending_work.json.bad').exists()
+    bot.resume_pending_work(str(filename))
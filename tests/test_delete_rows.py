@@ -0,0 +1,24 @@
+import os
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import benchmark
+import bot
+
+HEADER = ['Дата', 'Пара', 'Группа', 'Студент', 'Статус', 'Причина', 'Время', 'ID']
+
+
+def test_legacy_row_moved_past_the_window_is_found(monkeypatch):
+    legacy = ['01.02.2026', '1', 'G', 'A', 'Отсутствовал', '-', '10:00']
+    filler = ['01.02.2026', '2', 'G', 'B', 'Присутствовал', '-', '10:00', 'r']
+    rows = [HEADER] + [filler] * 20 + [legacy]
+    sheet = benchmark.FakeWorksheet('Посещаемость', rows)
+    monkeypatch.setattr(bot.attendance_sheet, '_worksheet', sheet)
+    monkeypatch.setattr(bot, 'cache', bot.SheetsCache())
+    monkeypatch.setattr(bot, 'WRITE_CONFLICT_WINDOW', 2)
+    
+    # Строку прочитали на 22-й позиции, а потом лист сдвинулся на 10 строк вверх
+    del sheet.rows[1:11]
+    bot.delete_rows_checked([(22, legacy)])
+    assert legacy not in sheet.rows
+    assert len(sheet.rows) == 11
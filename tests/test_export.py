@@ -0,0 +1,21 @@
+import os
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import benchmark
+import bot
+
+
+def test_export_pages_past_blank_rows(monkeypatch):
+    header = ['Дата', 'Пара', 'Группа', 'Студент', 'Статус', 'Причина', 'Время', 'ID']
+    row = ['01.02.2026', '1', 'G', 'A', 'Присутствовал', '-', '10:00', 'r1']
+    # Второй кусок (строки 4-6) заканчивается пустыми строками, данные идут дальше
+    rows = [header, row, row, row, [], [], row, row]
+    monkeypatch.setattr(bot.attendance_sheet, '_worksheet', benchmark.FakeWorksheet('Посещаемость', rows))
+    monkeypatch.setattr(bot, 'cache', bot.SheetsCache())
+    
+    chunks = list(bot.iter_attendance_chunks(chunk_rows=3))
+    exported = [values for chunk in chunks for values in chunk if values]
+    assert exported[0] == header
+    assert len(exported) == 6
+    assert all(len(values) == 8 for values in exported)
@@ -0,0 +1,113 @@
+import os
+
+import pytest
+import telebot
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import bot
+
+
+def api_error(code, description, retry_after=None):
+    result_json = {'ok': False, 'error_code': code, 'description': description}
+    if retry_after is not None:
+        result_json['parameters'] = {'retry_after': retry_after}
+    return telebot.apihelper.ApiTelegramException('test', None, result_json)
+
+
+class FakeBot:
+    """Записывает вызовы; errors - очередь исключений для очередных вызовов метода"""
+    
+    def __init__(self, errors=None):
+        self.calls = []
+        self.errors = errors or {}
+    
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            if method == 'send_document':
+                chat_id, document = args
+                args = (chat_id, document.read())
+            self.calls.append((method, args, kwargs))
+            if self.errors.get(method):
+                raise self.errors[method].pop(0)
+        return call
+
+
+@pytest.fixture
+def fake_bot(monkeypatch):
+    fake = FakeBot()
+    monkeypatch.setattr(bot, 'bot', fake)
+    monkeypatch.setattr(bot, 'TELEGRAM_CHAT_RATE', 1000)
+    monkeypatch.setattr(bot, 'TELEGRAM_CHAT_BURST', 1000)
+    return fake
+
+
+def run(outbox):
+    outbox.start()
+    assert outbox.wait_idle(5)
+
+
+def test_chat_order_is_kept_across_priorities(fake_bot):
+    outbox = bot.Outbox(senders=1)
+    outbox.send_document(1, b'report', visible_file_name='report.xlsx')
+    outbox.send_message(1, 'after report')
+    outbox.send_message(2, 'other chat')
+    outbox.answer_callback_query('query')
+    run(outbox)
+    
+    methods = [(method, args[:2]) for method, args, kwargs in fake_bot.calls]
+    assert methods[0] == ('answer_callback_query', ('query', None))
+    chat_1 = [args[1] for method, args, kwargs in fake_bot.calls if args[0] == 1]
+    assert chat_1 == [b'report', 'after report']
+
+
+def test_pending_edits_of_a_message_are_merged(fake_bot):
+    outbox = bot.Outbox(senders=1)
+    for text in ('one', 'two', 'three'):
+        outbox.edit_message_text(text, 1, 10)
+    outbox.edit_message_text('other message', 1, 11)
+    run(outbox)
+    
+    assert [args[0] for method, args, kwargs in fake_bot.calls] == ['three', 'other message']
+
+
+def test_document_retry_after_429_sends_the_whole_file(fake_bot):
+    fake_bot.errors['send_document'] = [api_error(429, 'Too Many Requests', retry_after=0)]
+    outbox = bot.Outbox(senders=1)
+    outbox.send_document(1, b'report')
+    run(outbox)
+    
+    assert [args[1] for method, args, kwargs in fake_bot.calls] == [b'report', b'report']
+
+
+def test_broken_markup_is_resent_as_plain_text(fake_bot):
+    fake_bot.errors['send_document'] = [api_error(400, "Bad Request: can't parse entities")]
+    outbox = bot.Outbox(senders=1)
+    outbox.send_document(1, b'report', caption='*a_b*', parse_mode='Markdown')
+    run(outbox)
+    
+    assert [kwargs.get('parse_mode') for method, args, kwargs in fake_bot.calls] == ['Markdown', None]
+
+
+def test_final_failure_is_reported_to_the_chat(fake_bot):
+    fake_bot.errors['send_document'] = [api_error(400, 'Bad Request: file is too big')]
+    outbox = bot.Outbox(senders=1)
+    outbox.send_document(1, b'report', error_text='❌ Ошибка отправки отчёта')
+    run(outbox)
+    
+    method, args, kwargs = fake_bot.calls[-1]
+    assert method == 'send_message'
+    assert args[0] == 1 and args[1].startswith('❌ Ошибка отправки отчёта')
+
+
+def test_token_bucket_limits_and_blocks():
+    bucket = bot.TokenBucket(rate=1, burst=2)
+    bucket.updated = 0.0
+    assert bucket.delay(0.0) == 0.0
+    bucket.take(0.0)
+    bucket.take(0.0)
+    assert bucket.delay(0.0) == 1.0
+    assert bucket.delay(1.0) == 0.0
+    bucket.block(1.0, 5)
+    assert bucket.delay(1.0) == 5.0
+    assert not bucket.idle(1.0)
@@ -0,0 +1,45 @@
+import datetime
+import os
+from unittest import mock
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import bot
+
+
+def test_report_built_before_write_is_not_cached():
+    cache = bot.ReportCache()
+    
+    def build_during_write(month, year):
+        # Запись в месяц приходит, пока отчёт ещё строится
+        cache.invalidate('15.01.2020')
+        return {'text': 'stale'}
+    
+    with mock.patch.object(bot, 'build_monthly_report', build_during_write):
+        assert cache.get_or_build(1, 2020) == {'text': 'stale'}
+    assert cache.get(1, 2020) is None
+    
+    with mock.patch.object(bot, 'build_monthly_report', lambda month, year: {'text': 'fresh'}):
+        cache.get_or_build(1, 2020)
+    assert cache.get(1, 2020)['text'] == 'fresh'
+
+
+def test_closed_month_report_expires():
+    cache = bot.ReportCache(ttl=600, closed_ttl=3600)
+    cache.put(1, 2020, {'text': 'old'}, cache.generation(1, 2020))
+    assert cache.get(1, 2020)
+    cache.reports[(2020, 1)]['created'] -= 3601
+    assert cache.get(1, 2020) is None
+
+
+def test_scheduler_catches_up_a_missed_delivery(tmp_path):
+    scheduler = bot.MonthlyReportScheduler(hour=3, state_file=str(tmp_path / 'state.json'))
+    # Истории нет: догоняем только в день рассылки
+    assert scheduler.missed_month(datetime.datetime(2026, 3, 1, 2)) is None
+    assert scheduler.missed_month(datetime.datetime(2026, 3, 1, 5)) == (2026, 2)
+    assert scheduler.missed_month(datetime.datetime(2026, 3, 5, 5)) is None
+    
+    scheduler._mark_delivered(2026, 1)
+    assert scheduler.missed_month(datetime.datetime(2026, 3, 5, 5)) == (2026, 2)
+    scheduler._mark_delivered(2026, 2)
+    assert scheduler.missed_month(datetime.datetime(2026, 3, 5, 5)) is None
@@ -0,0 +1,49 @@
+import os
+from types import SimpleNamespace
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import bot
+
+
+HEADER = ['ID', 'ФИО', 'Подгруппа']
+
+
+def bits(roster):
+    return {student.name: student.bit for student in roster.students}
+
+
+def test_bits_survive_refresh_and_free_up_for_new_students():
+    first = bot.Roster([HEADER, ['1', 'A', '1'], ['2', 'B', '1'], ['3', 'C', '2']])
+    second = bot.Roster([HEADER, ['1', 'A', '1'], ['3', 'C', '2'], ['4', 'D', '2']], previous=first)
+    assert bits(second)['A'] == bits(first)['A']
+    assert bits(second)['C'] == bits(first)['C']
+    # Номер ушедшего B достаётся новому студенту, общая карта не растёт
+    assert bits(second)['D'] == bits(first)['B']
+    assert len(second.bit_positions) == 3
+
+
+def test_rosters_do_not_share_bit_positions():
+    bot.Roster([HEADER] + [[str(i), f'S{i}', ''] for i in range(50)])
+    roster = bot.Roster([HEADER, ['1', 'A', '']])
+    assert bits(roster) == {'A': 1}
+
+
+def test_toggle_ignores_students_outside_current_list(monkeypatch):
+    answers = []
+    refreshed = []
+    monkeypatch.setattr(bot, 'outbox', SimpleNamespace(
+        answer_callback_query=lambda call_id, text=None, **kwargs: answers.append(text)))
+    monkeypatch.setattr(bot, 'refresh_students_list', lambda chat_id, message_id=None: refreshed.append(chat_id))
+    monkeypatch.setattr(bot, 'user_data', {})
+    
+    roster = bot.Roster([HEADER, ['1', 'A', '1'], ['2', 'B', '2']])
+    user = bot.get_user_data(7)
+    user['students_list'] = roster.for_subgroup('1')
+    other = roster.for_subgroup('2')[0]
+    call = SimpleNamespace(id='1', data=f'toggle_{other.id}',
+                           message=SimpleNamespace(chat=SimpleNamespace(id=7), message_id=1))
+    bot.toggle_student(call)
+    assert user['selected_students'] == 0
+    assert refreshed == [7]
+    assert answers == ["❌ Данные устарели, обновите список"]
@@ -0,0 +1,54 @@
+import os
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import bot
+
+
+class Sheet:
+    def __init__(self, values=None, records=None, during_read=None):
+        self.values = values or []
+        self.records = records or []
+        self.during_read = during_read
+    
+    def get_all_values(self):
+        return self.values
+    
+    def get_all_records(self):
+        if self.during_read:
+            self.during_read()
+        return self.records
+
+
+def make_cache(monkeypatch, during_read=None):
+    cache = bot.SheetsCache()
+    monkeypatch.setattr(bot, 'sheets_quota', bot.SheetsQuota())
+    monkeypatch.setattr(bot, 'students_sheet', Sheet(values=[['ID', 'ФИО'], ['1', 'A']]))
+    monkeypatch.setattr(bot, 'attendance_sheet', Sheet(
+        records=[{'Дата': '02.02.2026', 'Пара': 1, 'Студент': 'A', 'Статус': 'Присутствовал', 'Причина': '-'}],
+        during_read=during_read))
+    return cache
+
+
+def test_prefetch_reads_sheets_without_holding_the_lock(monkeypatch):
+    def during_read():
+        assert cache.lock.acquire(blocking=False)
+        cache.lock.release()
+    cache = make_cache(monkeypatch, during_read)
+    cache.prefetch('02.02.2026', [1])
+    assert cache.get_attendance('02.02.2026', 1) == {'A': {'status': 'Присутствовал', 'reason': '-'}}
+
+
+def test_prefetched_students_use_the_normal_ttl(monkeypatch):
+    cache = make_cache(monkeypatch)
+    cache.prefetch('02.02.2026', [1])
+    bot.students_sheet.values = [['ID', 'ФИО'], ['1', 'A'], ['2', 'B']]
+    cache.students_timestamp -= cache.cache_ttl + 1
+    assert 'B' in cache.get_roster()
+
+
+def test_write_during_prefetch_is_not_overwritten(monkeypatch):
+    newer = {'A': {'status': 'Отсутствовал', 'reason': '-'}}
+    cache = make_cache(monkeypatch, lambda: cache.store_attendance('02.02.2026', 1, newer))
+    cache.prefetch('02.02.2026', [1])
+    assert cache.get_attendance('02.02.2026', 1) == newer
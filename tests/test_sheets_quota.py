@@ -0,0 +1,42 @@
+import os
+import time
+
+import pytest
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import bot
+
+
+def test_handler_does_not_wait_longer_than_its_budget():
+    quota = bot.SheetsQuota(burst=1, interval=100, max_wait=1)
+    quota.acquire()
+    with pytest.raises(bot.QuotaExceeded):
+        quota.acquire()
+
+
+def test_429_closes_the_quota_and_slows_down():
+    quota = bot.SheetsQuota(burst=5, interval=1, max_backoff=30, max_wait=1)
+    delay = quota.penalize(retry_after=20)
+    assert delay >= 20
+    assert quota.interval == 1.5
+    with pytest.raises(bot.QuotaExceeded):
+        quota.wait_open()
+    
+    for _ in range(10):
+        quota.blocked_until = 0.0
+        quota.penalize()
+    assert quota.interval == quota.max_interval == 4
+    
+    for _ in range(50):
+        quota.reward()
+    assert quota.interval == 1 and quota.strikes == 0
+
+
+def test_background_thread_waits_instead_of_failing():
+    quota = bot.SheetsQuota(burst=1, interval=0.05, max_wait=0)
+    quota.wait_without_limit()
+    started = time.monotonic()
+    quota.acquire()
+    quota.acquire()
+    assert time.monotonic() - started >= 0.04
@@ -0,0 +1,27 @@
+import os
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import bot
+
+
+def test_default_curator_can_unsubscribe(tmp_path):
+    filename = str(tmp_path / 'subscriptions.json')
+    subscriptions = bot.Subscriptions(filename, defaults={'alerts': [1]})
+    assert subscriptions.get('alerts') == {1}
+    
+    assert subscriptions.toggle('alerts', 1) is False
+    assert subscriptions.get('alerts') == set()
+    # Отписка переживает перезапуск
+    assert bot.Subscriptions(filename, defaults={'alerts': [1]}).get('alerts') == set()
+    
+    assert subscriptions.toggle('alerts', 1) is True
+    assert subscriptions.get('alerts') == {1}
+
+
+def test_regular_chat_toggles(tmp_path):
+    subscriptions = bot.Subscriptions(str(tmp_path / 'subscriptions.json'), defaults={'alerts': [1]})
+    assert subscriptions.toggle('alerts', 2) is True
+    assert subscriptions.get('alerts') == {1, 2}
+    assert subscriptions.toggle('alerts', 2) is False
+    assert subscriptions.get('alerts') == {1}
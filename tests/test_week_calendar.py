@@ -0,0 +1,16 @@
+import datetime
+import os
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import bot
+
+
+def test_semester_starting_mid_week_resets_parity():
+    calendar = bot.WeekCalendar([datetime.date(2025, 9, 1), datetime.date(2026, 2, 11)], 'odd')
+    # Первая неделя второго семестра - верхняя уже со дня начала, а не со следующего понедельника
+    assert calendar.week_type(datetime.date(2026, 2, 11)) == 'odd'
+    assert calendar.week_type(datetime.date(2026, 2, 15)) == 'odd'
+    assert calendar.week_type(datetime.date(2026, 2, 16)) == 'even'
+    assert calendar.week_type(datetime.date(2026, 2, 22)) == 'even'
+    assert calendar.week_type(datetime.date(2026, 2, 23)) == 'odd'